@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+import time
+
+from readux.annotations.models import Annotation
+from readux.annotations.views import export_filter, ndjson_annotations
+
+
+class Command(BaseCommand):
+    '''Export annotations as newline-delimited JSON, one annotation per
+    line, in the format used by the annotator store API; the export can
+    be loaded into another instance with **import_annotations**.  Groups
+    with permissions on annotations are identified by name, since group
+    ids are specific to a single instance.
+    Annotations are loaded and written in batches, so memory use does
+    not depend on the number of annotations exported.
+    '''
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('-o', '--output',
+            help='File to write annotations to (default: standard output)')
+        parser.add_argument('--volume', action='append',
+            help='Only export annotations on the specified volume pid ' +
+                 '(can be repeated)')
+        parser.add_argument('--collection', action='append',
+            help='Only export annotations on volumes in the specified ' +
+                 'collection pid (can be repeated)')
+        parser.add_argument('--user', action='append',
+            help='Only export annotations by the specified username ' +
+                 '(can be repeated)')
+        parser.add_argument('--group', action='append',
+            help='Only export annotations visible to the specified group ' +
+                 'name (can be repeated)')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of annotations to load at once (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        notes = export_filter(Annotation.objects.all().select_related('user'),
+                              volumes=options['volume'],
+                              collections=options['collection'],
+                              users=options['user'],
+                              groups=options['group'])
+
+        start = time.time()
+        total = 0
+        output = open(options['output'], 'w') if options['output'] else self.stdout
+        try:
+            for chunk in ndjson_annotations(notes, batch_size=options['batch_size'],
+                                            export=True):
+                # each chunk ends with a newline, so none is added
+                # when writing to stdout
+                output.write(chunk)
+                total += chunk.count('\n')
+        finally:
+            if output is not self.stdout:
+                output.close()
+
+        # report to stderr, since annotations may be written to stdout
+        self.stderr.write('Exported %d annotations in %.02fs' % \
+            (total, time.time() - start))
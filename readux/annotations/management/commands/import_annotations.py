@@ -1,61 +1,299 @@
+from contextlib import contextmanager
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import pre_delete, post_delete
+from guardian.models import UserObjectPermission, GroupObjectPermission
+from guardian.shortcuts import get_perms_for_model
+import itertools
 import json
+import time
+import uuid
+
+from readux import versions
+from readux.annotations.models import Annotation, AnnotationVisibility, \
+    AnnotationTerm, AnnotationTag, AnnotationCount, AnnotationChange, \
+    remove_annotation_visibility, find_annotation_users, remove_annotation_count
+
+
+#: signal receivers that update visibility, counts and the change log
+#: for one deleted annotation or permission at a time; the import
+#: updates these in bulk instead
+DELETE_RECEIVERS = [
+    (post_delete, remove_annotation_visibility, UserObjectPermission),
+    (post_delete, remove_annotation_visibility, GroupObjectPermission),
+    (pre_delete, find_annotation_users, Annotation),
+    (post_delete, remove_annotation_count, Annotation),
+]
+
+
+@contextmanager
+def disconnect(receivers):
+    # temporarily disconnect signal receivers, so that existing
+    # annotations and permissions can be deleted without per-row
+    # updates (and with a single query)
+    for signal, receiver, sender in receivers:
+        signal.disconnect(receiver, sender=sender)
+    try:
+        yield
+    finally:
+        for signal, receiver, sender in receivers:
+            signal.connect(receiver, sender=sender)
+
+
+def is_group(entity):
+    # check if a user or group in annotation permissions is a group,
+    # identified by id or, in exports, by name
+    return entity.startswith('group:') or \
+        entity.startswith(Annotation.export_group_prefix)
+
+
+@contextmanager
+def preserve_timestamps():
+    # disable automatic dates on annotation created and updated fields
+    # so that imported annotations keep their original dates
+    fields = [Annotation._meta.get_field(name) for name in ['created', 'updated']]
+    settings = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, settings):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def read_annotations(datafile):
+    '''Generator for annotation data from a file, which can be either
+    JSON in the format provided by the annotator store API search, or
+    newline-delimited JSON with one annotation per line, as generated by
+    the **export_annotations** manage command (only one line is loaded
+    at a time).'''
+    first = datafile.readline()
+    try:
+        data = json.loads(first)
+    except ValueError:
+        data = None
+
+    if isinstance(data, dict) and 'rows' not in data:
+        yield data
+        for line in datafile:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        for data in json.loads(first + datafile.read())['rows']:
+            yield data
 
-from readux.annotations.models import Annotation
 
 class Command(BaseCommand):
-    '''Import a JSON file of annotation data in the format provided
-    by the annotator store API (i.e., search results) and create
-    corresponding local annotations for.
+    '''Import a file of annotation data, either JSON in the format
+    provided by the annotator store API (i.e., search results) or
+    newline-delimited JSON as generated by **export_annotations**, and
+    create corresponding local annotations for.  Annotations are
+    inserted in batches, along with permissions and the search index,
+    tags, and change log normally updated when an annotation is saved;
+    existing annotations with the same ids are replaced.  Annotation
+    authors must exist in this instance; permissions are only imported
+    for users that exist and for groups identified by name (as
+    exported by **export_annotations**) that exist in this instance.
+    The import is run in a single transaction, so if any annotation
+    can't be imported, no annotations are imported.
     '''
+    help = __doc__
 
     def add_arguments(self, parser):
         parser.add_argument('file',
-            help='JSON file with annotation data')
+            help='JSON or newline-delimited JSON file with annotation data')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of annotations to insert at once (default: %(default)s)')
 
     def handle(self, *args, **options):
-        print options['file']
+        #: cache of user ids by username
+        self.users = {}
+        #: group ids by name
+        self.groups = dict(Group.objects.values_list('name', 'pk'))
+        #: users in annotation permissions that could not be found
+        self.skipped_users = set()
+        #: groups in annotation permissions that could not be found
+        self.skipped_groups = set()
+        #: page and volume uris for imported annotations
+        self.uris = set()
+        self.ctype = ContentType.objects.get_for_model(Annotation)
+        # skip default django add permission - not relevant
+        # on an individual object
+        self.permissions = dict((perm.codename, perm)
+                                for perm in get_perms_for_model(Annotation)
+                                if perm.codename != 'add_annotation')
+
+        start = time.time()
+        total = 0
+        batch_size = options['batch_size']
         with open(options['file']) as datafile:
-            data = json.loads(datafile.read())
+            rows = read_annotations(datafile)
+            with versions.atomic():
+                with preserve_timestamps():
+                    while True:
+                        batch = list(itertools.islice(rows, batch_size))
+                        if not batch:
+                            break
+                        total += self.import_batch(batch)
+                        elapsed = time.time() - start
+                        self.stdout.write('Imported %d annotations (%.01f/s)' % \
+                            (total, total / elapsed if elapsed else total))
 
-        for annotation in data['rows']:
-            self.import_annotation(annotation)
+                # update precomputed counts for all imported annotations
+                AnnotationCount.update_pages(self.uris)
 
-    def import_annotation(self, data):
-        '''Create and save a new annotation, setting fields based on a
-        dictionary of data passed in.  Raises an error if an annotation
-        author is not found as a user in the database.'''
-        note = Annotation()
+        self.stdout.write('Imported %d annotations in %.02fs' % \
+            (total, time.time() - start))
+        if self.skipped_users:
+            self.stdout.write('Skipped permissions for unknown users: %s' % \
+                ', '.join(sorted(self.skipped_users)))
+        if self.skipped_groups:
+            self.stdout.write('Skipped permissions for unknown groups: %s' % \
+                ', '.join(sorted(self.skipped_groups)))
+
+    def import_batch(self, rows):
+        '''Import a list of annotation data in bulk; returns the number
+        of annotations imported.'''
+        self.load_users(rows)
+        notes, permissions = zip(*[self.import_annotation(data) for data in rows])
+        ids = [unicode(note.id) for note in notes]
+        self.uris.update((note.uri, note.volume_uri) for note in notes)
 
         # NOTE: because we are using uuid for annotation id field,
         # importing an annotation twice does not error, but simply
         # replaces the old copy.  Might want to add checks for this...
+        existing = set(Annotation.objects.filter(pk__in=ids)
+                                 .values_list('id', 'uri', 'volume_uri'))
+        # counts for the previous uris are updated with the others
+        self.uris.update((uri, volume_uri) for note_id, uri, volume_uri in existing)
+        with disconnect(DELETE_RECEIVERS):
+            UserObjectPermission.objects.filter(content_type=self.ctype,
+                                                object_pk__in=ids).delete()
+            GroupObjectPermission.objects.filter(content_type=self.ctype,
+                                                 object_pk__in=ids).delete()
+            Annotation.objects.filter(pk__in=ids).delete()
+
+        Annotation.objects.bulk_create(notes)
+
+        # bulk_create does not call save or send signals, so create
+        # permissions, visibility, search index and tags directly
+        user_perms = set()
+        group_perms = set()
+        for note, note_permissions in zip(notes, permissions):
+            # annotation owner has full access
+            if note.user_id is not None:
+                user_perms.update((note.id, note.user_id, codename)
+                                  for codename in self.permissions.keys())
+            for mode, entities in note_permissions.iteritems():
+                codename = Annotation.permission_to_codename.get(mode, None)
+                if codename is None:
+                    continue
+                for entity in entities:
+                    if is_group(entity):
+                        group_id = self.group_id(entity)
+                        if group_id is not None:
+                            group_perms.add((note.id, group_id, codename))
+                    elif entity in self.users:
+                        user_perms.add((note.id, self.users[entity], codename))
+
+        UserObjectPermission.objects.bulk_create([
+            UserObjectPermission(content_type=self.ctype,
+                                 permission=self.permissions[codename],
+                                 user_id=user_id, object_pk=unicode(note_id))
+            for note_id, user_id, codename in user_perms])
+        GroupObjectPermission.objects.bulk_create([
+            GroupObjectPermission(content_type=self.ctype,
+                                  permission=self.permissions[codename],
+                                  group_id=group_id, object_pk=unicode(note_id))
+            for note_id, group_id, codename in group_perms])
+        AnnotationVisibility.objects.bulk_create(
+            [AnnotationVisibility(annotation_id=note_id, principal_id=user_id,
+                                  principal_type=AnnotationVisibility.USER)
+             for note_id, user_id, codename in user_perms
+             if codename == 'view_annotation'] +
+            [AnnotationVisibility(annotation_id=note_id, principal_id=group_id,
+                                  principal_type=AnnotationVisibility.GROUP)
+             for note_id, group_id, codename in group_perms
+             if codename == 'view_annotation'])
+        AnnotationTerm.objects.bulk_create([term for note in notes
+                                            for term in AnnotationTerm.for_annotation(note)])
+        AnnotationTag.objects.bulk_create([tag for note in notes
+                                           for tag in AnnotationTag.for_annotation(note)])
+        imported = set((note.id, note.uri, note.volume_uri) for note in notes)
+        # replaced annotations that are no longer on the same uri
+        AnnotationChange.record(AnnotationChange.DELETE, existing - imported)
+        AnnotationChange.record(AnnotationChange.UPDATE, imported)
+        return len(notes)
+
+    def load_users(self, rows):
+        '''Look up ids for all annotation authors and users with
+        annotation permissions in a list of annotation data that are not
+        already loaded, with a single query.  Raises an error if any
+        author is not found in the database; permissions for users that
+        are not found are skipped.'''
+        authors = set(data['user'] for data in rows if data.get('user', None))
+        usernames = set(authors)
+        for data in rows:
+            for entities in data.get('permissions', {}).itervalues():
+                usernames.update(entity for entity in entities
+                                 if not is_group(entity))
+        usernames -= set(self.users.keys()) | self.skipped_users
+        if usernames:
+            # NOTE: this could result in making one person's annotations
+            # available to someone else, if someone is using a different
+            # username in another instance
+            self.users.update(get_user_model().objects.filter(username__in=usernames)
+                                              .values_list('username', 'pk'))
+        missing = authors - set(self.users.keys())
+        if missing:
+            raise CommandError('Cannot import annotations for user %s (does not exist)' % \
+                               ', '.join(sorted(missing)))
+        self.skipped_users.update(usernames - set(self.users.keys()))
+
+    def group_id(self, entity):
+        '''Local id for a group in annotation permissions, or None if
+        the group is not found.  Groups are matched by name, as exported
+        by **export_annotations**; group ids (as used by the annotator
+        store API) are specific to a single instance, so groups
+        identified by id are skipped.'''
+        if entity.startswith(Annotation.export_group_prefix):
+            name = entity[len(Annotation.export_group_prefix):]
+            if name in self.groups:
+                return self.groups[name]
+        self.skipped_groups.add(entity)
+
+    def import_annotation(self, data):
+        '''Initialize a new annotation, setting fields based on a
+        dictionary of data passed in.  Annotation author must already be
+        loaded by :meth:`load_users`.  Returns the annotation and its
+        permissions dictionary.'''
+        note = Annotation()
 
         # required fields that should always be present
         # (not normally set by user)
         for field in ['updated', 'created', 'id']:
             setattr(note, field, data[field])
             del data[field]
+        note.id = uuid.UUID(note.id)
         # user is special: annotation data only includes username,
-        # but we need a user object
-        # NOTE: this could result in making one person's annotations
-        # available to someone else, if someone is using a different
-        # username in another instance
-        if 'user' in data:
-            try:
-                note.user = get_user_model().objects.get(username=data['user'])
-                del data['user']
-            except get_user_model().DoesNotExist:
-                raise CommandError('Cannot import annotations for user %s (does not exist)' % data['user'])
+        # but we need a user id
+        if data.get('user', None):
+            note.user_id = self.users[data['user']]
+        data.pop('user', None)
 
         for field in Annotation.common_fields:
             if field in data:
                 setattr(note, field, data[field])
                 del data[field]
 
+        # permissions are stored as database permissions, not extra data
+        permissions = data.pop('permissions', None) or {}
+
         # put any other data that is left in extra data json field
         if data:
             note.extra_data.update(data)
 
-        note.save()
+        return note, permissions
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+import time
+
+from readux import versions
+from readux.annotations.models import Annotation, AnnotationCount
+
+
+class Command(BaseCommand):
+    '''Rebuild the precomputed per-volume and per-page annotation counts
+    (see :class:`~readux.annotations.models.AnnotationCount`) from
+    annotations and annotation permissions.  Counts are normally kept
+    up to date automatically; use this to populate counts for existing
+    annotations, or to repair them.
+    '''
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('volume_uri', nargs='*',
+            help='Only rebuild counts for the specified volume uris ' +
+                 '(default: all volumes)')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        notes = Annotation.objects.all()
+        counts = AnnotationCount.objects.all()
+        if options['volume_uri']:
+            notes = notes.filter(volume_uri__in=options['volume_uri'])
+            counts = counts.filter(volume_uri__in=options['volume_uri'])
+
+        with versions.atomic():
+            # remove all existing counts first, so that counts for
+            # volumes or pages that no longer have annotations are removed
+            counts.delete()
+            AnnotationCount.update_annotations(notes)
+
+        total = AnnotationCount.objects.filter(user__isnull=True)
+        if options['volume_uri']:
+            total = total.filter(volume_uri__in=options['volume_uri'])
+        self.stdout.write('Rebuilt annotation counts for %d volumes and %d pages in %.02fs' % \
+            (total.filter(uri_type=AnnotationCount.VOLUME).count(),
+             total.filter(uri_type=AnnotationCount.PAGE).count(),
+             time.time() - start))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_visibility(apps, schema_editor):
+    # create annotation visibility records for all existing
+    # guardian per-object view permissions on annotations
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Permission = apps.get_model('auth', 'Permission')
+    UserObjectPermission = apps.get_model('guardian', 'UserObjectPermission')
+    GroupObjectPermission = apps.get_model('guardian', 'GroupObjectPermission')
+    AnnotationVisibility = apps.get_model('annotations', 'AnnotationVisibility')
+
+    try:
+        ctype = ContentType.objects.get(app_label='annotations',
+                                        model='annotation')
+        view_perm = Permission.objects.get(content_type=ctype,
+                                           codename='view_annotation')
+    except (ContentType.DoesNotExist, Permission.DoesNotExist):
+        # no permissions have been created, so nothing to do
+        return
+
+    # guardian permissions are not removed when annotations are deleted,
+    # so only include permissions for annotations that exist
+    Annotation = apps.get_model('annotations', 'Annotation')
+    annotation_ids = set(unicode(pk) for pk in
+                         Annotation.objects.values_list('id', flat=True))
+
+    for model, principal_type, principal_field in [
+            (UserObjectPermission, 'user', 'user_id'),
+            (GroupObjectPermission, 'group', 'group_id')]:
+        perms = model.objects.filter(content_type=ctype, permission=view_perm) \
+                             .values_list('object_pk', principal_field)
+        AnnotationVisibility.objects.bulk_create([
+            AnnotationVisibility(annotation_id=object_pk,
+                                 principal_type=principal_type,
+                                 principal_id=principal_id)
+            for object_pk, principal_id in perms.iterator()
+            if object_pk in annotation_ids
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('guardian', '0001_initial'),
+        ('annotations', '0005_grant_user_access'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnnotationVisibility',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('principal_type', models.CharField(max_length=5, choices=[(b'user', b'User'), (b'group', b'Group')])),
+                ('principal_id', models.IntegerField()),
+                ('annotation', models.ForeignKey(related_name='visibility', to='annotations.Annotation')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='annotationvisibility',
+            unique_together=set([('annotation', 'principal_type', 'principal_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='annotationvisibility',
+            index_together=set([('principal_type', 'principal_id', 'annotation')]),
+        ),
+        migrations.RunPython(populate_visibility,
+                             reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import Counter
+import json
+import re
+
+from django.db import migrations, models
+
+
+# tokenizing as implemented by AnnotationTerm when this migration was
+# written; copied here so the migration does not depend on current models
+MAX_LENGTH = 100
+TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return [term[:MAX_LENGTH]
+            for term in TERM_PATTERN.findall((text or '').lower())]
+
+
+def populate_terms(apps, schema_editor):
+    # build the full-text search index for all existing annotations
+    Annotation = apps.get_model('annotations', 'Annotation')
+    AnnotationTerm = apps.get_model('annotations', 'AnnotationTerm')
+
+    terms = []
+    for note in Annotation.objects.all().iterator():
+        extra_data = note.extra_data
+        if isinstance(extra_data, basestring):
+            extra_data = json.loads(extra_data or '{}')
+        tags = extra_data.get('tags', None) or []
+        if isinstance(tags, basestring):
+            tags = [tags]
+
+        counts = Counter()
+        for field, values in [('text', [note.text]), ('quote', [note.quote]),
+                              ('tags', tags)]:
+            for value in values:
+                for term in tokenize(value):
+                    counts[(field, term)] += 1
+        terms.extend(AnnotationTerm(annotation_id=note.pk, field=field,
+                                    term=term, count=count)
+                     for (field, term), count in counts.iteritems())
+        if len(terms) >= 1000:
+            AnnotationTerm.objects.bulk_create(terms)
+            terms = []
+    AnnotationTerm.objects.bulk_create(terms)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotations', '0006_annotation_visibility'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnnotationTerm',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('field', models.CharField(max_length=5, choices=[(b'text', b'Text'), (b'quote', b'Quote'), (b'tags', b'Tags')])),
+                ('term', models.CharField(max_length=100)),
+                ('count', models.PositiveIntegerField(default=1)),
+                ('annotation', models.ForeignKey(related_name='terms', to='annotations.Annotation')),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='annotation',
+            name='uri',
+            field=models.URLField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='annotation',
+            name='volume_uri',
+            field=models.URLField(db_index=True, blank=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='annotationterm',
+            unique_together=set([('annotation', 'field', 'term')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='annotationterm',
+            index_together=set([('term', 'field', 'annotation')]),
+        ),
+        migrations.RunPython(populate_terms,
+                             reverse_code=migrations.RunPython.noop),
+    ]
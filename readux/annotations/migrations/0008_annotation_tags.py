@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+from django.utils.text import slugify
+
+
+def normalize_tags(tags):
+    # tag normalization as implemented by AnnotationTag when this
+    # migration was written; copied here so the migration does not
+    # depend on current models.  Returns a list of (tag, slug), with
+    # tags that differ only by capitalization or punctuation included once.
+    normalized = []
+    slugs = set()
+    for tag in tags:
+        tag = tag.strip()[:255]
+        slug = slugify(tag)
+        if slug and slug not in slugs:
+            slugs.add(slug)
+            normalized.append((tag, slug))
+    return normalized
+
+
+def populate_tags(apps, schema_editor):
+    # create normalized tag records for all existing annotations
+    Annotation = apps.get_model('annotations', 'Annotation')
+    AnnotationTag = apps.get_model('annotations', 'AnnotationTag')
+
+    tags = []
+    for note in Annotation.objects.all().iterator():
+        extra_data = note.extra_data
+        if isinstance(extra_data, basestring):
+            extra_data = json.loads(extra_data or '{}')
+        note_tags = extra_data.get('tags', None) or []
+        if isinstance(note_tags, basestring):
+            note_tags = [note_tags]
+        tags.extend(AnnotationTag(annotation_id=note.pk, tag=tag, slug=slug)
+                    for tag, slug in normalize_tags(note_tags))
+        if len(tags) >= 1000:
+            AnnotationTag.objects.bulk_create(tags)
+            tags = []
+    AnnotationTag.objects.bulk_create(tags)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotations', '0007_annotation_terms'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnnotationTag',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('tag', models.CharField(max_length=255)),
+                ('slug', models.SlugField(max_length=255)),
+                ('annotation', models.ForeignKey(related_name='tag_set', to='annotations.Annotation')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='annotationtag',
+            unique_together=set([('annotation', 'slug')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='annotationtag',
+            index_together=set([('slug', 'annotation')]),
+        ),
+        migrations.RunPython(populate_tags,
+                             reverse_code=migrations.RunPython.noop),
+    ]
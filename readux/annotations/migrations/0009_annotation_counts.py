@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('annotations', '0008_annotation_tags'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnnotationCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('uri', models.URLField()),
+                ('uri_type', models.CharField(max_length=6, choices=[(b'volume', b'Volume'), (b'page', b'Page')])),
+                ('volume_uri', models.URLField(blank=True)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='annotationcount',
+            index_together=set([('user', 'uri_type', 'uri'), ('user', 'uri_type', 'volume_uri')]),
+        ),
+    ]
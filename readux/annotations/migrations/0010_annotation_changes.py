@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotations', '0009_annotation_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnnotationChange',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('annotation_id', models.UUIDField(db_index=True)),
+                ('uri', models.URLField()),
+                ('volume_uri', models.URLField(blank=True)),
+                ('action', models.CharField(max_length=6, choices=[(b'update', b'Created or updated'), (b'delete', b'Deleted')])),
+                ('time', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='annotationchange',
+            index_together=set([('uri', 'id'), ('volume_uri', 'id')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('annotations', '0010_annotation_changes'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='annotationcount',
+            unique_together=set([('uri_type', 'uri', 'volume_uri', 'user')]),
+        ),
+    ]
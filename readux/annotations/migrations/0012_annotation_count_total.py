@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_totals(apps, schema_editor):
+    # mark existing total counts; any duplicate totals (created by
+    # concurrent updates before totals were unique) are removed, and
+    # counts should be rebuilt with rebuild_annotation_counts
+    AnnotationCount = apps.get_model('annotations', 'AnnotationCount')
+    totals = AnnotationCount.objects.filter(user__isnull=True)
+    seen = set()
+    duplicates = []
+    for pk, uri_type, uri, volume_uri in totals.order_by('pk') \
+            .values_list('pk', 'uri_type', 'uri', 'volume_uri'):
+        if (uri_type, uri, volume_uri) in seen:
+            duplicates.append(pk)
+        seen.add((uri_type, uri, volume_uri))
+    if duplicates:
+        AnnotationCount.objects.filter(pk__in=duplicates).delete()
+    totals.update(total=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotations', '0011_annotation_count_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotationcount',
+            name='total',
+            field=models.NullBooleanField(),
+        ),
+        migrations.RunPython(mark_totals, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='annotationcount',
+            unique_together=set([('uri_type', 'uri', 'volume_uri', 'total'), ('uri_type', 'uri', 'volume_uri', 'user')]),
+        ),
+    ]
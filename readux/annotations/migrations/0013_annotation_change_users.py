@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotations', '0012_annotation_count_total'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotationchange',
+            name='users',
+            field=jsonfield.fields.JSONField(null=True, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='annotationchange',
+            name='action',
+            field=models.CharField(max_length=6, choices=[(b'update', b'Created or updated'), (b'delete', b'Deleted'), (b'remove', b'No longer visible to some users')]),
+        ),
+    ]
@@ -1,17 +1,27 @@
-from collections import OrderedDict
+import base64
+from collections import OrderedDict, Counter, defaultdict
+from datetime import timedelta
 import json
 import logging
+import re
 import uuid
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import Group, User
+from django.utils.dateparse import parse_datetime
 from django.utils.html import format_html
+from django.utils.text import slugify
 from jsonfield import JSONField
-from guardian.shortcuts import assign_perm, get_objects_for_user, \
-    get_objects_for_group, get_perms_for_model, get_perms
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_save, pre_delete, post_delete, \
+    m2m_changed
+from django.dispatch import receiver
+from guardian.shortcuts import assign_perm, get_perms_for_model, get_perms
 from guardian.models import UserObjectPermission, GroupObjectPermission
 
+from readux import versions
+
 
 logger = logging.getLogger(__name__)
 
@@ -27,39 +37,111 @@ class AnnotationQuerySet(models.QuerySet):
         annotations; users can access only their own annotations or
         those where permissions have been granted to a group they belong to.
 
-        .. Note::
-            Due to the use of :meth:`guardian.shortcuts.get_objects_for_user`,
-            it is recommended to use this method must be used first; it
-            does combine the existing queryset query, but it does not
-            chain as querysets normally do.
-
+        Per-object view permissions are found with an indexed join on
+        :class:`AnnotationVisibility`, which is kept in sync with
+        :mod:`guardian` per-object permissions; results are distinct,
+        since an annotation may be visible both directly and through
+        a group.
         """
-        qs = get_objects_for_user(user, 'view_annotation',
-                                    Annotation)
-        # combine the current queryset query, if any, with the newly
-        # created queryset from django guardian
-        qs.query.combine(self.query, 'AND')
-        return qs
+        if user.is_anonymous():
+            return self.none()
+        # superusers and users with global view permission can view all
+        if user.is_superuser or user.has_perm('annotations.view_annotation'):
+            return self.all()
+
+        return self.filter(
+            models.Q(visibility__principal_type=AnnotationVisibility.USER,
+                     visibility__principal_id=user.pk) |
+            models.Q(visibility__principal_type=AnnotationVisibility.GROUP,
+                     visibility__principal_id__in=list(user.groups.values_list('pk', flat=True)))
+        ).distinct()
 
     def visible_to_group(self, group):
         """
-        Return annotations the specified group is allowed to view.
-        Objects are found based on view_annotation permission and
-        per-object permissions.
-
-        .. Note::
-            Due to the use of :meth:`guardian.shortcuts.get_objects_for_user`,
-            it is recommended to use this method first; it does combine
-            the existing queryset query, but it does not chain as querysets
-            normally do.
-
+        Return annotations the specified group is allowed to view,
+        based on per-object view_annotation permissions (see
+        :class:`AnnotationVisibility`).
         """
-        qs = get_objects_for_group(group, 'view_annotation',
-                                   Annotation)
-        # combine current queryset query, if any, with the newly
-        # created queryset from django guardian
-        qs.query.combine(self.query, 'AND')
-        return qs
+        return self.filter(visibility__principal_type=AnnotationVisibility.GROUP,
+                           visibility__principal_id=group.pk)
+
+    def info_list(self):
+        '''Serialize all annotations in the queryset, equivalent to
+        calling :meth:`Annotation.info` on each one, but loading
+        permissions for all annotations at once (see
+        :meth:`Annotation.bulk_permissions`), so the number of queries
+        does not depend on the number of annotations.  Use
+        ``select_related('user')`` on the queryset to avoid a query for
+        each annotation user.'''
+        return Annotation.bulk_info(list(self))
+
+    def search(self, query, fields=None):
+        '''Full-text search on annotation text, quote and tags, using
+        the :class:`AnnotationTerm` index.  Every term in the query must
+        match the beginning of an indexed term in one of the specified
+        fields (case-insensitive).  Results are not sorted; see
+        :meth:`by_relevance`.
+
+        :param query: search string
+        :param fields: optional list of fields to search; one or more of
+            :attr:`AnnotationTerm.FIELDS` (default: all)
+        '''
+        notes = self
+        for term in AnnotationTerm.tokenize(query):
+            notes = notes.filter(pk__in=AnnotationTerm.objects
+                .matching(term, fields).values('annotation'))
+        return notes
+
+    def tagged(self, tags):
+        '''Return annotations with all of the specified tags, using the
+        :class:`AnnotationTag` table.  Tags are matched by slug, so
+        matching ignores case and punctuation.
+
+        :param tags: list of tags
+        '''
+        notes = self
+        for slug in set(slugify(tag) for tag in tags if tag.strip()):
+            notes = notes.filter(pk__in=AnnotationTag.objects.filter(slug=slug)
+                                                             .values('annotation'))
+        return notes
+
+    def by_relevance(self, searches):
+        '''Sort annotations by relevance for one or more full-text
+        searches, most relevant first; relevance is the total number of
+        times the search terms occur in the searched fields.  Annotations
+        with the same relevance are sorted by :attr:`cursor_ordering`.
+        Adds a ``relevance`` attribute to each annotation.
+
+        :param searches: list of tuples of query and fields, as passed
+            to :meth:`search`
+        '''
+        matches = models.Q()
+        for query, fields in searches:
+            for term in AnnotationTerm.tokenize(query):
+                matches |= models.Q(terms__term__startswith=term,
+                                    terms__field__in=fields or AnnotationTerm.FIELDS)
+        # sum term counts over the matching annotations only, since
+        # joins from other filters (e.g. visibility; see visible_to)
+        # would repeat term rows
+        notes = self.model.objects.filter(pk__in=self.values('pk'))
+        notes.query.select_related = self.query.select_related
+        return notes.filter(matches) \
+                    .annotate(relevance=models.Sum('terms__count')) \
+                    .order_by('-relevance', *self.cursor_ordering)
+
+    #: stable sort order for cursor pagination; see :meth:`after`
+    cursor_ordering = ('created', 'id')
+
+    def after(self, cursor):
+        '''Return annotations after the specified cursor (as generated
+        by :attr:`Annotation.cursor`), sorted by :attr:`cursor_ordering`.
+        Uses a keyset filter rather than an offset, so pages are stable
+        when annotations are added and cost the same regardless of
+        position.  Raises :class:`ValueError` if the cursor is invalid.'''
+        created, pk = Annotation.parse_cursor(cursor)
+        return self.filter(models.Q(created__gt=created) |
+                           models.Q(created=created, id__gt=pk)) \
+                   .order_by(*self.cursor_ordering)
 
     def last_created_time(self):
         '''Creation time of the most recently created annotation. If
@@ -122,7 +204,7 @@ class Annotation(models.Model):
     #: the annotated text
     quote = models.TextField()
     #: URI of the annotated document
-    uri = models.URLField()
+    uri = models.URLField(db_index=True)
     #: user who owns the annotation
     #: when serialized, id of annotation owner OR an object with an 'id' property
     # Make user optional for now
@@ -130,7 +212,7 @@ class Annotation(models.Model):
 
     #: Readux-specific field: URI for the volume that an annotation
     #: is associated with (i.e., volume a page is part of)
-    volume_uri = models.URLField(blank=True)
+    volume_uri = models.URLField(blank=True, db_index=True)
 
     # tags still todo
     # "tags": [ "review", "error" ],             # list of tags (from Tags plugin)
@@ -204,6 +286,14 @@ class Annotation(models.Model):
         if 'related_pages' in self.extra_data:
             return self.extra_data['related_pages']
 
+    @property
+    def tags(self):
+        'convenience access to list of tags in extra data'
+        tags = self.extra_data.get('tags', None) or []
+        if isinstance(tags, basestring):
+            tags = [tags]
+        return tags
+
     @classmethod
     def create_from_request(cls, request):
         '''Initialize a new :class:`Annotation` based on data from a
@@ -229,13 +319,65 @@ class Annotation(models.Model):
         # convert extra data back to json for storage in a single json field
         return cls(extra_data=json.dumps(extra_data), **model_data)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Annotation, cls).from_db(db, field_names, values)
+        # keep track of uris as loaded, so that annotation counts
+        # for the old uris can be updated if they are changed
+        instance._loaded_uris = (instance.__dict__.get('uri'),
+                                 instance.__dict__.get('volume_uri'))
+        return instance
+
     def save(self, *args, **kwargs):
         """Extend default save method to ensure annotation user has
-        access to edit and update their own annotation."""
-        super(Annotation, self).save(*args, **kwargs)
-        # NOTE: currently annotation model assumes user is not modified;
-        # if it is changed, previous owner will still have permissions
-        self.grant_user_access()
+        access to edit and update their own annotation, and to update
+        the full-text search index, tags, annotation counts, and
+        change log.  Versions for conditional views are updated once
+        the changes are committed."""
+        with versions.atomic():
+            super(Annotation, self).save(*args, **kwargs)
+            # NOTE: currently annotation model assumes user is not modified;
+            # if it is changed, previous owner will still have permissions
+            self.grant_user_access()
+            self.index_terms()
+            self.update_tags()
+
+            uris = set([(self.uri, self.volume_uri)])
+            loaded_uris = getattr(self, '_loaded_uris', None)
+            if loaded_uris is None:
+                # new annotation: add to the total; counts for users
+                # are updated when view permission is granted
+                AnnotationCount.adjust(self.uri, self.volume_uri, 1)
+            elif None not in loaded_uris and loaded_uris not in uris:
+                # moved to another page: move counts for the total
+                # and every user who can see the annotation
+                uris.add(loaded_uris)
+                for user_ids in [None, _visible_users(self.pk)]:
+                    AnnotationCount.adjust(loaded_uris[0], loaded_uris[1], -1,
+                                           user_ids)
+                    AnnotationCount.adjust(self.uri, self.volume_uri, 1, user_ids)
+            # record the change, and removal from the previous uris
+            # if they have changed
+            AnnotationChange.record(AnnotationChange.UPDATE,
+                                    [(self.pk, self.uri, self.volume_uri)])
+            uris.discard((self.uri, self.volume_uri))
+            AnnotationChange.record(AnnotationChange.DELETE,
+                                    [(self.pk, uri, volume_uri)
+                                     for uri, volume_uri in uris])
+            self._loaded_uris = (self.uri, self.volume_uri)
+
+    def index_terms(self):
+        '''Update the :class:`AnnotationTerm` full-text search index
+        for this annotation.  Index entries are removed automatically
+        when the annotation is deleted.'''
+        self.terms.all().delete()
+        AnnotationTerm.objects.bulk_create(AnnotationTerm.for_annotation(self))
+
+    def update_tags(self):
+        '''Update the :class:`AnnotationTag` records for this annotation
+        to match the tags in extra data.'''
+        self.tag_set.all().delete()
+        AnnotationTag.objects.bulk_create(AnnotationTag.for_annotation(self))
 
     def update_from_request(self, request):
         '''Update attributes from data in a
@@ -285,9 +427,14 @@ class Annotation(models.Model):
 
         self.save()
 
-    def info(self):
+    def info(self, permissions=None):
         '''Return a :class:`collections.OrderedDict` of fields to be
-        included in serialized JSON version of the current annotation.'''
+        included in serialized JSON version of the current annotation.
+
+        :param permissions: optional annotation permissions dictionary,
+            if already loaded; if not specified, :meth:`permissions_dict`
+            will be used
+        '''
         info = OrderedDict([
             ('id', unicode(self.id)),
             ('annotator_schema_version', self.schema_version),
@@ -307,7 +454,8 @@ class Annotation(models.Model):
                      if k not in info})
 
         # annotation permissions dict based on database permissions
-        permissions = self.permissions_dict()
+        if permissions is None:
+            permissions = self.permissions_dict()
         # only include if at least one permission is not empty
         if any(permissions.values()):
             info['permissions'] = permissions
@@ -399,14 +547,93 @@ class Annotation(models.Model):
                     continue
                 self.assign_permission(perm.codename, self.user)
 
+    @property
+    def cursor(self):
+        '''Opaque cursor identifying the position of this annotation in
+        a list sorted by creation date and id; see
+        :meth:`AnnotationQuerySet.after`.'''
+        return base64.urlsafe_b64encode('%s|%s' % (self.created.isoformat(),
+                                                   self.id.hex))
+
+    @staticmethod
+    def parse_cursor(cursor):
+        '''Parse a cursor generated by :attr:`cursor` into a tuple of
+        created datetime and annotation id.  Raises :class:`ValueError`
+        if the cursor is invalid.'''
+        try:
+            created, pk = base64.urlsafe_b64decode(str(cursor)).split('|')
+        except (TypeError, UnicodeEncodeError):
+            raise ValueError('Invalid cursor')
+        created = parse_datetime(created)
+        if created is None:
+            raise ValueError('Invalid cursor')
+        return created, uuid.UUID(pk)
+
+    #: prefix for groups in exported permissions; groups are exported
+    #: by name, since group ids are specific to a single instance
+    export_group_prefix = 'group-name:'
+
+    @classmethod
+    def bulk_info(cls, annotations, export=False):
+        '''Serialize a list of annotations, equivalent to calling
+        :meth:`info` on each one, but with permissions for all annotations
+        loaded at once (see :meth:`bulk_permissions`).'''
+        permissions = cls.bulk_permissions(annotations, export=export)
+        return [note.info(permissions=permissions[note.pk])
+                for note in annotations]
+
+    @classmethod
+    def empty_permissions(cls):
+        'Annotation permissions dictionary with an empty list for each mode'
+        return dict([(mode, []) for mode in cls.permission_to_codename.keys()])
+
+    @classmethod
+    def bulk_permissions(cls, annotations, export=False):
+        '''Load :mod:`guardian` per-object permissions for a list of
+        annotations with one query for user permissions and one for
+        group permissions.  Returns a dictionary of annotation id to
+        permissions dictionary, in the same format as
+        :meth:`permissions_dict`.  If `export` is True, groups are
+        identified by name (with :attr:`export_group_prefix`) instead
+        of id, so that permissions can be imported into another
+        instance.'''
+        permissions = dict((note.pk, cls.empty_permissions())
+                           for note in annotations)
+        # guardian stores object ids as strings
+        object_ids = dict((unicode(pk), pk) for pk in permissions.keys())
+        if not object_ids:
+            return permissions
+        ctype = ContentType.objects.get_for_model(cls)
+
+        user_perms = UserObjectPermission.objects \
+            .filter(content_type=ctype, object_pk__in=object_ids.keys()) \
+            .values_list('object_pk', 'permission__codename', 'user__username')
+        for object_pk, codename, username in user_perms:
+            mode = cls.codename_to_permission[codename]
+            permissions[object_ids[object_pk]][mode].append(username)
+
+        group_perms = GroupObjectPermission.objects \
+            .filter(content_type=ctype, object_pk__in=object_ids.keys()) \
+            .values_list('object_pk', 'permission__codename', 'group_id',
+                         'group__name')
+        for object_pk, codename, group_id, group_name in group_perms:
+            mode = cls.codename_to_permission[codename]
+            if export:
+                group = cls.export_group_prefix + group_name
+            else:
+                # equivalent to AnnotationGroup.annotation_id
+                group = 'group:%d' % group_id
+            permissions[object_ids[object_pk]][mode].append(group)
+
+        return permissions
+
     def permissions_dict(self):
         '''Convert stored :mod:`guardian` per-object permissions into
         annotation permission dictionary format'''
         # convert db permissions into annotator style permissions
 
         # construct base permissions dict, empty list for each mode
-        permissions = dict([(mode, [])
-                           for mode in self.permission_to_codename.keys()])
+        permissions = self.empty_permissions()
 
         for user_perm in self.user_permissions():
             # convert db codename to annotation mode
@@ -460,3 +687,687 @@ class AnnotationGroup(Group):
     @property
     def annotation_id(self):
         return 'group:%d' % self.pk
+
+
+class AnnotationVisibility(models.Model):
+    '''Denormalized list of the users and groups with view permission
+    on each :class:`Annotation`, so that visible annotations can be found
+    with an indexed join (see :meth:`AnnotationQuerySet.visible_to`)
+    instead of querying :mod:`guardian` per-object permissions, which are
+    keyed on string object ids.  Kept in sync with guardian view
+    permissions via signal handlers.'''
+    USER = 'user'
+    GROUP = 'group'
+    PRINCIPAL_TYPE_CHOICES = (
+        (USER, 'User'),
+        (GROUP, 'Group'),
+    )
+
+    #: annotation that can be viewed
+    annotation = models.ForeignKey(Annotation, related_name='visibility')
+    #: type of principal with view access: user or group
+    principal_type = models.CharField(max_length=5,
+                                      choices=PRINCIPAL_TYPE_CHOICES)
+    #: id of the user or group
+    principal_id = models.IntegerField()
+
+    class Meta:
+        unique_together = ('annotation', 'principal_type', 'principal_id')
+        index_together = [('principal_type', 'principal_id', 'annotation')]
+
+    def __repr__(self):
+        return '<AnnotationVisibility: %s %s:%s>' % \
+            (self.annotation_id, self.principal_type, self.principal_id)
+
+
+class AnnotationTermManager(models.Manager):
+    'Custom :class:`~django.models.Manager` for :class:`AnnotationTerm`'
+
+    def matching(self, term, fields=None):
+        '''Index entries for terms beginning with the specified term
+        in any of the specified fields (default: all fields).'''
+        return self.filter(term__startswith=term,
+                           field__in=fields or AnnotationTerm.FIELDS)
+
+
+class AnnotationTerm(models.Model):
+    '''Inverted index of the terms in annotation text, quote and tags,
+    for full-text search on annotations (see
+    :meth:`AnnotationQuerySet.search`) without scanning the annotation
+    table.  Updated when an annotation is saved.'''
+    TEXT = 'text'
+    QUOTE = 'quote'
+    TAGS = 'tags'
+    FIELD_CHOICES = (
+        (TEXT, 'Text'),
+        (QUOTE, 'Quote'),
+        (TAGS, 'Tags'),
+    )
+    #: list of indexed fields
+    FIELDS = [TEXT, QUOTE, TAGS]
+
+    #: maximum length of an indexed term; longer terms are truncated
+    MAX_LENGTH = 100
+    #: pattern for splitting text into terms
+    TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+    #: annotation the term occurs in
+    annotation = models.ForeignKey(Annotation, related_name='terms')
+    #: annotation field the term occurs in
+    field = models.CharField(max_length=5, choices=FIELD_CHOICES)
+    #: lower-case term
+    term = models.CharField(max_length=MAX_LENGTH)
+    #: number of times the term occurs in the field
+    count = models.PositiveIntegerField(default=1)
+
+    objects = AnnotationTermManager()
+
+    class Meta:
+        unique_together = ('annotation', 'field', 'term')
+        index_together = [('term', 'field', 'annotation')]
+
+    def __repr__(self):
+        return '<AnnotationTerm: %s %s:%s>' % \
+            (self.annotation_id, self.field, self.term)
+
+    @classmethod
+    def tokenize(cls, text):
+        'Split text into a list of lower-case terms'
+        return [term[:cls.MAX_LENGTH]
+                for term in cls.TERM_PATTERN.findall((text or '').lower())]
+
+    @classmethod
+    def for_annotation(cls, annotation):
+        '''Generate unsaved index entries for an annotation.
+
+        :param annotation: :class:`Annotation`
+        :returns: list of :class:`AnnotationTerm`
+        '''
+        counts = Counter()
+        for field, values in [(cls.TEXT, [annotation.text]),
+                              (cls.QUOTE, [annotation.quote]),
+                              (cls.TAGS, annotation.tags)]:
+            for value in values:
+                for term in cls.tokenize(value):
+                    counts[(field, term)] += 1
+        return [cls(annotation_id=annotation.pk, field=field, term=term,
+                    count=count)
+                for (field, term), count in counts.iteritems()]
+
+
+class AnnotationTagQuerySet(models.QuerySet):
+    'Custom :class:`~django.models.QuerySet` for :class:`AnnotationTag`'
+
+    def counts(self):
+        '''Number of annotations for each tag, most frequent first.
+        Returns a list of dictionaries with slug, tag (for display;
+        if a tag is used with variant capitalization or punctuation,
+        one of the variants) and count.'''
+        counts = self.values('slug') \
+                     .annotate(display=models.Min('tag'),
+                               count=models.Count('annotation')) \
+                     .order_by('-count', 'slug')
+        return [{'slug': c['slug'], 'tag': c['display'], 'count': c['count']}
+                for c in counts]
+
+
+class AnnotationTag(models.Model):
+    '''Normalized copy of the tags in annotation extra data, so that
+    annotations can be found and counted by tag with an indexed query,
+    without loading and deserializing annotation data.  Updated when an
+    annotation is saved.'''
+
+    #: annotation with the tag
+    annotation = models.ForeignKey(Annotation, related_name='tag_set')
+    #: tag, as entered
+    tag = models.CharField(max_length=255)
+    #: slugified tag, for case-insensitive matching and use in ids
+    slug = models.SlugField(max_length=255)
+
+    objects = AnnotationTagQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('annotation', 'slug')
+        index_together = [('slug', 'annotation')]
+
+    def __repr__(self):
+        return '<AnnotationTag: %s %s>' % (self.annotation_id, self.slug)
+
+    @classmethod
+    def for_annotation(cls, annotation):
+        '''Generate unsaved tag records for an annotation; tags that
+        differ only by capitalization or punctuation are only included
+        once.
+
+        :param annotation: :class:`Annotation`
+        :returns: list of :class:`AnnotationTag`
+        '''
+        tags = OrderedDict()
+        for tag in annotation.tags:
+            tag = tag.strip()[:255]
+            slug = slugify(tag)
+            if slug and slug not in tags:
+                tags[slug] = cls(annotation_id=annotation.pk, tag=tag,
+                                 slug=slug)
+        return tags.values()
+
+
+class AnnotationCountQuerySet(models.QuerySet):
+    'Custom :class:`~django.models.QuerySet` for :class:`AnnotationCount`'
+
+    def for_user(self, user=None):
+        '''Counts of annotations visible to the specified user (as
+        determined by :meth:`AnnotationQuerySet.visible_to`), or of all
+        annotations if no user is specified.'''
+        if user is None or user.is_superuser or \
+           user.has_perm('annotations.view_annotation'):
+            return self.filter(user__isnull=True)
+        if user.is_anonymous():
+            return self.none()
+        return self.filter(user=user)
+
+    def volumes(self):
+        'Dictionary of volume uri to annotation count'
+        return dict(self.filter(uri_type=AnnotationCount.VOLUME)
+                        .values_list('uri', 'count'))
+
+    def pages(self, volume_uri):
+        'Dictionary of page uri to annotation count for a single volume'
+        return dict(self.filter(uri_type=AnnotationCount.PAGE,
+                                volume_uri=volume_uri)
+                        .values_list('uri', 'count'))
+
+
+class AnnotationCount(models.Model):
+    '''Precomputed number of annotations on each volume and page,
+    visible to each user (directly or through a group), and in total,
+    so that annotation counts can be displayed on search results and
+    page lists without aggregating annotations for every request.
+    Adjusted in place when annotations are added, moved or deleted,
+    when view permissions change, and when group membership changes
+    (see :meth:`adjust`); can be rebuilt with the
+    **rebuild_annotation_counts** manage command.'''
+    VOLUME = 'volume'
+    PAGE = 'page'
+    URI_TYPE_CHOICES = (
+        (VOLUME, 'Volume'),
+        (PAGE, 'Page'),
+    )
+
+    #: volume or page uri
+    uri = models.URLField()
+    #: type of uri: volume or page
+    uri_type = models.CharField(max_length=6, choices=URI_TYPE_CHOICES)
+    #: volume uri, for page counts
+    volume_uri = models.URLField(blank=True)
+    #: user the annotations are visible to; if empty, count is the
+    #: total for all annotations
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True)
+    #: True for total counts, and empty otherwise; since databases do
+    #: not consider empty users equal, this keeps totals unique
+    total = models.NullBooleanField()
+    #: number of annotations
+    count = models.PositiveIntegerField(default=0)
+
+    objects = AnnotationCountQuerySet.as_manager()
+
+    class Meta:
+        unique_together = [('uri_type', 'uri', 'volume_uri', 'user'),
+                           ('uri_type', 'uri', 'volume_uri', 'total')]
+        index_together = [('user', 'uri_type', 'uri'),
+                          ('user', 'uri_type', 'volume_uri')]
+
+    def __repr__(self):
+        return '<AnnotationCount: %s %s %s: %d>' % \
+            (self.uri_type, self.uri, self.user_id, self.count)
+
+    @classmethod
+    def update(cls, uri_type, uri, volume_uri=''):
+        '''Recalculate counts for a single volume or page.
+
+        :param uri_type: :attr:`VOLUME` or :attr:`PAGE`
+        :param uri: volume or page uri
+        :param volume_uri: volume uri, for page counts
+        '''
+        if uri_type == cls.VOLUME:
+            notes = Annotation.objects.filter(volume_uri=uri)
+            volume_uri = uri
+        else:
+            notes = Annotation.objects.filter(uri=uri, volume_uri=volume_uri)
+
+        with transaction.atomic():
+            cls.objects.filter(uri_type=uri_type, uri=uri,
+                               volume_uri=volume_uri).delete()
+            total = notes.count()
+            if not total:
+                return
+
+            # annotations visible to each user, directly or through a group
+            visible = defaultdict(set)
+            group_notes = defaultdict(set)
+            for annotation_id, principal_type, principal_id in \
+                    AnnotationVisibility.objects.filter(annotation__in=notes) \
+                        .values_list('annotation', 'principal_type', 'principal_id'):
+                if principal_type == AnnotationVisibility.USER:
+                    visible[principal_id].add(annotation_id)
+                else:
+                    group_notes[principal_id].add(annotation_id)
+            if group_notes:
+                for user_id, group_id in User.groups.through.objects \
+                        .filter(group_id__in=group_notes.keys()) \
+                        .values_list('user_id', 'group_id'):
+                    visible[user_id] |= group_notes[group_id]
+
+            counts = [cls(uri_type=uri_type, uri=uri, volume_uri=volume_uri,
+                          total=True, count=total)]
+            counts.extend(cls(uri_type=uri_type, uri=uri, volume_uri=volume_uri,
+                              user_id=user_id, count=len(annotation_ids))
+                          for user_id, annotation_ids in visible.iteritems())
+            cls.objects.bulk_create(counts)
+
+    @classmethod
+    def adjust(cls, uri, volume_uri, amount, user_ids=None):
+        '''Add to or subtract from the counts for the page and volume
+        of a single annotation, without recalculating them, when an
+        annotation is added, removed, or becomes visible or no longer
+        visible to some users.  Counts that drop to zero are removed,
+        as they are when counts are recalculated.
+
+        :param uri: annotation uri
+        :param volume_uri: annotation volume uri (may be empty)
+        :param amount: amount to add (negative to subtract)
+        :param user_ids: ids of the users whose counts should be
+            adjusted; if not specified, adjusts the total
+        '''
+        if user_ids is not None:
+            user_ids = set(user_ids)
+            if not user_ids:
+                return
+        uris = [(cls.PAGE, uri, volume_uri)]
+        if volume_uri:
+            uris.append((cls.VOLUME, volume_uri, volume_uri))
+
+        with versions.atomic():
+            for uri_type, count_uri, count_volume_uri in uris:
+                counts = cls.objects.filter(uri_type=uri_type, uri=count_uri,
+                                            volume_uri=count_volume_uri)
+                if user_ids is None:
+                    counts = counts.filter(user__isnull=True)
+                else:
+                    counts = counts.filter(user__in=user_ids)
+
+                if amount < 0:
+                    counts.filter(count__gt=-amount) \
+                          .update(count=models.F('count') + amount)
+                    counts.filter(count__lte=-amount).delete()
+                    continue
+
+                existing = set(counts.values_list('user', flat=True))
+                counts.update(count=models.F('count') + amount)
+                for user_id in (user_ids or set([None])) - existing:
+                    try:
+                        # savepoint, so a count created by a concurrent
+                        # update does not abort the transaction
+                        with transaction.atomic():
+                            cls.objects.create(uri_type=uri_type, uri=count_uri,
+                                               volume_uri=count_volume_uri,
+                                               user_id=user_id,
+                                               total=True if user_id is None else None,
+                                               count=amount)
+                    except IntegrityError:
+                        counts.filter(user=user_id) \
+                              .update(count=models.F('count') + amount)
+            _annotations_changed([volume_uri])
+
+    @classmethod
+    def update_annotations(cls, annotations):
+        '''Recalculate counts for the pages and volumes of all
+        annotations in a queryset.'''
+        cls.update_pages(annotations.values_list('uri', 'volume_uri').distinct())
+
+    @classmethod
+    def update_pages(cls, uris):
+        '''Recalculate counts for a list of pages and their volumes.
+
+        :param uris: list of tuples of page uri and volume uri
+        '''
+        uris = set(uris)
+        with versions.atomic():
+            for uri, volume_uri in uris:
+                cls.update(cls.PAGE, uri, volume_uri)
+            volume_uris = set(volume_uri for uri, volume_uri in uris if volume_uri)
+            for volume_uri in volume_uris:
+                cls.update(cls.VOLUME, volume_uri)
+            _annotations_changed(volume_uris)
+
+
+class AnnotationChangeQuerySet(models.QuerySet):
+    '''Custom :class:`~django.db.models.QuerySet` for
+    :class:`AnnotationChange`.'''
+
+    def latest_token(self):
+        '''Token for the most recent change, to be passed to
+        :meth:`since` to find later changes (0 if there are no
+        changes).'''
+        return self.aggregate(token=models.Max('id'))['token'] or 0
+
+    def since(self, token, until=None):
+        '''Changes after the specified token, and optionally up to and
+        including a later token.
+
+        Ids are assigned when a change is recorded, not when it is
+        committed, so a change with a lower id than the token may be
+        committed after the token was issued.  To include those,
+        changes recorded within **ANNOTATION_SYNC_OVERLAP** seconds
+        (default 60) before the token are also returned, and may be
+        returned more than once; clients should apply changes by
+        annotation id.'''
+        after = models.Q(id__gt=token)
+        # time of the most recent change at or before the token
+        token_time = self.filter(id__lte=token).order_by('-id') \
+                         .values_list('time', flat=True).first()
+        if token_time is not None:
+            overlap = getattr(settings, 'ANNOTATION_SYNC_OVERLAP', 60)
+            after |= models.Q(time__gt=token_time - timedelta(seconds=overlap))
+        changes = self.filter(after)
+        if until is not None:
+            changes = changes.filter(id__lte=until)
+        return changes
+
+
+class AnnotationChange(models.Model):
+    '''Log of changes to annotations on each page and volume, so that
+    clients can request only the annotations that have changed since
+    they last loaded them.  Changes are recorded when an annotation is
+    saved or deleted, and when its visibility changes; since only the
+    most recent change matters, earlier changes for the same annotation
+    and uri are removed when a new change is recorded.  Changes are not
+    linked to the annotation, so that deletions are kept as tombstones.
+    When an annotation is no longer visible to some users, the change
+    records which users, so that only those users are told to remove
+    it; these changes are kept until the annotation is deleted.'''
+    UPDATE = 'update'
+    DELETE = 'delete'
+    REMOVE = 'remove'
+    ACTION_CHOICES = (
+        (UPDATE, 'Created or updated'),
+        (DELETE, 'Deleted'),
+        (REMOVE, 'No longer visible to some users'),
+    )
+
+    #: id of the annotation that changed
+    annotation_id = models.UUIDField(db_index=True)
+    #: annotation uri
+    uri = models.URLField()
+    #: annotation volume uri
+    volume_uri = models.URLField(blank=True)
+    #: type of change
+    action = models.CharField(max_length=6, choices=ACTION_CHOICES)
+    #: ids of the users who can no longer see the annotation, for
+    #: :attr:`REMOVE` changes
+    users = JSONField(null=True, blank=True)
+    #: datetime the change was recorded
+    time = models.DateTimeField(auto_now_add=True)
+
+    objects = AnnotationChangeQuerySet.as_manager()
+
+    class Meta:
+        index_together = [('uri', 'id'), ('volume_uri', 'id')]
+
+    def __repr__(self):
+        return '<AnnotationChange: %s %s %s>' % \
+            (self.action, self.annotation_id, self.uri)
+
+    @classmethod
+    def record(cls, action, annotations, user_ids=None):
+        '''Record a change to one or more annotations.
+
+        :param action: :attr:`UPDATE`, :attr:`DELETE` or :attr:`REMOVE`
+        :param annotations: list of tuples of annotation id, uri,
+            and volume uri
+        :param user_ids: ids of the users who can no longer see the
+            annotations, for :attr:`REMOVE`
+        '''
+        changes = set((uuid.UUID(unicode(annotation_id)), uri, volume_uri)
+                      for annotation_id, uri, volume_uri in annotations)
+        if not changes:
+            return
+        if action == cls.REMOVE:
+            user_ids = sorted(set(user_ids or []))
+            if not user_ids:
+                return
+            # other users still need earlier changes
+            replaced = []
+        elif action == cls.UPDATE:
+            replaced = [cls.UPDATE, cls.DELETE]
+        else:
+            replaced = [cls.UPDATE, cls.DELETE, cls.REMOVE]
+        with transaction.atomic():
+            # remove previous changes for the same annotations and uris
+            previous = [pk for pk, annotation_id, uri, volume_uri in
+                        cls.objects.filter(annotation_id__in=[change[0] for change in changes],
+                                           action__in=replaced)
+                                   .values_list('pk', 'annotation_id', 'uri', 'volume_uri')
+                        if (annotation_id, uri, volume_uri) in changes]
+            if previous:
+                cls.objects.filter(pk__in=previous).delete()
+            cls.objects.bulk_create([
+                cls(annotation_id=annotation_id, uri=uri,
+                    volume_uri=volume_uri, action=action,
+                    users=user_ids if action == cls.REMOVE else None)
+                for annotation_id, uri, volume_uri in changes])
+
+    @classmethod
+    def record_annotations(cls, annotations):
+        '''Record updates for all annotations in a queryset (e.g.,
+        when their visibility changes).'''
+        cls.record(cls.UPDATE, list(annotations.values_list('id', 'uri',
+                                                            'volume_uri')))
+
+
+def _annotations_changed(volume_uris):
+    # update versions for conditional views (see readux.versions)
+    # after annotations change
+    versions.bump(versions.ANNOTATIONS,
+                  *[versions.annotation_scope(uri) for uri in volume_uris if uri])
+
+
+def _view_permission(instance):
+    # check if a guardian per-object permission grants view access
+    # to an annotation
+    return instance.content_type_id == ContentType.objects.get_for_model(Annotation).id \
+        and instance.permission.codename == 'view_annotation'
+
+def _visibility_fields(instance):
+    # annotation visibility fields for a guardian per-object permission
+    if isinstance(instance, UserObjectPermission):
+        principal = (AnnotationVisibility.USER, instance.user_id)
+    else:
+        principal = (AnnotationVisibility.GROUP, instance.group_id)
+    return {'annotation_id': instance.object_pk,
+            'principal_type': principal[0], 'principal_id': principal[1]}
+
+def _principal_users(principal_type, principal_id):
+    # ids of the users that a visibility principal applies to
+    if principal_type == AnnotationVisibility.USER:
+        return set([principal_id])
+    return set(User.groups.through.objects.filter(group_id=principal_id)
+                                          .values_list('user_id', flat=True))
+
+def _visible_users(annotation_id):
+    # ids of the users who can see an annotation, directly or through
+    # a group, as counted by AnnotationCount
+    user_ids = set()
+    group_ids = []
+    for principal_type, principal_id in AnnotationVisibility.objects \
+            .filter(annotation=annotation_id) \
+            .values_list('principal_type', 'principal_id'):
+        if principal_type == AnnotationVisibility.USER:
+            user_ids.add(principal_id)
+        else:
+            group_ids.append(principal_id)
+    if group_ids:
+        user_ids.update(User.groups.through.objects.filter(group_id__in=group_ids)
+                                                   .values_list('user_id', flat=True))
+    return user_ids
+
+@receiver(post_save, sender=UserObjectPermission)
+@receiver(post_save, sender=GroupObjectPermission)
+def add_annotation_visibility(sender, instance, **kwargs):
+    '''Add :class:`AnnotationVisibility` when view permission on an
+    annotation is granted to a user or group, and add to the
+    :class:`AnnotationCount` for users who could not already see it.'''
+    if _view_permission(instance):
+        fields = _visibility_fields(instance)
+        visible = _visible_users(instance.object_pk)
+        visibility, created = AnnotationVisibility.objects.get_or_create(**fields)
+        if created:
+            added = _principal_users(fields['principal_type'],
+                                     fields['principal_id']) - visible
+            _update_counts(instance.object_pk, 1, added)
+
+@receiver(post_delete, sender=UserObjectPermission)
+@receiver(post_delete, sender=GroupObjectPermission)
+def remove_annotation_visibility(sender, instance, **kwargs):
+    '''Remove :class:`AnnotationVisibility` when view permission on an
+    annotation is removed from a user or group, and subtract from the
+    :class:`AnnotationCount` for users who can no longer see it.'''
+    if _view_permission(instance):
+        fields = _visibility_fields(instance)
+        visibility = AnnotationVisibility.objects.filter(**fields)
+        if visibility.exists():
+            visibility.delete()
+            removed = _principal_users(fields['principal_type'],
+                                       fields['principal_id']) \
+                - _visible_users(instance.object_pk)
+            _update_counts(instance.object_pk, -1, removed)
+
+def _update_counts(annotation_id, amount, user_ids):
+    # update annotation counts for the page and volume of an annotation
+    # and record the change after a change in the annotation visibility
+    uris = Annotation.objects.filter(pk=annotation_id) \
+                             .values_list('uri', 'volume_uri').first()
+    if uris is not None:
+        with versions.atomic():
+            AnnotationCount.adjust(uris[0], uris[1], amount, user_ids)
+            if amount > 0:
+                AnnotationChange.record(AnnotationChange.UPDATE,
+                                        [(annotation_id, ) + tuple(uris)])
+            else:
+                AnnotationChange.record(AnnotationChange.REMOVE,
+                                        [(annotation_id, ) + tuple(uris)],
+                                        user_ids)
+
+@receiver(pre_delete, sender=Annotation)
+def find_annotation_users(sender, instance, **kwargs):
+    '''Keep track of the users who can see an annotation before it is
+    deleted, since its :class:`AnnotationVisibility` is deleted with it.'''
+    instance._visible_users = _visible_users(instance.pk)
+
+@receiver(post_delete, sender=Annotation)
+def remove_annotation_count(sender, instance, **kwargs):
+    '''Update :class:`AnnotationCount` and record an
+    :class:`AnnotationChange` when an annotation is deleted.'''
+    with versions.atomic():
+        for user_ids in [None, getattr(instance, '_visible_users', set())]:
+            AnnotationCount.adjust(instance.uri, instance.volume_uri, -1, user_ids)
+        AnnotationChange.record(AnnotationChange.DELETE,
+                                [(instance.pk, instance.uri, instance.volume_uri)])
+
+def _update_member_counts(members, amount):
+    # update annotation counts and record changes for annotations that
+    # become visible or are no longer visible to users when they are
+    # added to or removed from groups; members is a list of tuples of
+    # user id and group id
+    group_ids = defaultdict(set)
+    for user_id, group_id in members:
+        group_ids[user_id].add(group_id)
+    group_notes = defaultdict(set)
+    for annotation_id, group_id in AnnotationVisibility.objects \
+            .filter(principal_type=AnnotationVisibility.GROUP,
+                    principal_id__in=set(group_id for user_id, group_id in members)) \
+            .values_list('annotation', 'principal_id'):
+        group_notes[group_id].add(annotation_id)
+
+    # users for each annotation, if they can see it only through the
+    # groups they were added to or removed from
+    changed = defaultdict(set)
+    for user_id, groups in group_ids.iteritems():
+        notes = set()
+        for group_id in groups:
+            notes |= group_notes[group_id]
+        if not notes:
+            continue
+        other_groups = User.groups.through.objects.filter(user_id=user_id) \
+                           .exclude(group_id__in=groups) \
+                           .values_list('group_id', flat=True)
+        visible = AnnotationVisibility.objects.filter(annotation__in=notes).filter(
+            models.Q(principal_type=AnnotationVisibility.USER, principal_id=user_id) |
+            models.Q(principal_type=AnnotationVisibility.GROUP,
+                     principal_id__in=list(other_groups)))
+        for annotation_id in notes - set(visible.values_list('annotation', flat=True)):
+            changed[annotation_id].add(user_id)
+    if not changed:
+        return
+
+    # number of annotations changed on each page, for each user
+    uris = list(Annotation.objects.filter(pk__in=changed.keys())
+                                  .values_list('id', 'uri', 'volume_uri'))
+    page_counts = defaultdict(lambda: defaultdict(int))
+    for annotation_id, uri, volume_uri in uris:
+        for user_id in changed[annotation_id]:
+            page_counts[(uri, volume_uri)][user_id] += 1
+    with versions.atomic():
+        for (uri, volume_uri), user_counts in page_counts.iteritems():
+            count_users = defaultdict(set)
+            for user_id, count in user_counts.iteritems():
+                count_users[count].add(user_id)
+            for count, user_ids in count_users.iteritems():
+                AnnotationCount.adjust(uri, volume_uri, amount * count, user_ids)
+        if amount > 0:
+            AnnotationChange.record(AnnotationChange.UPDATE, uris)
+        else:
+            # record which users can no longer see each annotation
+            removed = defaultdict(list)
+            for annotation_id, uri, volume_uri in uris:
+                removed[frozenset(changed[annotation_id])] \
+                    .append((annotation_id, uri, volume_uri))
+            for user_ids, annotations in removed.iteritems():
+                AnnotationChange.record(AnnotationChange.REMOVE,
+                                        annotations, user_ids)
+
+@receiver(m2m_changed, sender=User.groups.through)
+def update_group_annotation_counts(sender, instance, action, reverse,
+                                   pk_set, **kwargs):
+    '''Update :class:`AnnotationCount` and record an
+    :class:`AnnotationChange` for annotations that become visible or are
+    no longer visible to users when they are added to or removed from
+    a group.'''
+    if action in ['pre_remove', 'post_add']:
+        if reverse:
+            members = [(user_id, instance.pk) for user_id in pk_set]
+        else:
+            members = [(instance.pk, group_id) for group_id in pk_set]
+
+    if action == 'pre_remove':
+        # keep track of current members, since removing users who
+        # are not members of a group has no effect
+        current = set(User.groups.through.objects
+            .filter(user_id__in=[user_id for user_id, group_id in members],
+                    group_id__in=[group_id for user_id, group_id in members])
+            .values_list('user_id', 'group_id'))
+        instance._removed_members = [member for member in members
+                                     if member in current]
+    elif action == 'pre_clear':
+        # keep track of members before they are removed
+        if reverse:
+            instance._removed_members = [(user_id, instance.pk) for user_id in
+                instance.user_set.values_list('pk', flat=True)]
+        else:
+            instance._removed_members = [(instance.pk, group_id) for group_id in
+                instance.groups.values_list('pk', flat=True)]
+    elif action == 'post_add':
+        # only new members are included when members are added
+        _update_member_counts(members, 1)
+    elif action in ['post_remove', 'post_clear']:
+        _update_member_counts(getattr(instance, '_removed_members', []), -1)
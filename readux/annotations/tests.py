@@ -1,13 +1,30 @@
+from cStringIO import StringIO
+from datetime import timedelta
 import json
 from mock import Mock, patch
+import os
+import tempfile
+import time
+from unittest import skipUnless
 import uuid
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.urlresolvers import reverse, resolve
+from django.db import transaction, IntegrityError
+from django.db.models import Q
 from django.test import TestCase
 from django.test.utils import override_settings
-from guardian.shortcuts import remove_perm
+from guardian.models import UserObjectPermission, GroupObjectPermission
+from guardian.shortcuts import remove_perm, get_objects_for_user, \
+    get_objects_for_group
 
-from readux.annotations.models import Annotation, AnnotationGroup
+from readux import versions
+from readux.annotations.models import Annotation, AnnotationGroup, \
+    AnnotationVisibility, AnnotationTerm, AnnotationTag, AnnotationCount, \
+    AnnotationChange
 
 
 class AnnotationTestCase(TestCase):
@@ -136,6 +153,436 @@ class AnnotationTestCase(TestCase):
 
         self.assertEqual(3, Annotation.objects.visible_to(testuser).count())
         self.assertEqual(4, Annotation.objects.visible_to(testadmin).count())
+        # chains with other filters
+        self.assertEqual(1, Annotation.objects.filter(text='foo') \
+                                              .visible_to(testuser).count())
+        self.assertEqual(0, Annotation.objects.visible_to(AnonymousUser()).count())
+
+    def test_visibility_sync(self):
+        Annotation.objects.all().delete()
+        testuser = get_user_model().objects.get(username='testuser')
+        otheruser = get_user_model().objects.create(username='other')
+        group = AnnotationGroup.objects.create(name='annotation group')
+
+        note = Annotation.objects.create(user=testuser, text='foo')
+        # owner is granted view permission on save
+        self.assertEqual(1, note.visibility.count())
+        self.assertEqual(0, Annotation.objects.visible_to(otheruser).count())
+        self.assertEqual(0, Annotation.objects.visible_to_group(group).count())
+
+        # grant view access to a group
+        note.db_permissions({'read': [group.annotation_id]})
+        self.assertEqual(1, Annotation.objects.visible_to_group(group).count())
+        # db_permissions replaces all permissions, including owner
+        self.assertEqual(0, Annotation.objects.visible_to(testuser).count())
+        # group members can view
+        group.user_set.add(otheruser)
+        self.assertEqual(1, Annotation.objects.visible_to(otheruser).count())
+
+        note.grant_user_access()
+        self.assertEqual(1, Annotation.objects.visible_to(testuser).count())
+        # visible both directly and through a group: listed once, and
+        # relevance is not inflated by the visibility join
+        group.user_set.add(testuser)
+        self.assertEqual([note], list(Annotation.objects.visible_to(testuser)))
+        results = list(Annotation.objects.visible_to(testuser).search('foo') \
+                                 .by_relevance([('foo', None)]))
+        self.assertEqual([note], results)
+        self.assertEqual(1, results[0].relevance)
+        group.user_set.remove(testuser)
+        remove_perm('view_annotation', testuser, note)
+        self.assertEqual(0, Annotation.objects.visible_to(testuser).count())
+
+        # non-view permissions are not included
+        note.assign_permission('change_annotation', otheruser)
+        self.assertEqual(1, note.visibility.count())
+
+        note.delete()
+        self.assertEqual(0, AnnotationVisibility.objects.count())
+
+    def test_annotation_counts(self):
+        Annotation.objects.all().delete()
+        testuser = get_user_model().objects.get(username='testuser')
+        testadmin = get_user_model().objects.get(username='testsuper')
+        otheruser = get_user_model().objects.create(username='other')
+        group = AnnotationGroup.objects.create(name='annotation group')
+        vol_uri = 'http://example.com/books/vol:1/'
+        page_uri = 'http://example.com/books/vol:1/pages/p:1/'
+
+        note = Annotation.objects.create(user=testuser, text='foo',
+                                         uri=page_uri, volume_uri=vol_uri)
+        Annotation.objects.create(user=testadmin, text='bar',
+                                  uri=page_uri, volume_uri=vol_uri)
+        counts = AnnotationCount.objects
+        self.assertEqual({vol_uri: 2}, counts.for_user().volumes())
+        self.assertEqual({page_uri: 2}, counts.for_user().pages(vol_uri))
+        self.assertEqual({vol_uri: 1}, counts.for_user(testuser).volumes())
+        self.assertEqual({page_uri: 1}, counts.for_user(testuser).pages(vol_uri))
+        # superuser sees all annotations
+        self.assertEqual({vol_uri: 2}, counts.for_user(testadmin).volumes())
+        self.assertEqual({}, counts.for_user(otheruser).volumes())
+        self.assertEqual({}, counts.for_user(AnonymousUser()).volumes())
+
+        # updated for permission and group membership changes
+        note.db_permissions({'read': [testuser.username, group.annotation_id]})
+        self.assertEqual({}, counts.for_user(otheruser).volumes())
+        group.user_set.add(otheruser)
+        self.assertEqual({vol_uri: 1}, counts.for_user(otheruser).volumes())
+        # visible through user and group permissions, but only counted once
+        group.user_set.add(testuser)
+        self.assertEqual({vol_uri: 1}, counts.for_user(testuser).volumes())
+        otheruser.groups.clear()
+        self.assertEqual({}, counts.for_user(otheruser).volumes())
+
+        # updated when an annotation is moved to another page
+        note = Annotation.objects.get(pk=note.pk)
+        other_page = 'http://example.com/books/vol:1/pages/p:2/'
+        note.uri = other_page
+        note.save()
+        self.assertEqual({page_uri: 1, other_page: 1},
+                         counts.for_user().pages(vol_uri))
+
+        # updated on delete
+        note.delete()
+        self.assertEqual({vol_uri: 1}, counts.for_user().volumes())
+        self.assertEqual({page_uri: 1}, counts.for_user().pages(vol_uri))
+        self.assertEqual({}, counts.for_user(testuser).volumes())
+
+        # rebuild matches incrementally updated counts
+        expected = sorted(counts.values_list('uri_type', 'uri', 'user', 'count'))
+        counts.all().delete()
+        call_command('rebuild_annotation_counts', stdout=StringIO())
+        self.assertEqual(expected,
+                         sorted(counts.values_list('uri_type', 'uri', 'user', 'count')))
+
+    def test_annotation_counts_incremental(self):
+        Annotation.objects.all().delete()
+        testuser = get_user_model().objects.get(username='testuser')
+        otheruser = get_user_model().objects.create(username='other')
+        group = AnnotationGroup.objects.create(name='annotation group')
+        group.user_set.add(testuser, otheruser)
+        vol_uri = 'http://example.com/books/vol:1/'
+        page_uri = 'http://example.com/books/vol:1/pages/p:1/'
+        counts = AnnotationCount.objects
+
+        # saves, deletes and permission changes adjust existing counts
+        # instead of recalculating them
+        with patch.object(AnnotationCount, 'update') as mockupdate:
+            note = Annotation.objects.create(user=testuser, text='foo',
+                                             uri=page_uri, volume_uri=vol_uri)
+            Annotation.objects.create(user=testuser, text='bar',
+                                      uri=page_uri, volume_uri=vol_uri)
+            self.assertEqual({vol_uri: 2}, counts.for_user().volumes())
+            self.assertEqual({page_uri: 2}, counts.for_user(testuser).pages(vol_uri))
+
+            # visible to the owner directly and through a group;
+            # removing one still leaves it visible
+            note.assign_permission('view_annotation', group)
+            self.assertEqual({vol_uri: 1}, counts.for_user(otheruser).volumes())
+            self.assertEqual({vol_uri: 2}, counts.for_user(testuser).volumes())
+            remove_perm('view_annotation', testuser, note)
+            self.assertEqual({vol_uri: 2}, counts.for_user(testuser).volumes())
+            remove_perm('view_annotation', group, note)
+            self.assertEqual({vol_uri: 1}, counts.for_user(testuser).volumes())
+            self.assertEqual({}, counts.for_user(otheruser).volumes())
+
+            # group membership changes adjust counts for users who
+            # gain or lose access, in either direction
+            note.assign_permission('view_annotation', group)
+            self.assertEqual({vol_uri: 2}, counts.for_user(testuser).volumes())
+            group.user_set.remove(otheruser)
+            self.assertEqual({}, counts.for_user(otheruser).volumes())
+            # removing a user who is not a member has no effect
+            group.user_set.remove(otheruser)
+            self.assertEqual({}, counts.for_user(otheruser).volumes())
+            otheruser.groups.add(group)
+            self.assertEqual({vol_uri: 1}, counts.for_user(otheruser).volumes())
+            # only changes for annotations visible to the group are recorded
+            changes = AnnotationChange.objects.latest_token()
+            group.user_set.clear()
+            self.assertEqual({vol_uri: 1}, counts.for_user(testuser).volumes())
+            self.assertEqual({}, counts.for_user(otheruser).volumes())
+            self.assertEqual([note.pk], list(AnnotationChange.objects.filter(id__gt=changes)
+                                             .values_list('annotation_id', flat=True)))
+
+            note.delete()
+            self.assertEqual({vol_uri: 1}, counts.for_user().volumes())
+            self.assertEqual({vol_uri: 1}, counts.for_user(testuser).volumes())
+            mockupdate.assert_not_called()
+
+        # one count per page, volume and user
+        self.assertEqual(4, counts.count())
+        # totals are unique, even though they have no user
+        with transaction.atomic():
+            self.assertRaises(IntegrityError, counts.create, uri_type=AnnotationCount.PAGE,
+                              uri=page_uri, volume_uri=vol_uri, total=True, count=1)
+
+    def test_annotation_versions(self):
+        testuser = get_user_model().objects.get(username='testuser')
+        vol_uri = 'http://example.com/books/vol:1/'
+        scopes = [(versions.annotation_scope(vol_uri), None)]
+        version, = versions.get_versions(scopes)
+
+        # versions are updated after changes are committed
+        with versions.atomic():
+            note = Annotation.objects.create(user=testuser, text='foo',
+                uri='http://example.com/books/vol:1/pages/p:1/',
+                volume_uri=vol_uri)
+            self.assertEqual([version], versions.get_versions(scopes))
+        updated, = versions.get_versions(scopes)
+        self.assert_(updated > version)
+
+        # and not if the changes are rolled back
+        with self.assertRaises(ValueError):
+            with versions.atomic():
+                note.delete()
+                raise ValueError
+        self.assertEqual([updated], versions.get_versions(scopes))
+        self.assertEqual(1, Annotation.objects.filter(pk=note.pk).count())
+
+    # without overlap, only changes after a token are returned
+    @override_settings(ANNOTATION_SYNC_OVERLAP=0)
+    def test_annotation_changes(self):
+        Annotation.objects.all().delete()
+        AnnotationChange.objects.all().delete()
+        testuser = get_user_model().objects.get(username='testuser')
+        vol_uri = 'http://example.com/books/vol:1/'
+        page_uri = 'http://example.com/books/vol:1/pages/p:1/'
+        changes = AnnotationChange.objects
+        self.assertEqual(0, changes.latest_token())
+
+        note = Annotation.objects.create(user=testuser, text='foo',
+                                         uri=page_uri, volume_uri=vol_uri)
+        # only the most recent change for each annotation and uri is kept
+        self.assertEqual(1, changes.count())
+        change = changes.get()
+        self.assertEqual((note.pk, page_uri, vol_uri, AnnotationChange.UPDATE),
+                         (change.annotation_id, change.uri, change.volume_uri,
+                          change.action))
+        token = changes.latest_token()
+        self.assertEqual(change.pk, token)
+        self.assertEqual(0, changes.since(token).count())
+
+        # moving an annotation records removal from the previous page
+        note = Annotation.objects.get(pk=note.pk)
+        other_page = 'http://example.com/books/vol:1/pages/p:2/'
+        note.uri = other_page
+        note.save()
+        self.assertEqual(set([(page_uri, AnnotationChange.DELETE),
+                              (other_page, AnnotationChange.UPDATE)]),
+                         set(changes.since(token).values_list('uri', 'action')))
+        self.assertEqual(2, changes.count())
+
+        # visibility changes are recorded, with the users who can no
+        # longer see the annotation; earlier updates are kept for others
+        token = changes.latest_token()
+        remove_perm('view_annotation', testuser, note)
+        self.assertEqual([(note.pk, AnnotationChange.REMOVE, [testuser.pk])],
+                         list(changes.since(token).values_list('annotation_id',
+                                                               'action', 'users')))
+        self.assertEqual(3, changes.count())
+
+        # deletions are kept as tombstones
+        token = changes.latest_token()
+        note.delete()
+        self.assertEqual([(note.pk, other_page, AnnotationChange.DELETE)],
+                         list(changes.since(token).values_list('annotation_id',
+                                                               'uri', 'action')))
+
+    def test_annotation_changes_interleaved(self):
+        Annotation.objects.all().delete()
+        AnnotationChange.objects.all().delete()
+        testuser = get_user_model().objects.get(username='testuser')
+        page_uri = 'http://example.com/books/vol:1/pages/p:1/'
+        changes = AnnotationChange.objects
+        Annotation.objects.create(user=testuser, text='foo', uri=page_uri)
+        token = changes.latest_token()
+
+        # one transaction is assigned the next id for its change, but
+        # has not committed when a later change is committed and a
+        # client requests changes
+        uncommitted_id = token + 1
+        second = Annotation.objects.create(user=testuser, text='bar', uri=page_uri)
+        changes.filter(annotation_id=second.pk).update(id=uncommitted_id + 1)
+        later_token = changes.latest_token()
+        with override_settings(ANNOTATION_SYNC_OVERLAP=0):
+            self.assertEqual([second.pk], list(changes.since(token, later_token)
+                                               .values_list('annotation_id', flat=True)))
+
+        # the first transaction then commits, with a lower id and an
+        # earlier time than the change the client's token refers to
+        late = Annotation.objects.create(user=testuser, text='baz', uri=page_uri)
+        committed = changes.get(pk=later_token).time
+        changes.filter(annotation_id=late.pk) \
+               .update(id=uncommitted_id, time=committed - timedelta(seconds=1))
+        self.assertEqual(later_token, changes.latest_token())
+        # change is included on the client's next request
+        self.assert_(late.pk in changes.since(later_token)
+                                       .values_list('annotation_id', flat=True))
+        # which is only possible with an overlap
+        with override_settings(ANNOTATION_SYNC_OVERLAP=0):
+            self.assertEqual(0, changes.since(later_token).count())
+
+    def test_import_annotations(self):
+        testuser = get_user_model().objects.get(username='testuser')
+        notes = Annotation.objects.all()
+        for note in notes:
+            note.extra_data['tags'] = ['imported']
+            note.save()
+        data = {'rows': Annotation.bulk_info(notes)}
+        expected = sorted((note.id, note.created, note.text, note.user_id)
+                          for note in notes)
+        Annotation.objects.all().delete()
+
+        with tempfile.NamedTemporaryFile(suffix='.json') as datafile:
+            datafile.write(json.dumps(data))
+            datafile.flush()
+            output = StringIO()
+            call_command('import_annotations', datafile.name, batch_size=1,
+                         stdout=output)
+            self.assert_('Imported 2 annotations' in output.getvalue())
+            # original dates are preserved
+            self.assertEqual(expected, sorted(Annotation.objects.values_list(
+                'id', 'created', 'text', 'user')))
+            # owner permissions, visibility, index, tags, counts and
+            # change log are created without saving each annotation
+            note = Annotation.objects.get(user=testuser)
+            self.assert_(note.user_can_view(testuser))
+            self.assert_(note.user_can_update(testuser))
+            self.assertEqual([note], list(Annotation.objects.visible_to(testuser)))
+            self.assertEqual([note], list(Annotation.objects.search('strange')))
+            self.assertEqual(2, Annotation.objects.tagged(['imported']).count())
+            self.assertEqual({note.uri: 1}, AnnotationCount.objects
+                             .for_user(testuser).pages(note.volume_uri))
+            self.assertEqual(set(Annotation.objects.values_list('id', flat=True)),
+                             set(AnnotationChange.objects.values_list('annotation_id', flat=True)))
+
+            # importing again replaces existing annotations
+            call_command('import_annotations', datafile.name, stdout=StringIO())
+            self.assertEqual(2, Annotation.objects.count())
+            self.assert_(Annotation.objects.get(pk=note.pk).user_can_view(testuser))
+
+        # replaced annotations are deleted without per-annotation
+        # count updates; moved annotations are removed from their
+        # previous uri
+        old_uri = note.uri
+        for row in data['rows']:
+            if row['id'] == str(note.pk):
+                row['uri'] = 'http://example.com/books/vol:1/pages/p:9/'
+        with tempfile.NamedTemporaryFile(suffix='.json') as datafile:
+            datafile.write(json.dumps(data))
+            datafile.flush()
+            with patch.object(AnnotationCount, 'adjust') as mockadjust:
+                call_command('import_annotations', datafile.name, stdout=StringIO())
+                mockadjust.assert_not_called()
+        self.assertEqual(AnnotationChange.DELETE,
+                         AnnotationChange.objects.get(annotation_id=note.pk,
+                                                      uri=old_uri).action)
+        self.assertFalse(old_uri in AnnotationCount.objects.for_user(testuser)
+                                                   .pages(note.volume_uri))
+
+        # permissions for unknown users are skipped and reported
+        Annotation.objects.all().delete()
+        for row in data['rows']:
+            row['permissions']['read'].append('nobody')
+        with tempfile.NamedTemporaryFile(suffix='.json') as datafile:
+            datafile.write(json.dumps(data))
+            datafile.flush()
+            output = StringIO()
+            call_command('import_annotations', datafile.name, batch_size=1,
+                         stdout=output)
+        self.assertEqual(2, Annotation.objects.count())
+        self.assert_('Skipped permissions for unknown users: nobody'
+                     in output.getvalue())
+
+        # import is transactional; nothing is imported if an author is missing
+        Annotation.objects.all().delete()
+        data['rows'][1]['user'] = 'nobody'
+        with tempfile.NamedTemporaryFile(suffix='.json') as datafile:
+            datafile.write(json.dumps(data))
+            datafile.flush()
+            with self.assertRaises(CommandError):
+                call_command('import_annotations', datafile.name, batch_size=1,
+                             stdout=StringIO())
+        self.assertEqual(0, Annotation.objects.count())
+
+    def test_export_annotations(self):
+        testuser = get_user_model().objects.get(username='testuser')
+        group = AnnotationGroup.objects.create(name='annotation group')
+        group.user_set.add(testuser)
+        for note in Annotation.objects.all():
+            note.save()
+        note = Annotation.objects.get(user=testuser)
+        note.db_permissions({'read': [testuser.username, group.annotation_id]})
+        # restore owner permissions, as when an annotation is saved
+        note.save()
+        expected = Annotation.bulk_info(Annotation.objects.order_by('created', 'id'))
+
+        # export all annotations; groups are identified by name
+        output = StringIO()
+        call_command('export_annotations', batch_size=1, stdout=output,
+                     stderr=StringIO())
+        exported = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(json.loads(json.dumps(Annotation.bulk_info(
+            Annotation.objects.order_by('created', 'id'), export=True))), exported)
+        self.assert_('group-name:annotation group' in
+                     [row for row in exported if row['id'] == str(note.id)][0]['permissions']['read'])
+
+        # filter by user or group
+        output = StringIO()
+        call_command('export_annotations', user=['testuser'], stdout=output,
+                     stderr=StringIO())
+        self.assertEqual([str(note.id)],
+                         [json.loads(line)['id'] for line in output.getvalue().splitlines()])
+        output = StringIO()
+        call_command('export_annotations', group=['annotation group'],
+                     stdout=output, stderr=StringIO())
+        self.assertEqual([str(note.id)],
+                         [json.loads(line)['id'] for line in output.getvalue().splitlines()])
+        output = StringIO()
+        call_command('export_annotations', group=['other group'], stdout=output,
+                     stderr=StringIO())
+        self.assertEqual('', output.getvalue())
+
+        # exported annotations can be imported again, with permissions
+        with tempfile.NamedTemporaryFile(suffix='.ndjson') as datafile:
+            call_command('export_annotations', output=datafile.name,
+                         stderr=StringIO())
+            Annotation.objects.all().delete()
+            call_command('import_annotations', datafile.name, batch_size=1,
+                         stdout=StringIO())
+        self.assertEqual(json.loads(json.dumps(expected)),
+                         json.loads(json.dumps(Annotation.bulk_info(
+                             Annotation.objects.order_by('created', 'id')))))
+        self.assertEqual([note], list(Annotation.objects.visible_to_group(group)))
+
+        # groups are matched by name in another instance, where group ids
+        # differ; permissions for unknown groups are skipped
+        with tempfile.NamedTemporaryFile(suffix='.ndjson') as datafile:
+            call_command('export_annotations', output=datafile.name,
+                         stderr=StringIO())
+            Annotation.objects.all().delete()
+            group.delete()
+            other_group = AnnotationGroup.objects.create(name='other group')
+            output = StringIO()
+            call_command('import_annotations', datafile.name, stdout=output)
+            self.assertEqual([], list(Annotation.objects.visible_to_group(other_group)))
+            self.assert_('Skipped permissions for unknown groups: group-name:annotation group'
+                         in output.getvalue())
+
+            Annotation.objects.all().delete()
+            new_group = AnnotationGroup.objects.create(name='annotation group')
+            call_command('import_annotations', datafile.name, stdout=StringIO())
+            self.assertEqual([note], list(Annotation.objects.visible_to_group(new_group)))
+
+        # group ids from the annotator store api are not imported
+        with tempfile.NamedTemporaryFile(suffix='.json') as datafile:
+            datafile.write(json.dumps({'rows': expected}))
+            datafile.flush()
+            Annotation.objects.all().delete()
+            call_command('import_annotations', datafile.name, stdout=StringIO())
+            self.assertEqual([], list(Annotation.objects.visible_to_group(new_group)))
+            self.assert_(Annotation.objects.get(pk=note.pk).user_can_view(testuser))
 
     def test_last_created_time(self):
         # test custom queryset methods
@@ -275,6 +722,106 @@ class AnnotationTestCase(TestCase):
         self.assertEqual(0, note.group_permissions().count())
 
 
+    def test_info_list(self):
+        Annotation.objects.all().delete()  # delete fixture annotations
+        user = get_user_model().objects.get(username='testuser')
+        group = AnnotationGroup.objects.create(name='foo')
+        for i in range(5):
+            note = Annotation.create_from_request(self.mockrequest)
+            note.user = user
+            note.save()
+        note.db_permissions({'read': [user.username, group.annotation_id],
+                             'update': [user.username]})
+
+        notes = Annotation.objects.all().select_related('user')
+        expected = [n.info() for n in notes]
+        # constant number of queries: annotations, user permissions,
+        # group permissions
+        with self.assertNumQueries(3):
+            info = notes.all().info_list()
+        self.assertEqual(expected, info)
+
+        self.assertEqual([], Annotation.objects.none().info_list())
+
+    def test_search(self):
+        Annotation.objects.all().delete()  # delete fixture annotations
+        note = Annotation(text='A strange, strange idea', quote='Strangers',
+                          uri='http://example.com/',
+                          extra_data={'tags': ['odd ideas', 'review']})
+        note.save()
+        other = Annotation(text='A sensible idea', quote='something else',
+                           uri='http://example.com/')
+        other.save()
+
+        # index is updated on save
+        terms = dict(((t.field, t.term), t.count) for t in note.terms.all())
+        self.assertEqual(2, terms[(AnnotationTerm.TEXT, 'strange')])
+        self.assertEqual(1, terms[(AnnotationTerm.QUOTE, 'strangers')])
+        self.assertEqual(1, terms[(AnnotationTerm.TAGS, 'odd')])
+        self.assertEqual(1, terms[(AnnotationTerm.TAGS, 'review')])
+
+        notes = Annotation.objects.all()
+        # all terms must match, case-insensitive; prefix matches
+        self.assertEqual(2, notes.search('idea').count())
+        self.assertEqual([note], list(notes.search('STRANGE idea')))
+        self.assertEqual([other], list(notes.search('sens', [AnnotationTerm.TEXT])))
+        self.assertEqual([other], list(notes.search('sensible idea')))
+        self.assertEqual(0, notes.search('strange sensible').count())
+        # restricted to fields
+        self.assertEqual(0, notes.search('strangers', [AnnotationTerm.TEXT]).count())
+        self.assertEqual([note], list(notes.search('strangers', [AnnotationTerm.QUOTE])))
+        self.assertEqual([note], list(notes.search('review', [AnnotationTerm.TAGS])))
+
+        # relevance: number of times search terms occur
+        results = list(notes.search('strange').by_relevance([('strange', None)]))
+        self.assertEqual([note], results)
+        # strange (text, twice) + strangers (quote)
+        self.assertEqual(3, results[0].relevance)
+        # idea (text) + ideas (tags) ranks above idea (text)
+        results = list(notes.search('idea').by_relevance([('idea', None)]))
+        self.assertEqual([note, other], results)
+
+        # updated on save, removed on delete
+        note.text = 'changed'
+        note.save()
+        self.assertEqual(0, notes.search('strange', [AnnotationTerm.TEXT]).count())
+        note.delete()
+        self.assertEqual(0, AnnotationTerm.objects.filter(annotation=note.pk).count())
+
+    def test_tags(self):
+        Annotation.objects.all().delete()  # delete fixture annotations
+        note = Annotation(text='note', uri='http://example.com/',
+                          extra_data={'tags': ['Review', ' review', 'to-do']})
+        note.save()
+        other = Annotation(text='other', uri='http://example.com/',
+                           extra_data={'tags': 'review'})
+        other.save()
+        untagged = Annotation(text='untagged', uri='http://example.com/')
+        untagged.save()
+
+        # tag records updated on save; duplicate slugs only stored once
+        self.assertEqual(['Review', 'to-do'],
+                         [t.tag for t in note.tag_set.order_by('slug')])
+        self.assertEqual(['review'], [t.slug for t in other.tag_set.all()])
+        self.assertEqual(0, untagged.tag_set.count())
+
+        notes = Annotation.objects.all()
+        self.assertEqual(set([note, other]), set(notes.tagged(['REVIEW'])))
+        self.assertEqual([note], list(notes.tagged(['review', 'to-do'])))
+        self.assertEqual(0, notes.tagged(['bogus']).count())
+
+        self.assertEqual([{'slug': 'review', 'tag': 'Review', 'count': 2},
+                          {'slug': 'to-do', 'tag': 'to-do', 'count': 1}],
+                         AnnotationTag.objects.all().counts())
+        self.assertEqual([{'slug': 'review', 'tag': 'review', 'count': 1}],
+                         AnnotationTag.objects.filter(annotation=other).counts())
+
+        note.extra_data['tags'] = ['done']
+        note.save()
+        self.assertEqual(['done'], [t.slug for t in note.tag_set.all()])
+        note.delete()
+        self.assertEqual(0, AnnotationTag.objects.filter(annotation=note.pk).count())
+
     def test_permissions_dict(self):
         note = Annotation.create_from_request(self.mockrequest)
         note.save()
@@ -366,10 +913,47 @@ class AnnotationViewsTest(TestCase):
         self.client.login(**self.user_credentials['superuser'])
         resp = self.client.get(reverse('annotation-api:annotations'))
         data = json.loads(resp.content)
-        # all notes user should be listed
+        # all notes user should be listed, sorted by creation date
+        sorted_notes = notes.order_by('created', 'id')
         self.assertEqual(notes.count(), len(data))
-        self.assertEqual(data[0]['id'], unicode(notes[0].id))
-        self.assertEqual(data[1]['id'], unicode(notes[1].id))
+        self.assertEqual(data[0]['id'], unicode(sorted_notes[0].id))
+        self.assertEqual(data[1]['id'], unicode(sorted_notes[1].id))
+        self.assertFalse(resp.has_header('Link'))
+
+        # paginated by cursor
+        resp = self.client.get(reverse('annotation-api:annotations'), {'limit': 1})
+        data = json.loads(resp.content)
+        self.assertEqual(1, len(data))
+        self.assertEqual(data[0]['id'], unicode(sorted_notes[0].id))
+        self.assert_('cursor=%s' % sorted_notes[0].cursor in resp['Link'])
+        self.assert_('rel="next"' in resp['Link'])
+        resp = self.client.get(reverse('annotation-api:annotations'),
+                               {'limit': 1, 'cursor': sorted_notes[0].cursor})
+        data = json.loads(resp.content)
+        self.assertEqual(data[0]['id'], unicode(sorted_notes[1].id))
+        self.assertFalse(resp.has_header('Link'))
+
+        # streaming newline-delimited json
+        resp = self.client.get(reverse('annotation-api:annotations'),
+                               {'format': 'ndjson'})
+        self.assertEqual('application/x-ndjson', resp['Content-Type'])
+        lines = ''.join(resp.streaming_content).splitlines()
+        self.assertEqual(notes.count(), len(lines))
+        self.assertEqual(unicode(sorted_notes[1].id), json.loads(lines[1])['id'])
+        with patch('readux.annotations.views.Annotation.bulk_info',
+                   side_effect=Annotation.bulk_info) as mockbulk_info:
+            resp = self.client.get(reverse('annotation-api:annotations'),
+                                   {'format': 'ndjson', 'limit': 1})
+            lines = ''.join(resp.streaming_content).splitlines()
+        self.assertEqual(1, len(lines))
+        self.assertEqual(1, mockbulk_info.call_count)
+
+        resp = self.client.get(reverse('annotation-api:annotations'),
+                               {'format': 'ndjson', 'cursor': 'bogus'})
+        self.assertEqual(400, resp.status_code)
+        resp = self.client.get(reverse('annotation-api:annotations'),
+                               {'limit': 'all'})
+        self.assertEqual(400, resp.status_code)
 
         # test group permissions
         self.client.login(**self.user_credentials['user'])
@@ -590,8 +1174,49 @@ class AnnotationViewsTest(TestCase):
         resp = self.client.get(search_url, {'text': 'what a'})
         data = json.loads(resp.content)
         self.assertEqual(notes.count(), data['total'])
-        self.assertEqual(str(notes[0].id), data['rows'][0]['id'])
-        self.assertEqual(str(notes[1].id), data['rows'][1]['id'])
+        # results are equally relevant, so sorted by creation date
+        sorted_notes = notes.order_by('created', 'id')
+        self.assertEqual(str(sorted_notes[0].id), data['rows'][0]['id'])
+        self.assertEqual(str(sorted_notes[1].id), data['rows'][1]['id'])
+
+        # full-text search on words within text, quote, and tags
+        resp = self.client.get(search_url, {'text': 'sensation'})
+        data = json.loads(resp.content)
+        self.assertEqual(1, data['total'])
+        self.assertEqual(str(self.superuser_note.id), data['rows'][0]['id'])
+        resp = self.client.get(search_url, {'quote': self.user_note.quote})
+        data = json.loads(resp.content)
+        self.assertEqual(str(self.user_note.id), data['rows'][0]['id'])
+        resp = self.client.get(search_url, {'keyword': 'strange what'})
+        data = json.loads(resp.content)
+        self.assertEqual(1, data['total'])
+        self.assertEqual(str(self.user_note.id), data['rows'][0]['id'])
+        resp = self.client.get(search_url, {'keyword': 'bogus'})
+        data = json.loads(resp.content)
+        self.assertEqual(0, data['total'])
+        # search by tags
+        self.user_note.extra_data['tags'] = ['odd', 'marriage']
+        self.user_note.save()
+        resp = self.client.get(search_url, {'tags': 'Odd, marriage'})
+        data = json.loads(resp.content)
+        self.assertEqual(1, data['total'])
+        self.assertEqual(str(self.user_note.id), data['rows'][0]['id'])
+        resp = self.client.get(search_url, {'tags': 'odd sensational'})
+        data = json.loads(resp.content)
+        self.assertEqual(0, data['total'])
+        # relevance-sorted results are paginated by offset
+        resp = self.client.get(search_url, {'text': 'what', 'limit': 1,
+                                            'offset': 1})
+        data = json.loads(resp.content)
+        self.assertEqual(notes.count(), data['total'])
+        self.assertEqual(str(sorted_notes[1].id), data['rows'][0]['id'])
+        self.assert_('next' not in data)
+        # or by cursor, sorted by creation date
+        resp = self.client.get(search_url, {'text': 'what', 'limit': 1,
+                                            'sort': 'created'})
+        data = json.loads(resp.content)
+        self.assertEqual(str(sorted_notes[0].id), data['rows'][0]['id'])
+        self.assertEqual(sorted_notes[0].cursor, data['next'])
 
         # search on uri
         resp = self.client.get(search_url, {'uri': notes[0].uri})
@@ -605,18 +1230,266 @@ class AnnotationViewsTest(TestCase):
         self.assertEqual(1, data['total'])
         self.assertEqual(unicode(user_notes[0].id), data['rows'][0]['id'])
 
-        # limit/offset
+        # limit/offset; total is the number of matches before pagination
+        sorted_notes = notes.order_by('created', 'id')
         resp = self.client.get(search_url, {'limit': '1'})
         data = json.loads(resp.content)
-        self.assertEqual(1, data['total'])
+        self.assertEqual(notes.count(), data['total'])
+        self.assertEqual(1, len(data['rows']))
+        self.assertEqual(str(sorted_notes[0].id), data['rows'][0]['id'])
+        self.assertEqual(sorted_notes[0].cursor, data['next'])
+
+        # next page by cursor
+        resp = self.client.get(search_url, {'limit': '1', 'cursor': data['next']})
+        data = json.loads(resp.content)
+        self.assertEqual(notes.count(), data['total'])
+        self.assertEqual(str(sorted_notes[1].id), data['rows'][0]['id'])
+        self.assert_('next' not in data)
 
         resp = self.client.get(search_url, {'offset': '1'})
         data = json.loads(resp.content)
-        self.assertEqual(notes.count() - 1, data['total'])
+        self.assertEqual(notes.count(), data['total'])
+        self.assertEqual(notes.count() - 1, len(data['rows']))
         # should return the *second* note first
-        self.assertEqual(str(notes[1].id), data['rows'][0]['id'])
+        self.assertEqual(str(sorted_notes[1].id), data['rows'][0]['id'])
 
         # non-numeric pagination should be ignored
         resp = self.client.get(search_url, {'limit': 'three'})
         data = json.loads(resp.content)
         self.assertEqual(notes.count(), data['total'])
+        self.assertEqual(notes.count(), len(data['rows']))
+
+        # invalid cursor
+        resp = self.client.get(search_url, {'cursor': 'foo'})
+        self.assertEqual(400, resp.status_code)
+
+    def test_annotation_changes(self):
+        changes_url = reverse('annotation-api:changes')
+        uri = self.user_note.uri
+        # login required
+        resp = self.client.get(changes_url, {'uri': uri})
+        self.assertEqual(401, resp.status_code)
+
+        self.client.login(**self.user_credentials['user'])
+        resp = self.client.get(changes_url)
+        self.assertEqual(400, resp.status_code,
+            'uri or volume_uri should be required')
+        resp = self.client.get(changes_url, {'uri': uri, 'since': 'bogus'})
+        self.assertEqual(400, resp.status_code)
+
+        # without a token, returns all annotations for the uri
+        resp = self.client.get(changes_url, {'uri': uri})
+        self.assertEqual('application/json', resp['Content-Type'])
+        data = json.loads(resp.content)
+        self.assertEqual([str(self.user_note.id)],
+                         [row['id'] for row in data['rows']])
+        self.assertEqual([], data['deleted'])
+        since = data['since']
+        self.assertEqual(AnnotationChange.objects.latest_token(), since)
+
+        # nothing has changed; changes recorded shortly before the token
+        # are returned again, in case they were committed after it
+        resp = self.client.get(changes_url, {'uri': uri, 'since': since})
+        data = json.loads(resp.content)
+        self.assertEqual([str(self.user_note.id)],
+                         [row['id'] for row in data['rows']])
+        self.assertEqual([], data['deleted'])
+        self.assertEqual(since, data['since'])
+        with override_settings(ANNOTATION_SYNC_OVERLAP=0):
+            resp = self.client.get(changes_url, {'uri': uri, 'since': since})
+            data = json.loads(resp.content)
+            self.assertEqual([], data['rows'])
+            self.assertEqual([], data['deleted'])
+
+        # only new and updated annotations are returned
+        self.user_note.text = 'updated'
+        self.user_note.save()
+        new_note = Annotation.objects.create(user=self.user_note.user,
+                                             text='new', uri=uri)
+        resp = self.client.get(changes_url, {'uri': uri, 'since': since})
+        data = json.loads(resp.content)
+        self.assertEqual(set([str(self.user_note.id), str(new_note.id)]),
+                         set(row['id'] for row in data['rows']))
+        self.assertEqual([], data['deleted'])
+        since = data['since']
+
+        # deleted and moved annotations are returned as tombstones
+        new_note.delete()
+        self.user_note.uri = 'http://example.com/other/'
+        self.user_note.save()
+        resp = self.client.get(changes_url, {'uri': uri, 'since': since})
+        data = json.loads(resp.content)
+        self.assertEqual([], data['rows'])
+        self.assertEqual(sorted([str(self.user_note.id), str(new_note.id)]),
+                         data['deleted'])
+        since = data['since']
+
+        # changes to annotations the user can't see are not reported,
+        # unless the user could see them before
+        testuser = get_user_model().objects.get(username='testuser')
+        private_note = Annotation.objects.create(user=self.superuser_note.user,
+                                                 text='private', uri=uri)
+        shared_note = Annotation.objects.create(user=self.superuser_note.user,
+                                                text='shared', uri=uri)
+        shared_note.assign_permission('view_annotation', testuser)
+        with override_settings(ANNOTATION_SYNC_OVERLAP=0):
+            resp = self.client.get(changes_url, {'uri': uri, 'since': since})
+            data = json.loads(resp.content)
+            self.assertEqual([str(shared_note.id)], [row['id'] for row in data['rows']])
+            self.assertEqual([], data['deleted'])
+            since = data['since']
+            private_note.text = 'changed'
+            private_note.save()
+            remove_perm('view_annotation', testuser, shared_note)
+            resp = self.client.get(changes_url, {'uri': uri, 'since': since})
+            data = json.loads(resp.content)
+            self.assertEqual([], data['rows'])
+            self.assertEqual([str(shared_note.id)], data['deleted'])
+
+    def test_export_annotations(self):
+        export_url = reverse('annotation-api:export')
+        # login required
+        resp = self.client.get(export_url)
+        self.assertEqual(401, resp.status_code)
+
+        # only annotations visible to the user are exported
+        self.client.login(**self.user_credentials['user'])
+        resp = self.client.get(export_url)
+        self.assertEqual('application/x-ndjson', resp['Content-Type'])
+        lines = ''.join(resp.streaming_content).splitlines()
+        self.assertEqual([str(self.user_note.id)],
+                         [json.loads(line)['id'] for line in lines])
+
+        self.client.login(**self.user_credentials['superuser'])
+        resp = self.client.get(export_url)
+        lines = ''.join(resp.streaming_content).splitlines()
+        self.assertEqual(Annotation.objects.count(), len(lines))
+        resp = self.client.get(export_url, {'user': 'testsuper'})
+        lines = ''.join(resp.streaming_content).splitlines()
+        self.assertEqual([str(self.superuser_note.id)],
+                         [json.loads(line)['id'] for line in lines])
+
+        # filter by volume pid
+        self.user_note.volume_uri = 'http://example.com/books/vol:1/'
+        self.user_note.save()
+        with patch('readux.books.view_helpers.volume_uri') as mockvolume_uri:
+            mockvolume_uri.return_value = self.user_note.volume_uri
+            resp = self.client.get(export_url, {'volume': 'vol:1'})
+            lines = ''.join(resp.streaming_content).splitlines()
+            mockvolume_uri.assert_called_with('vol:1')
+            self.assertEqual([str(self.user_note.id)],
+                             [json.loads(line)['id'] for line in lines])
+
+        # filter by collection; includes every volume in the collection,
+        # not just the first page of solr results
+        self.user_note.volume_uri = 'http://example.com/books/vol:20/'
+        self.user_note.save()
+        with patch('readux.utils.solr_interface') as mocksolr_interface, \
+             patch('readux.utils.solr_cursor') as mocksolr_cursor, \
+             patch('readux.books.view_helpers.volume_uri') as mockvolume_uri:
+            mocksolr_cursor.return_value = iter([{'pid': 'vol:%d' % i}
+                                                 for i in range(25)])
+            mockvolume_uri.side_effect = lambda pid: 'http://example.com/books/%s/' % pid
+            resp = self.client.get(export_url, {'collection': 'coll:1'})
+            lines = ''.join(resp.streaming_content).splitlines()
+            mocksolr = mocksolr_interface.return_value
+            mocksolr_cursor.assert_called_with(
+                mocksolr.query.return_value.filter.return_value.field_limit.return_value)
+            self.assertEqual(25, mockvolume_uri.call_count)
+            self.assertEqual([str(self.user_note.id)],
+                             [json.loads(line)['id'] for line in lines])
+
+
+@skipUnless(os.environ.get('BENCHMARK_VISIBILITY'),
+            'set BENCHMARK_VISIBILITY=<number of annotations> to run')
+class AnnotationVisibilityBenchmark(TestCase):
+    '''Opt-in benchmark comparing query time for finding annotations
+    visible to a user or group using :mod:`guardian` per-object
+    permissions, a subquery on :class:`AnnotationVisibility`, and the
+    join used by :meth:`AnnotationQuerySet.visible_to`.  Run with the
+    test database for the configured backend, e.g.::
+
+        BENCHMARK_VISIBILITY=100000 python manage.py test \\
+            readux.annotations.tests.AnnotationVisibilityBenchmark
+    '''
+
+    num_users = 100
+    repeat = 5
+
+    def setUp(self):
+        # create test users, annotations and view permissions for each,
+        # using bulk inserts
+        total = int(os.environ['BENCHMARK_VISIBILITY'])
+        start = time.time()
+        User = get_user_model()
+        User.objects.bulk_create([User(username='benchmark-%d' % i)
+                                  for i in range(self.num_users)])
+        users = list(User.objects.filter(username__startswith='benchmark-'))
+        self.user = users[0]
+        self.group = AnnotationGroup.objects.create(name='benchmark')
+        self.group.user_set.add(self.user)
+
+        ctype = ContentType.objects.get_for_model(Annotation)
+        view_perm = Permission.objects.get(content_type=ctype,
+                                           codename='view_annotation')
+        batch = 5000
+        for offset in range(0, total, batch):
+            notes = [Annotation(id=uuid.uuid4(), user=users[i % len(users)],
+                                text='benchmark note', uri='http://example.com/%d' % i)
+                     for i in range(offset, min(offset + batch, total))]
+            Annotation.objects.bulk_create(notes)
+            # bulk_create does not send signals, so create permissions
+            # and visibility records directly; every tenth annotation is
+            # also shared with the test group
+            UserObjectPermission.objects.bulk_create([
+                UserObjectPermission(content_type=ctype, permission=view_perm,
+                                     user=note.user, object_pk=unicode(note.pk))
+                for note in notes])
+            shared = notes[::10]
+            GroupObjectPermission.objects.bulk_create([
+                GroupObjectPermission(content_type=ctype, permission=view_perm,
+                                      group=self.group, object_pk=unicode(note.pk))
+                for note in shared])
+            AnnotationVisibility.objects.bulk_create(
+                [AnnotationVisibility(annotation=note, principal_id=note.user.pk,
+                                      principal_type=AnnotationVisibility.USER)
+                 for note in notes] +
+                [AnnotationVisibility(annotation=note, principal_id=self.group.pk,
+                                      principal_type=AnnotationVisibility.GROUP)
+                 for note in shared])
+        print '\nCreated %d annotations for %d users in %.02fs' % \
+            (total, self.num_users, time.time() - start)
+
+    def compare(self, label, queries):
+        # run each query and report average time; all must find the
+        # same annotations
+        counts = set()
+        for name, query in queries:
+            start = time.time()
+            for i in range(self.repeat):
+                count = query().count()
+                # also fetch a page of results, as the views do
+                list(query().order_by('created')[:50])
+            print '%s %s: %.04fs (%d annotations)' % \
+                (label, name, (time.time() - start) / self.repeat, count)
+            counts.add(count)
+        self.assertEqual(1, len(counts))
+
+    def test_user(self):
+        user = self.user
+        visible = AnnotationVisibility.objects.filter(
+            Q(principal_type=AnnotationVisibility.USER, principal_id=user.pk) |
+            Q(principal_type=AnnotationVisibility.GROUP,
+              principal_id__in=user.groups.values('pk')))
+        self.compare('user', [
+            ('guardian', lambda: get_objects_for_user(user, 'view_annotation', Annotation)),
+            ('subquery', lambda: Annotation.objects.filter(pk__in=visible.values('annotation'))),
+            ('join', lambda: Annotation.objects.visible_to(user)),
+        ])
+
+    def test_group(self):
+        group = self.group
+        self.compare('group', [
+            ('guardian', lambda: get_objects_for_group(group, 'view_annotation', Annotation)),
+            ('join', lambda: Annotation.objects.visible_to_group(group)),
+        ])
@@ -8,6 +8,8 @@ urlpatterns = patterns('',
     url(r'^$', views.AnnotationIndex.as_view(), name='index'),
     # urls are without trailing slashes per annotatorjs api documentation
     url(r'^search$', views.AnnotationSearch.as_view(), name='search'),
+    url(r'^changes$', views.AnnotationChanges.as_view(), name='changes'),
+    url(r'^export$', views.AnnotationExport.as_view(), name='export'),
     url(r'^annotations$', views.Annotations.as_view(), name='annotations'),
     url(r'^annotations/(?P<id>%s)$' % Annotation.UUID_REGEX,
         views.AnnotationView.as_view(), name='view'),
@@ -1,14 +1,20 @@
+from django.contrib.auth.models import Group
 from django.core.exceptions import PermissionDenied
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.urlresolvers import reverse
-from django.db.models import Q
-from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest
+from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest, \
+    StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils.decorators import method_decorator
 from django.views.generic import View
 from eulcommon.djangoextras.auth import login_required_with_ajax
 from eulcommon.djangoextras.http.responses import HttpResponseSeeOtherRedirect
+import itertools
+import json
+import re
 
-from readux.annotations.models import Annotation
+from readux.annotations.models import Annotation, AnnotationTerm, \
+    AnnotationChange, AnnotationVisibility
 from readux.utils import absolutize_url
 
 
@@ -50,6 +56,16 @@ class AnnotationIndex(View):
                     "desc": "Basic search API",
                     "method": "GET",
                     "url": "%ssearch" % base_url
+                },
+                "changes": {
+                    "desc": "Annotations changed since a previous request",
+                    "method": "GET",
+                    "url": "%schanges" % base_url
+                },
+                "export": {
+                    "desc": "Export annotations as newline-delimited JSON",
+                    "method": "GET",
+                    "url": "%sexport" % base_url
                 }
             }
         })
@@ -69,17 +85,59 @@ class Annotations(View):
     view their own annotations.
     """
 
+    #: default number of annotations to return in a single response
+    page_size = 500
+
     def get(self, request):
-        'List viewable annotations as JSON.'
+        '''List viewable annotations as JSON, sorted by creation date.
+        Returns at most :attr:`page_size` annotations (or the number
+        specified by the ``limit`` parameter); when there are more, the
+        response includes a ``Link`` header with the url for the next
+        page, based on a ``cursor`` parameter.
+
+        With ``format=ndjson``, returns all matching annotations (or up
+        to ``limit``, if specified) as newline-delimited JSON, streamed
+        as they are loaded from the database.'''
         # NOTE: this method doesn't *technically* require that the user
         # be logged in, but under current permission model, no
         # annotations will be visible to anonymous users.
 
-        notes = Annotation.objects.visible_to(request.user)
-        # TODO: sort order?
+        notes = Annotation.objects.visible_to(request.user) \
+                          .select_related('user')
 
-        # TODO: pagination? look at reference implementation
-        return JsonResponse([n.info() for n in notes], safe=False)
+        try:
+            limit = int(request.GET.get('limit', self.page_size))
+            if limit < 1:
+                raise ValueError
+        except ValueError:
+            return HttpResponseBadRequest('Invalid limit')
+
+        if request.GET.get('format', None) == 'ndjson':
+            if 'limit' not in request.GET:
+                limit = None
+            try:
+                chunks = ndjson_annotations(notes, request.GET.get('cursor', None),
+                                            limit)
+                # get the first chunk to check that cursor is valid
+                first = next(chunks, '')
+            except ValueError:
+                return HttpResponseBadRequest('Invalid cursor')
+            return StreamingHttpResponse(itertools.chain([first], chunks),
+                                         content_type='application/x-ndjson')
+
+        try:
+            page, next_cursor = cursor_page(notes, request.GET.get('cursor', None),
+                                            limit)
+        except ValueError:
+            return HttpResponseBadRequest('Invalid cursor')
+
+        response = JsonResponse(Annotation.bulk_info(page), safe=False)
+        if next_cursor is not None:
+            params = request.GET.copy()
+            params['cursor'] = next_cursor
+            response['Link'] = '<%s?%s>; rel="next"' % \
+                (absolutize_url(request.path), params.urlencode())
+        return response
 
     @method_decorator(login_required_with_ajax())
     def post(self, request):
@@ -159,64 +217,290 @@ class AnnotationSearch(View):
 
     The following search fields are currently supported:
        - uri (exact match)
-       - text (case-insensitive partial match)
-       - quote (case-insensitive partial match)
+       - volume_uri (exact match)
+       - text (full-text search)
+       - quote (full-text search)
+       - tags: annotations with all of the specified tags, separated
+         by spaces or commas (case-insensitive match)
        - user (exact match on username)
-       - keyword: case-insensitive partial match on text, quote, or
-         with extra data (e.g., to match tags)
-
-    Search results can be limited by specifying ``limit`` or ``offset``
-    parameters.
+       - keyword: full-text search on text, quote, and tags
+
+    Full-text searches use the
+    :class:`~readux.annotations.models.AnnotationTerm` index; every word
+    in the search must match the beginning of a word in the searched
+    fields, ignoring case.
+
+    Results for full-text searches are sorted by relevance, and can be
+    paginated with ``limit`` and ``offset`` parameters.  Otherwise (or
+    when ``sort=created`` is specified), search results are sorted by
+    creation date, and can be limited by specifying a ``limit``
+    parameter.  When there are more results, the response includes a
+    ``next`` cursor, which can be passed as the ``cursor`` parameter to
+    get the next set of results.  An ``offset`` parameter is still
+    supported, but cursors are more efficient.  ``total`` is always the
+    total number of matching annotations.
     '''
 
+    #: full-text search parameters and the index fields they search
+    fulltext_fields = {
+        'text': [AnnotationTerm.TEXT],
+        'quote': [AnnotationTerm.QUOTE],
+        'keyword': AnnotationTerm.FIELDS,
+    }
+
     def get(self, request):
         # TODO: look at reference implementation to see what
         # other search fields should be supported
 
         # Only provide access to notes a user can view
         # (For non-superusers, this is only notes they own)
-        notes = Annotation.objects.visible_to(request.user)
+        notes = Annotation.objects.visible_to(request.user) \
+                          .select_related('user')
 
+        searches = []
         search_keys = request.GET.keys()
         for field in search_keys:
             search_val = request.GET[field]
-            if field == 'text':
-                notes = notes.filter(text__icontains=search_val)
-            elif field == 'quote':
-                notes = notes.filter(text__icontains=search_val)
+            if field in self.fulltext_fields:
+                searches.append((search_val, self.fulltext_fields[field]))
+                notes = notes.search(search_val, self.fulltext_fields[field])
+            elif field == 'tags':
+                notes = notes.tagged(re.split(r'[\s,]+', search_val.strip()))
             elif field == 'user':
                 notes = notes.filter(user__username=search_val)
             elif field in Annotation.common_fields:
                 notes = notes.filter(**{field: search_val})
-            # special case: "keyword" search on multiple fields
-            elif field == 'keyword':
-                notes = notes.filter(
-                    Q(text__icontains=search_val) |
-                    Q(quote__icontains=search_val) |
-                    Q(extra_data__icontains=search_val)
-                )
-                # NOTE: contains search on extra data jsonfield is
-                # probably not a great idea...
 
         # for now, ignore date fields and extra data
         # NOTE: date searching would be nice, but probably requires
         # parsing dates and generating date ranges
-        # tag searching may be important eventually too
 
-        # minimal pagination: limit/offset
+        # total number of matches, before pagination
+        total = notes.count()
+
+        # pagination: cursor or offset, and limit
         limit = request.GET.get('limit', None)
         offset = request.GET.get('offset', None)
-        # slice queryset by offset first, so limit will be relative to that
         try:
-            if offset is not None:
-                notes = notes[int(offset):]
-            if limit is not None:
-                notes = notes[:int(limit)]
+            limit = int(limit) if limit is not None else None
         except ValueError:
             # if non-numeric values are passed, just ignore them
-            pass
+            limit = None
+        try:
+            offset = int(offset) if offset is not None else None
+        except ValueError:
+            offset = None
+        cursor = request.GET.get('cursor', None)
+
+        if searches and cursor is None and request.GET.get('sort') != 'created':
+            # relevance ranking can't be combined with a cursor
+            notes = notes.by_relevance(searches)
+            start = offset or 0
+            page = list(notes[start:start + limit] if limit is not None
+                        else notes[start:])
+            next_cursor = None
+        else:
+            if cursor is None and offset is not None:
+                # offset is applied after sorting, so limit is relative to it
+                notes = notes.order_by(*notes.cursor_ordering)[offset:]
+            try:
+                page, next_cursor = cursor_page(notes, cursor, limit)
+            except ValueError:
+                return HttpResponseBadRequest('Invalid cursor')
+
+        data = {
+            'total': total,
+            'rows': Annotation.bulk_info(page)
+        }
+        if next_cursor is not None:
+            data['next'] = next_cursor
+        return JsonResponse(data)
+
+
+class AnnotationChanges(View):
+    '''Incremental sync for annotations on a single page or volume,
+    so that clients can update previously loaded annotations without
+    reloading all of them.  Requires a ``uri`` or ``volume_uri``
+    parameter, and an optional ``since`` token from a previous response.
+    Returns JSON with the following fields:
+
+       - rows: annotations created or updated since the token was issued,
+         or all annotations if no token is specified
+       - deleted: ids of annotations that have been deleted, moved to
+         another uri, or are no longer visible to the user
+       - since: token to pass on the next request
+
+    Changes are read from
+    :class:`~readux.annotations.models.AnnotationChange`; only the
+    annotations that have changed are loaded.  Changes recorded shortly
+    before a token was issued are returned again, in case they were
+    committed after it (see
+    :meth:`~readux.annotations.models.AnnotationChangeQuerySet.since`),
+    so clients should replace or remove annotations by id.
+    '''
+
+    @method_decorator(login_required_with_ajax())
+    def dispatch(self, *args, **kwargs):
+        return super(AnnotationChanges, self).dispatch(*args, **kwargs)
+
+    def get(self, request):
+        filters = dict((field, request.GET[field])
+                       for field in ['uri', 'volume_uri'] if field in request.GET)
+        if not filters:
+            return HttpResponseBadRequest('uri or volume_uri is required')
+        since = request.GET.get('since', None)
+        try:
+            since = int(since) if since is not None else None
+            if since is not None and since < 0:
+                raise ValueError
+        except ValueError:
+            return HttpResponseBadRequest('Invalid since token')
+
+        # get the current token first, so that changes made while this
+        # request is processed are included on the next request
+        token = AnnotationChange.objects.latest_token()
+        notes = Annotation.objects.visible_to(request.user) \
+                          .filter(**filters).select_related('user')
+        deleted = []
+        if since is not None:
+            changed = set()
+            removed = set()
+            for note_id, action, users in AnnotationChange.objects \
+                    .since(since, token).filter(**filters) \
+                    .values_list('annotation_id', 'action', 'users'):
+                changed.add(note_id)
+                # annotations deleted or moved from this uri, or no
+                # longer visible to this user; other changes to
+                # annotations the user can't see are not reported
+                if action == AnnotationChange.DELETE or \
+                        (action == AnnotationChange.REMOVE and
+                         request.user.pk in (users or [])):
+                    removed.add(note_id)
+            notes = list(notes.filter(pk__in=changed)
+                              .order_by(*notes.cursor_ordering))
+            # removed annotations that are not (again) found on this
+            # uri and visible to this user
+            deleted = sorted(str(note_id) for note_id in
+                             removed - set(note.pk for note in notes))
+        else:
+            notes = notes.order_by(*notes.cursor_ordering)
 
         return JsonResponse({
-            'total': notes.count(),
-            'rows': [n.info() for n in notes]
-        })
\ No newline at end of file
+            'since': token,
+            'rows': Annotation.bulk_info(notes),
+            'deleted': deleted
+        })
+
+
+class AnnotationExport(View):
+    '''Export annotations visible to the current user as
+    newline-delimited JSON, in the same format used by the
+    **export_annotations** and **import_annotations** manage commands.
+    Annotations can be filtered by ``volume`` or ``collection`` pid,
+    ``user`` (username), or ``group`` (group name); each filter can be
+    specified more than once.  Annotations are streamed as they are
+    loaded from the database, so large exports don't need to be loaded
+    into memory.
+    '''
+
+    @method_decorator(login_required_with_ajax())
+    def dispatch(self, *args, **kwargs):
+        return super(AnnotationExport, self).dispatch(*args, **kwargs)
+
+    def get(self, request):
+        notes = export_filter(Annotation.objects.visible_to(request.user),
+                              volumes=request.GET.getlist('volume'),
+                              collections=request.GET.getlist('collection'),
+                              users=request.GET.getlist('user'),
+                              groups=request.GET.getlist('group'))
+        response = StreamingHttpResponse(ndjson_annotations(notes.select_related('user'),
+                                                            export=True),
+                                         content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="annotations.ndjson"'
+        return response
+
+
+def export_filter(notes, volumes=None, collections=None, users=None,
+                  groups=None):
+    '''Filter annotations for export.
+
+    :param notes: :class:`~readux.annotations.models.AnnotationQuerySet`
+    :param volumes: optional list of volume pids
+    :param collections: optional list of collection pids; annotations
+        on any volume in the collections are included
+    :param users: optional list of usernames
+    :param groups: optional list of group names; annotations visible to
+        any of the groups are included
+    '''
+    if volumes or collections:
+        # imported here to avoid making annotations depend on books
+        # except when exporting by volume or collection
+        from readux.books.models import Volume
+        from readux.books.view_helpers import volume_uri
+        from readux.utils import solr_interface, solr_cursor
+        pids = list(volumes or [])
+        if collections:
+            solr = solr_interface()
+            in_collection = reduce(lambda a, b: a | b,
+                                   [solr.Q(collection_id=pid) for pid in collections])
+            # all volumes in the collections, not just the first page
+            pids.extend(result['pid'] for result in
+                        solr_cursor(solr.query(in_collection)
+                                        .filter(content_model=Volume.VOLUME_CMODEL_PATTERN)
+                                        .field_limit('pid')))
+        volume_uris = [volume_uri(pid) for pid in pids]
+        notes = notes.filter(volume_uri__in=volume_uris)
+    if users:
+        notes = notes.filter(user__username__in=users)
+    if groups:
+        notes = notes.filter(visibility__principal_type=AnnotationVisibility.GROUP,
+                             visibility__principal_id__in=Group.objects
+                                 .filter(name__in=groups).values('pk')) \
+                     .distinct()
+    return notes
+
+
+def cursor_page(notes, cursor=None, limit=None):
+    '''Get a page of annotations from a queryset, sorted by creation
+    date and id.  Returns a list of annotations and the cursor for the
+    next page, or None if there are no more annotations.  Raises
+    :class:`ValueError` if the cursor is invalid.
+
+    :param notes: :class:`~readux.annotations.models.AnnotationQuerySet`
+    :param cursor: optional cursor for the previous page
+    :param limit: optional maximum number of annotations to return
+    '''
+    if cursor is not None:
+        notes = notes.after(cursor)
+    elif notes.query.can_filter():
+        # (queryset with an offset is already sorted)
+        notes = notes.order_by(*notes.cursor_ordering)
+    if limit is None:
+        return list(notes), None
+    # get one extra to determine if there is another page
+    page = list(notes[:limit + 1])
+    if len(page) > limit:
+        return page[:limit], page[limit - 1].cursor
+    return page, None
+
+
+def ndjson_annotations(notes, cursor=None, limit=None, batch_size=500,
+                       export=False):
+    '''Generator for serializing annotations as newline-delimited JSON.
+    Annotations are loaded and serialized in batches of **batch_size**,
+    using a cursor for each batch, so that a large result set is never
+    loaded into memory at once.  Raises :class:`ValueError` if the
+    cursor is invalid.  For exports, groups in permissions are
+    identified by name (see
+    :meth:`~readux.annotations.models.Annotation.bulk_permissions`).'''
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        batch, cursor = cursor_page(notes, cursor, size)
+        if batch:
+            yield ''.join('%s\n' % json.dumps(info, cls=DjangoJSONEncoder)
+                          for info in Annotation.bulk_info(batch, export=export))
+        if remaining is not None:
+            remaining -= len(batch)
+        if cursor is None:
+            break
@@ -1,10 +1,10 @@
 '''Methods to generate annotated TEI for export.'''
 
 from bs4 import BeautifulSoup
+from collections import defaultdict
 from datetime import datetime
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Q
 from django.utils.text import slugify
 from eulxml.xmlmap import load_xmlobject_from_string, teimap, \
     load_xmlobject_from_file, XmlObject
@@ -12,6 +12,7 @@ import logging
 from lxml import etree
 import mistune
 import os
+import re
 
 
 from readux import __version__
@@ -44,13 +45,33 @@ def annotated_tei(teivol, annotations):
     :returns: :class:`~readux.books.tei.AnnotatedFacsimile` with annotation
         information
     '''
+    teivol = annotate_tei_header(teivol, annotations)
+
     # iterate throuth the annotations associated with this volume
     # and insert them into the tei based on the content they reference
 
     # could do some sanity-checking: compare annotation total vs
     # number actually added as we go page-by-page?
+    page_annotations = PageAnnotationIndex(annotations)
+    notes = []
+    for page in teivol.page_list:
+        notes.extend(annotate_page(page, page_annotations))
 
-    tags = set()
+    add_annotation_notes(teivol, notes)
+    return teivol
+
+
+def annotate_tei_header(teivol, annotations):
+    '''Update the header of a TEI :class:`~readux.books.tei.Facsimile`
+    document to reflect an annotated edition: title, responsibility
+    statement based on annotation authors, publication statement,
+    and encoding description.
+
+    :param teivol: tei document to be annotated
+    :param annotations: :class:`~readux.annotations.models.Annotation`
+        queryset to be added into the TEI for export
+    :returns: :class:`~readux.books.tei.AnnotatedFacsimile`
+    '''
     # make sure tei xml is using the xmlobject we need to add
     # annotation data and tags
     if not isinstance(teivol, tei.AnnotatedFacsimile):
@@ -84,30 +105,101 @@ def annotated_tei(teivol, annotations):
     # add stock encoding description
     teivol.encoding_desc = load_xmlobject_from_file(TEI_ENCODING_DESCRIPTION,
                                                     XmlObject)
+    return teivol
 
-    for page in teivol.page_list:
-        # use page.href to find annotations for this page
-        # if for some reason href is not set, skip this page
-        if not page.href:
-            continue
-
-        # page.href should either be local readux uri OR ARK uri;
-        # local uri is stored as annotation uri, but ark is in extra data
-        page_annotations = annotations.filter(Q(uri=page.href)|Q(extra_data__contains=page.href))
-
-        if page_annotations.exists():
-            for note in page_annotations:
-                # possible to get extra matches for page url in related pages,
-                # so skip any notes where ark doesn't match page url
-                if note.extra_data.get('ark', '') != page.href and not settings.DEV_ENV:
-                    # NOTE: allow without ark in dev, since test page records
-                    # may not have ARKs
-                    continue
-
-                insert_note(teivol, page, note)
-                # collect a list of unique tags as we work through the notes
-                if 'tags' in note.info():
-                    tags |= set(t.strip() for t in note.info()['tags'])
+
+class PageAnnotationIndex(object):
+    '''Annotations to be exported, loaded with a single query and grouped
+    by page uri and page ARK, so that annotations for each page can be
+    found without querying the database for every page in a volume.
+
+    Annotation info needed for export (text and image selections and
+    tags) is taken directly from annotation extra data, to avoid the
+    per-annotation permission lookups in
+    :meth:`~readux.annotations.models.Annotation.info`.
+
+    :param annotations: :class:`~readux.annotations.models.Annotation`
+        queryset to be added into the TEI for export
+    '''
+
+    def __init__(self, annotations):
+        self.by_page = defaultdict(list)
+        for note in annotations.select_related('user'):
+            info = note.extra_data
+            # local readux page uri is stored as annotation uri,
+            # but ark is in extra data
+            for page_uri in set([note.uri, info.get('ark', '')]):
+                if page_uri:
+                    self.by_page[page_uri].append((note, info))
+
+    def for_page(self, page_uri):
+        '''List of annotations for the specified page, as tuples of
+        annotation and annotation info.
+
+        :param page_uri: page ARK (or readux page uri)
+        '''
+        notes = []
+        for note, info in self.by_page.get(page_uri, []):
+            # skip any notes where ark doesn't match page url
+            if info.get('ark', '') != page_uri and not settings.DEV_ENV:
+                # NOTE: allow without ark in dev, since test page records
+                # may not have ARKs
+                continue
+            notes.append((note, info))
+        return notes
+
+
+def annotate_page(page, page_annotations):
+    '''Add highlight references to a single TEI facsimile page for
+    all annotations that belong to that page.
+
+    :param page: :class:`~readux.books.tei.Zone` page zone
+    :param page_annotations: :class:`PageAnnotationIndex` of annotations
+        to be added into the TEI for export
+    :returns: list of tuples of annotation, annotation info, and
+        highlight target, for use with :meth:`add_annotation_notes`
+    '''
+    # use page.href to find annotations for this page
+    # if for some reason href is not set, skip this page
+    if not page.href:
+        return []
+
+    notes = []
+    # page.href should either be local readux uri OR ARK uri
+    page_notes = page_annotations.for_page(page.href)
+    if not page_notes:
+        return notes
+
+    # index page elements by id once for all annotations on this page
+    page_index = PageIdIndex(page)
+    for note, info in page_notes:
+        target = insert_highlight(page, note, info, page_index)
+        if target is not None:
+            notes.append((note, info, target))
+    return notes
+
+
+def add_annotation_notes(teivol, notes):
+    '''Add annotation content to the body of an annotated TEI document,
+    consolidate the bibliography, and add annotation tags as an
+    interpGrp in the back matter.
+
+    :param teivol: :class:`~readux.books.tei.AnnotatedFacsimile`
+    :param notes: list of tuples of annotation, annotation info, and
+        highlight target, as returned by :meth:`annotate_page`
+    '''
+    tags = set()
+    for annotation, info, target in notes:
+        # call annotation_to_tei and insert the resulting note into
+        # the appropriate part of the document
+        teinote = annotation_to_tei(annotation, teivol, info)
+        teinote.target = target
+        # append actual annotation to tei annotations div
+        teivol.annotations.append(teinote)
+
+        # collect a list of unique tags as we work through the notes
+        if 'tags' in info:
+            tags |= set(t.strip() for t in info['tags'])
 
     consolidate_bibliography(teivol)
 
@@ -121,10 +213,8 @@ def annotated_tei(teivol, annotations):
             # and variation in capitalization or punctuation
             teivol.tags.interp.append(tei.Interp(id=slugify(tag), value=tag))
 
-    return teivol
-
 
-def annotation_to_tei(annotation, teivol):
+def annotation_to_tei(annotation, teivol, info=None):
     '''Generate a tei note from an annotation.  Sets annotation id,
     slugified tags as ana attribute, username as resp attribute, and
     annotation content is converted from markdown to TEI.
@@ -132,8 +222,13 @@ def annotation_to_tei(annotation, teivol):
     :param annotation: :class:`~readux.annotations.models.Annotation`
     :param teivol: :class:`~readux.books.tei.AnnotatedFacsimile` tei
         document, for converting related page ARK uris into TEI ids
+    :param info: optional annotation info; if not specified,
+        :meth:`~readux.annotations.models.Annotation.info` will be used
     :returns: :class:`readux.books.tei.Note`
     '''
+    if info is None:
+        info = annotation.info()
+
     # NOTE: annotation created/edited dates are not included here
     # because they were determined not to be relevant for our purposes
 
@@ -155,9 +250,9 @@ def annotation_to_tei(annotation, teivol):
     teinote.type = 'annotation'
 
     # if an annotation includes tags, reference them by slugified id in @ana
-    if 'tags' in annotation.info() and annotation.info()['tags']:
+    if 'tags' in info and info['tags']:
         tags = ' '.join(set('#%s' % slugify(t.strip())
-                            for t in annotation.info()['tags']))
+                            for t in info['tags']))
         teinote.ana = tags
 
     # if the annotation has an associated user, mark the author
@@ -200,6 +295,66 @@ def annotation_to_tei(annotation, teivol):
     return teinote
 
 
+class PageIdIndex(object):
+    '''Index of the elements in a TEI facsimile page by xml:id, for
+    finding the TEI content that corresponds to annotation selections
+    without evaluating xpaths against the page for every annotation.
+
+    :param teipage: :class:`~readux.books.tei.Zone` page zone
+    '''
+
+    #: regular expression for the xpaths generated by the readux
+    #: annotator for text selections, i.e. a div by id, optionally
+    #: followed by a numbered span (line or word)
+    html_xpath_re = re.compile(
+        r'^//div\[@id=[\'"](?P<id>[^\'"]+)[\'"]\](/span\[(?P<index>\d+)\])?$')
+
+    #: local names of tei elements corresponding to html spans
+    span_names = ('line', 'w')
+
+    def __init__(self, teipage):
+        self.teipage = teipage
+        xml_id = '{%s}id' % tei.TeiBase.ROOT_NAMESPACES['xml']
+        self.ids = {}
+        for el in teipage.node.iter(tag=etree.Element):
+            if el.get(xml_id):
+                self.ids[el.get(xml_id)] = el
+
+    def resolve(self, html_xpath, default_xpath):
+        '''Find the TEI element corresponding to an html xpath from
+        an annotation selection.  Common xpaths (element id and optional
+        span index) are resolved with the id index; anything else is
+        converted with :meth:`html_xpath_to_tei` and evaluated as an xpath
+        against the page.
+
+        :param html_xpath: xpath from the annotation selection
+        :param default_xpath: tei xpath to use if html xpath is empty
+        :returns: matching element, or None if not found
+        '''
+        match = self.html_xpath_re.match(html_xpath or '')
+        if match:
+            el = self.ids.get(match.group('id'))
+            # html divs correspond to tei zones
+            if el is None or etree.QName(el).localname != 'zone':
+                return None
+            if match.group('index') is None:
+                return el
+            # numbered span corresponds to the nth line or word child
+            spans = [child for child in el.iterchildren(tag=etree.Element)
+                     if etree.QName(child).localname in self.span_names]
+            index = int(match.group('index')) - 1
+            if 0 <= index < len(spans):
+                return spans[index]
+            return None
+
+        xpath = html_xpath_to_tei(html_xpath) or default_xpath
+        results = self.teipage.node.xpath(xpath,
+            namespaces=tei.Zone.ROOT_NAMESPACES)
+        # xpath returns a list of matches; we only want the first one
+        if results:
+            return results[0]
+
+
 def html_xpath_to_tei(xpath):
     '''Convert xpaths generated on the readux site to the
     equivalent xpaths for the corresponding TEI content,
@@ -222,30 +377,52 @@ def insert_note(teivol, teipage, annotation):
     :param annotation: :class:`~readux.annotations.models.Annotation`
         to add the document
     '''
+    target = insert_highlight(teipage, annotation)
+    if target is None:
+        return
+
+    # call annotation_to_tei and insert the resulting note into
+    # the appropriate part of the document
+    teinote = annotation_to_tei(annotation, teivol)
+    teinote.target = target
+    # append actual annotation to tei annotations div
+    teivol.annotations.append(teinote)
+
+
+def insert_highlight(teipage, annotation, info=None, page_index=None):
+    '''Insert highlight references for an annotation into a tei
+    facsimile page: start and end anchors for text annotations, or
+    a new zone for image annotations.
 
-    info = annotation.info()
+    :param teipage: :class:`~readux.books.tei.Zone` page zone where
+        annotation highlight references should be added
+    :param annotation: :class:`~readux.annotations.models.Annotation`
+    :param info: optional annotation info; if not specified,
+        :meth:`~readux.annotations.models.Annotation.info` will be used
+    :param page_index: optional :class:`PageIdIndex` for the page; will
+        be generated if not specified
+    :returns: target reference for the highlight, for use in the tei note;
+        None if the highlight could not be added
+    '''
+    if info is None:
+        info = annotation.info()
     # convert html xpaths to tei
     if 'ranges' in info and info['ranges']:
         # NOTE: assuming a single range selection for now
         # the annotator model supports multiple, but UI does not currently
         # support it.
         selection_range = info['ranges'][0]
-        # convert html xpaths from readux website to equivalent tei xpaths
-        # for selection within the facsimile document
+        # find tei elements corresponding to html xpaths from readux
+        # website for selection within the facsimile document
         # either of start or end xpaths could be empty; if so, assume
         # starting at the beginning of the page or end at the end
-        start_xpath = html_xpath_to_tei(selection_range['start']) or '//tei:zone[1]'
-        end_xpath = html_xpath_to_tei(selection_range['end']) or '//tei:zone[last()]'
-        # insert references using start and end xpaths & offsets
-        start = teipage.node.xpath(start_xpath, namespaces=tei.Zone.ROOT_NAMESPACES)
-        end = teipage.node.xpath(end_xpath, namespaces=tei.Zone.ROOT_NAMESPACES)
-        if not start or not end:
+        if page_index is None:
+            page_index = PageIdIndex(teipage)
+        start = page_index.resolve(selection_range['start'], '//tei:zone[1]')
+        end = page_index.resolve(selection_range['end'], '//tei:zone[last()]')
+        if start is None or end is None:
             logger.warn('Could not find start or end xpath for annotation %s' % annotation.id)
-            return
-        else:
-            # xpath returns a list of matches; we only want the first one
-            start = start[0]
-            end = end[0]
+            return None
 
         start_anchor = tei.Anchor(type='text-annotation-highlight-start',
             id='highlight-start-%s' % annotation.id,
@@ -290,12 +467,11 @@ def insert_note(teivol, teipage, annotation):
 
         teipage.node.append(image_highlight.node)
 
-    # call annotation_to_tei and insert the resulting note into
-    # the appropriate part of the document
-    teinote = annotation_to_tei(annotation, teivol)
-    teinote.target = target
-    # append actual annotation to tei annotations div
-    teivol.annotations.append(teinote)
+    else:
+        logger.warn('Annotation %s has no text or image selection' % annotation.id)
+        return None
+
+    return target
 
 
 def insert_anchor(element, anchor, offset):
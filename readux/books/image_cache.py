@@ -0,0 +1,261 @@
+'''Local, disk-based cache for image derivatives (thumbnails, page-size
+images, IIIF image info) retrieved from the IIIF image server.
+
+Cached images are stored in the directory configured as
+**IIIF_CACHE_DIR**; total size of the cache is limited to
+**IIIF_CACHE_MAX_BYTES**, and the least-recently used entries are removed
+when the cache grows larger than that.  Cache keys include the checksum of
+the page image datastream, so a cached derivative is never used for a
+modified image.
+'''
+
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from readux.utils import iiif_session
+
+
+logger = logging.getLogger(__name__)
+
+#: page image modes that are cached; full-size images are not cached,
+#: since they are large and infrequently requested
+cached_modes = ['thumbnail', 'mini-thumbnail', 'single-page', 'info', 'iiif']
+
+
+class CacheEntry(object):
+    '''A single cached derivative: path to the content on disk, content
+    type, size in bytes, and the time it was cached.'''
+
+    def __init__(self, path, content_type, size, created):
+        self.path = path
+        self.content_type = content_type
+        self.size = size
+        #: time the entry was cached, as a :class:`datetime.datetime`
+        self.created = created
+
+    @property
+    def etag(self):
+        'etag for the cached content, based on the cache key'
+        return os.path.basename(self.path)
+
+
+class DerivativeCache(object):
+    '''Size-bounded, disk-based cache with least-recently-used eviction.
+    Entries are written to a temporary file and renamed into place, so
+    partially written content is never served.  The modification time
+    of each content file is updated when the entry is used, for LRU
+    eviction.
+
+    :param root: base directory for cached content
+    :param max_bytes: maximum total size of cached content
+    :param low_water: fraction of **max_bytes** to reduce the cache to
+        when it is full, so that eviction (which scans the whole cache)
+        runs once for many new entries instead of for every new entry
+    '''
+
+    #: suffix for the file with metadata for a cache entry
+    meta_suffix = '.json'
+
+    def __init__(self, root, max_bytes, low_water=0.9):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        # running total of cache size, calculated when first needed;
+        # shared by all threads but not by other processes, so it is
+        # recalculated when eviction runs
+        self._size = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(pid, mode, path, checksum):
+        '''Generate a cache key for an image derivative.
+
+        :param pid: page pid
+        :param mode: image mode (e.g., thumbnail, info)
+        :param path: iiif path (for iiif image requests), if any
+        :param checksum: checksum of the page image datastream
+        '''
+        return hashlib.sha1('|'.join([pid, mode, path or '', checksum or ''])) \
+                      .hexdigest()
+
+    def path(self, key):
+        'File path for content with the specified key'
+        # split into subdirectories to avoid overly large directories
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def get(self, key):
+        '''Get a cached entry by key.  Returns a :class:`CacheEntry`, or
+        None if the key is not in the cache.'''
+        path = self.path(key)
+        try:
+            with open(path + self.meta_suffix) as metafile:
+                meta = json.load(metafile)
+            # update modification time to mark as recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return CacheEntry(path, meta['content_type'], meta['size'],
+                          datetime.utcfromtimestamp(meta['created']))
+
+    def put(self, key, chunks, content_type):
+        '''Add content to the cache.
+
+        :param key: cache key, as generated by :meth:`key`
+        :param chunks: iterable of content chunks
+        :param content_type: content type, for use when serving content
+        :returns: :class:`CacheEntry`
+        '''
+        path = self.path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # possible that another process created it
+                if not os.path.isdir(dirname):
+                    raise
+
+        # write content and metadata to temporary files in the same
+        # directory and rename into place, so the entry is complete
+        # when it becomes visible
+        size = 0
+        tmp = tempfile.NamedTemporaryFile(dir=dirname, prefix='.tmp-',
+                                          delete=False)
+        meta = tempfile.NamedTemporaryFile(dir=dirname, prefix='.tmp-',
+                                           delete=False)
+        try:
+            with tmp:
+                for chunk in chunks:
+                    tmp.write(chunk)
+                    size += len(chunk)
+            created = time.time()
+            with meta:
+                json.dump({'content_type': content_type, 'size': size,
+                           'created': created}, meta)
+            # replacing an existing entry only changes the total size
+            # by the difference
+            try:
+                size_change = size - os.path.getsize(path)
+            except OSError:
+                size_change = size
+            # content first, so metadata never refers to missing content
+            os.rename(tmp.name, path)
+            os.rename(meta.name, path + self.meta_suffix)
+        except Exception:
+            for name in [tmp.name, meta.name]:
+                if os.path.exists(name):
+                    os.remove(name)
+            raise
+
+        with self._lock:
+            if self._size is not None:
+                self._size += size_change
+        if self.size() > self.max_bytes:
+            self.evict()
+
+        return CacheEntry(path, content_type, size,
+                          datetime.utcfromtimestamp(created))
+
+    def _entries(self):
+        # list of (modification time, size, path) for all cached content
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith('.') or filename.endswith(self.meta_suffix):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        'Total size of cached content, in bytes'
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for mtime, size, path in self._entries())
+            return self._size
+
+    def evict(self):
+        '''Remove least-recently-used entries until total cache size is
+        no larger than the low-water mark (:attr:`low_water` fraction of
+        :attr:`max_bytes`).'''
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for mtime, size, path in entries)
+            target = self.max_bytes * self.low_water
+            removed = 0
+            for mtime, size, path in entries:
+                if total <= target:
+                    break
+                for filename in [path, path + self.meta_suffix]:
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        pass
+                total -= size
+                removed += 1
+            self._size = total
+        logger.debug('Removed %d entries from image derivative cache; %d bytes cached',
+                     removed, total)
+
+
+_cache = None
+
+def derivative_cache():
+    '''Access the configured :class:`DerivativeCache`, or None if
+    **IIIF_CACHE_DIR** is not configured.  Size defaults to 1GB;
+    configure with **IIIF_CACHE_MAX_BYTES**.'''
+    global _cache
+    cache_dir = getattr(settings, 'IIIF_CACHE_DIR', None)
+    if not cache_dir:
+        return None
+    if _cache is None or _cache.root != cache_dir:
+        _cache = DerivativeCache(cache_dir,
+            getattr(settings, 'IIIF_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+    return _cache
+
+
+def cache_page_image(page, mode):
+    '''Ensure that an image derivative for a page is in the local image
+    cache, retrieving it from the IIIF server if necessary; used to warm
+    the cache ahead of requests.  Only supports thumbnail, mini-thumbnail
+    and single-page modes.  Returns a tuple of
+    :class:`CacheEntry` and a boolean indicating if the image was
+    retrieved, or None if the image cache is not configured.
+
+    :param page: :class:`~readux.books.models.Page`
+    :param mode: image mode
+    '''
+    cache = derivative_cache()
+    if cache is None:
+        return None
+    image_urls = {
+        'thumbnail': page.iiif.thumbnail,
+        'mini-thumbnail': page.iiif.mini_thumbnail,
+        'single-page': page.iiif.page_size,
+    }
+    key = cache.key(page.pid, mode, None, page.image.checksum)
+    entry = cache.get(key)
+    if entry is not None:
+        return entry, False
+
+    response = iiif_session().get(unicode(image_urls[mode]()),
+        headers={'Accept-Encoding': 'identity'}, stream=True)
+    try:
+        response.raise_for_status()
+        entry = cache.put(key, response.iter_content(64 * 1024),
+                          response.headers.get('Content-Type'))
+    finally:
+        response.close()
+    return entry, True
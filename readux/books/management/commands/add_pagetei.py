@@ -158,18 +158,20 @@ class Command(BaseCommand):
             vol.save('Adding ids to OCR')
 
         ocr_pages = vol.ocr.content.pages
-        pbar = self.get_progressbar(len(vol.pages))
+        # page manifest provides pids, page order, and tei status for all
+        # pages with a single query, instead of loading each page separately
+        pages = vol.page_manifest
+        pbar = self.get_progressbar(len(pages))
 
         # NOTE: this *does* depend on pages loaded in order
         # (and no missing pages?)
         # index into ocr pages list, to match page objects with ocr
         index = vol.start_page - 1 if vol.start_page is not None else 0
 
-        for p in vol.pages:
-            # FIXME: can volume return page as the appropriate kind of page object?
+        for p in pages:
             page = self.repo.get_object(p.pid, type=PageV1_0)
             if self.verbosity > self.v_normal:
-                self.stdout.write('%s page %s' % (page.pid, page.page_order))
+                self.stdout.write('%s page %s' % (page.pid, p.page_order))
 
             # NOTE: some pages have no tei, but since the abbyy ocr
             # includes page content for every page, we're going to
@@ -219,7 +221,7 @@ class Command(BaseCommand):
                         # stop processing this volume to avoid loading bad data
                         break
 
-            if page.tei.exists:
+            if p.has_tei:
                 verb = 'updated'
                 self.stats['updated'] += 1
             else:
@@ -258,23 +260,24 @@ class Command(BaseCommand):
                       % vol.pid)
 
         updates = 0
-        pbar = self.get_progressbar(len(vol.pages))
+        pages = vol.page_manifest
+        pbar = self.get_progressbar(len(pages))
 
-        for p in vol.pages:
-
-            # FIXME: can volume return page as the appropriate kind of page object?
-            page = self.repo.get_object(p.pid, type=PageV1_1)
+        for p in pages:
             if self.verbosity > self.v_normal:
-                self.stdout.write('%s page %s' % (page.pid, page.page_order))
+                self.stdout.write('%s page %s' % (p.pid, p.page_order))
 
-            # for page 1.1, ocr is on the page object
-            if not page.ocr.exists:
+            # for page 1.1, ocr is on the page object; use the manifest
+            # to skip pages without ocr before loading them from fedora
+            if not p.has_ocr:
                 if self.verbosity >= self.v_normal:
                     self.stdout.write('No ocr content for %s (page %d); skipping' \
-                        % (page.pid, page.page_order))
+                        % (p.pid, p.page_order))
                 self.stats['skipped'] += 1
                 continue
 
+            page = self.repo.get_object(p.pid, type=PageV1_1)
+
             # if page does not yet have ids in the ocr, add them
             # OR if id-regeneration is requested
             if self.regenerate_ids or not page.ocr_has_ids:
@@ -284,7 +287,7 @@ class Command(BaseCommand):
                     self.stdout.write('Failed to add OCR ids to %s' % page.pid)
                 page.save('Adding ids to OCR')
 
-            if page.tei.exists:
+            if p.has_tei:
                 verb = 'updated'
                 self.stats['updated'] += 1
             else:
@@ -0,0 +1,40 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from readux import sitemaps
+
+
+class Command(BaseCommand):
+    '''Pre-generate gzipped sitemap files for all sections of the site
+    sitemap (collections, volumes, volume PDFs, pages, and site content
+    pages), so that sitemap requests do not query Solr.  Should be run
+    after content is indexed; files are written to **SITEMAP_DIR**
+    unless another directory is specified.'''
+    help = __doc__
+
+    v_normal = 1
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', '-o',
+            help='Directory to write sitemap files to (default: SITEMAP_DIR)'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', self.v_normal))
+        directory = options.get('output') or sitemaps.sitemap_dir()
+        if not directory:
+            raise CommandError('Please configure SITEMAP_DIR or specify an output directory')
+
+        # sitemaps are configured with the site urls
+        from readux.urls import sitemaps as site_sitemaps
+
+        start = time.time()
+        pages = sitemaps.generate(site_sitemaps, directory)
+        if verbosity >= self.v_normal:
+            for section, count in sorted(pages.items()):
+                self.stdout.write('%s: %d file%s' % \
+                    (section, count, 's' if count != 1 else ''))
+            self.stdout.write('Generated sitemaps in %s in %.02fs' % \
+                (directory, time.time() - start))
@@ -49,7 +49,7 @@ from django.core.management.base import BaseCommand, CommandError
 from progressbar import ProgressBar, Bar, Percentage, \
          ETA, Counter, Timer
 
-from readux.books.models import VolumeV1_0
+from readux.books.models import VolumeV1_0, PageV1_0
 from readux.books.management.page_import import BasePageImport
 from readux.utils import md5sum
 
@@ -269,11 +269,10 @@ the configured fedora instance).'''
         logger.debug('cover index is %d, current page count is %d; expected next page index %d',
             coverindex, vol.page_count, next_index)
 
-        # pages are currently not guaranteed to be returned in order,
-        # so generate a dictionary so we can find the last checksum
-        # NOTE: this is potentially slow for large volumes...
-        pages = sorted(vol.pages, key=lambda p: p.page_order)
-        last_page = pages[-1]
+        # use the page manifest (sorted by page order) to find the last
+        # page, so only that page needs to be loaded from fedora
+        last_page_info = vol.page_manifest[-1]
+        last_page = self.repo.get_object(last_page_info.pid, type=PageV1_0)
 
         # check that checksum for last page matches
         last_image = images[next_index - 1]
@@ -292,7 +291,7 @@ the configured fedora instance).'''
 
         if checksum == last_page.image.checksum:
             # return image index and numerical page order for next page
-            return (next_index, pages[-1].page_order + 1)
+            return (next_index, last_page_info.page_order + 1)
 
         # otherwise, return nothing (next page information not found)
 
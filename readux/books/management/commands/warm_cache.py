@@ -0,0 +1,244 @@
+from collections import defaultdict
+import logging
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+import os
+import signal
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from eulfedora.util import RequestFailed
+import requests
+
+from readux.books import image_cache
+from readux.books.management.page_import import collection_volumes
+from readux.books.models import Volume, Page
+from readux.books.views import VolumePageList
+from readux.fedora import ManagementRepository
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    '''Pre-generate cached content for volumes, so that the first readers
+    after a deploy or cache flush do not have to wait for it: volume
+    TEI, page manifests, page image dimensions, thumbnail sprite sheets,
+    and (if the local image cache is configured) page thumbnails.'''
+    help = __doc__
+    args = '<pid> [<pid> <pid>]'
+
+    v_normal = 1
+    verbosity = None
+    repo = None
+    interrupted = False
+
+    #: image derivative modes to cache for each page
+    image_modes = ['thumbnail', 'mini-thumbnail']
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all', '-a',
+            action='store_true',
+            default=False,
+            help='Warm the cache for all volumes with pages loaded'),
+        make_option('--collection', '-c',
+            help='Find and process volumes that belong to the specified collection pid ' + \
+            '(list of pids on the command line takes precedence over this option)'),
+        make_option('--concurrency', '-j',
+            type='int',
+            default=4,
+            help='Number of volumes to process at the same time (default: %default)'),
+        make_option('--resume', '-r',
+            help='File for tracking completed volumes; volumes listed in the ' + \
+            'file are skipped, and volumes are added as they are completed'),
+        make_option('--skip-tei',
+            action='store_true',
+            default=False,
+            help='Do not generate volume TEI'),
+        make_option('--skip-images',
+            action='store_true',
+            default=False,
+            help='Do not load image dimensions, thumbnails, or sprite sheets'),
+    )
+
+    def handle(self, *pids, **options):
+        # bind a handler for interrupt signal
+        signal.signal(signal.SIGINT, self.interrupt_handler)
+
+        self.repo = ManagementRepository()
+        self.verbosity = int(options.get('verbosity', self.v_normal))
+        self.skip_tei = options.get('skip_tei')
+        self.skip_images = options.get('skip_images')
+        self.stats = defaultdict(int)
+        self._lock = threading.Lock()
+
+        # if no pids are specified
+        if not pids:
+            # if collection is specified, find pids by collection
+            if options['collection']:
+                pids = [vol.pid for vol in
+                        collection_volumes(self.repo, options['collection'])]
+
+            # check if 'all' was specified, and if so find all volumes
+            elif options['all']:
+                pids = Volume.volumes_with_pages()
+                if self.verbosity >= self.v_normal:
+                    self.stdout.write('Found %d volumes with pages loaded' % len(pids))
+
+            # otherwise exit with an error message
+            else:
+                raise CommandError('Please specify a volume pid, collection, or --all')
+
+        self.resume_file = options.get('resume')
+        if self.resume_file and os.path.exists(self.resume_file):
+            with open(self.resume_file) as resume:
+                completed = set(line.strip() for line in resume)
+            skipped = len([pid for pid in pids if pid in completed])
+            pids = [pid for pid in pids if pid not in completed]
+            if skipped and self.verbosity >= self.v_normal:
+                self.stdout.write('Skipping %d volume%s already completed' % \
+                    (skipped, 's' if skipped != 1 else ''))
+
+        if options['concurrency'] < 1:
+            raise CommandError('Concurrency must be at least 1')
+
+        start = time.time()
+        pool = ThreadPool(min(options['concurrency'], len(pids)) or 1)
+        try:
+            # results are not needed; consume the iterator so that
+            # all volumes are processed
+            for result in pool.imap_unordered(self.warm_volume, pids):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+        self.summary(time.time() - start)
+
+    def count(self, stat, value=1):
+        # update stats; shared by all worker threads
+        with self._lock:
+            self.stats[stat] += value
+
+    def warm_volume(self, pid):
+        '''Warm cached content for a single volume.  Errors (including
+        unexpected errors) are reported and counted as failures, so that
+        other volumes are still processed.'''
+        # if we have received a SIGINT, skip remaining volumes
+        if self.interrupted:
+            return
+
+        vol = self.repo.get_object(pid, type=Volume)
+        try:
+            if not vol.exists or not vol.is_a_volume:
+                self.stderr.write('%s is not a Volume or is not accessible' % pid)
+                self.count('failures')
+                return
+
+            start = time.time()
+            # page manifest is used for tei, and to find pages
+            pages = list(vol.page_manifest)
+            self.count('items')
+
+            if not self.skip_tei and vol.has_tei:
+                tei = vol.generate_volume_tei()
+                self.count('items')
+                self.count('bytes', len(tei.serialize()))
+
+            if not self.skip_images:
+                self.warm_images(vol, pages)
+
+            # don't mark a partially processed volume as completed
+            if self.interrupted:
+                return
+
+        except (RequestFailed, requests.exceptions.RequestException) as err:
+            self.stderr.write('Error processing %s: %s' % (pid, err))
+            self.count('failures')
+            return
+        except Exception as err:
+            # an unexpected error should not stop other volumes
+            logger.exception('Unexpected error processing %s', pid)
+            self.stderr.write('Unexpected error processing %s: %s' % (pid, err))
+            self.count('failures')
+            return
+
+        self.count('volumes')
+        self.mark_completed(pid)
+        if self.verbosity >= self.v_normal:
+            self.stdout.write('Processed %s (%d pages) in %.02fs' % \
+                (pid, len(pages), time.time() - start))
+
+    def warm_images(self, vol, pages):
+        # load image dimensions and cache thumbnail derivatives for all
+        # pages, then generate sprite sheets for the volume page list
+        for p in pages:
+            if self.interrupted:
+                return
+            page = Page(vol.api, p.pid)
+            try:
+                if page.image_size:
+                    self.count('items')
+
+                for mode in self.image_modes:
+                    cached = image_cache.cache_page_image(page, mode)
+                    if cached is None:
+                        # local image cache is not configured
+                        break
+                    entry, fetched = cached
+                    self.count('items')
+                    if fetched:
+                        self.count('bytes', entry.size)
+            except (RequestFailed, requests.exceptions.RequestException) as err:
+                self.stderr.write('Error loading image for %s: %s' % (p.pid, err))
+                self.count('failures')
+            self.count('pages')
+
+        # sprite sheets for each page of the volume page list, based
+        # on the same solr page list and layout as the view
+        solr_pages = vol.find_solr_pages()
+        solr_pages = list(solr_pages.paginate(rows=solr_pages.count()))
+        if not solr_pages:
+            return
+        layout = VolumePageList.page_layout(vol, solr_pages)
+        chunk = VolumePageList.paginate_by
+        for i in range(0, len(solr_pages), chunk):
+            sprite = VolumePageList.page_sprite(solr_pages[i:i + chunk], layout)
+            content, offsets = sprite.render()
+            self.count('items')
+            self.count('bytes', len(content))
+            if len(offsets) != len(sprite.pids):
+                self.count('failures', len(sprite.pids) - len(offsets))
+
+    def mark_completed(self, pid):
+        # record completed volume in the resume file, if any
+        if self.resume_file:
+            with self._lock:
+                with open(self.resume_file, 'a') as resume:
+                    resume.write('%s\n' % pid)
+
+    def summary(self, elapsed):
+        if self.verbosity >= self.v_normal:
+            self.stdout.write('Processed %d volume%s (%d pages) in %.02fs' % \
+                (self.stats['volumes'], 's' if self.stats['volumes'] != 1 else '',
+                 self.stats['pages'], elapsed))
+            self.stdout.write('%d items cached (%.02f items/sec), %.02f MB; %d failure%s' % \
+                (self.stats['items'], self.stats['items'] / elapsed if elapsed else 0,
+                 self.stats['bytes'] / (1024.0 * 1024), self.stats['failures'],
+                 's' if self.stats['failures'] != 1 else ''))
+
+    def interrupt_handler(self, signum, frame):
+        '''Gracefully handle a SIGINT, if possible.  Sets a flag so
+        volumes that have not been started are skipped, and restores the
+        default SIGINT behavior, so that a second interrupt will stop the
+        script.  Use **--resume** to continue with remaining volumes.
+        '''
+        if signum == signal.SIGINT:
+            # restore default signal handler so a second SIGINT can be used to quit
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            # set interrupt flag so worker threads know to quit
+            self.interrupted = True
+            print >> self.stdout, \
+                  '\n\nScript will exit after the current volumes are processed.' + \
+                  '\n(Ctrl-C / Interrupt again to quit now)'
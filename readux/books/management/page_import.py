@@ -22,6 +22,40 @@ from readux.utils import md5sum
 logger = logging.getLogger(__name__)
 
 
+def collection_volumes(repo, pid):
+    '''Find all volumes that belong to a collection, by way of the
+    books in the collection.  Raises :class:`CommandError` if the
+    collection does not exist or is not a collection.
+
+    :param repo: :class:`~eulfedora.server.Repository`
+    :param pid: collection pid
+    :returns: list of :class:`~readux.books.models.Volume`
+    '''
+    coll = repo.get_object(pid, type=Collection)
+    if not coll.exists:
+        raise CommandError('Collection %s does not exist or is not accessible' % \
+                           pid)
+
+    if not coll.has_requisite_content_models:
+        raise CommandError('Object %s does not seem to be a collection' % \
+                           pid)
+
+    # NOTE: this approach may not scale for large collections
+    # if necessary, use a sparql query to count and possibly return the objects
+    # or else sparql query query to count and generator for the objects
+    # this sparql query does what we need:
+    # select ?vol
+    # WHERE {
+    #    ?book <fedora-rels-ext:isMemberOfCollection> <info:fedora/emory-control:LSDI-Yellowbacks> .
+    #   ?vol <fedora-rels-ext:isConstituentOf> ?book
+    #}
+    volumes = []
+    for book in coll.book_set:
+        volumes.extend(book.volume_set)
+
+    return volumes
+
+
 class BasePageImport(BaseCommand):
     '''Local extension of :class:`django.core.management.base.BaseCommand` with
     common logic for importing covers and book pages'''
@@ -64,30 +98,8 @@ class BasePageImport(BaseCommand):
                                (settings.FEDORA_ROOT, err))
 
     def pids_by_collection(self, pid):
-        coll = self.repo.get_object(pid, type=Collection)
-        if not coll.exists:
-            self.stdout.write('Collection %s does not exist or is not accessible' % \
-                              pid)
-
-        if not coll.has_requisite_content_models:
-            self.stdout.write('Object %s does not seem to be a collection' % \
-                              pid)
-
-        # NOTE: this approach may not scale for large collections
-        # if necessary, use a sparql query to count and possibly return the objects
-        # or else sparql query query to count and generator for the objects
-        # this sparql query does what we need:
-        # select ?vol
-        # WHERE {
-        #    ?book <fedora-rels-ext:isMemberOfCollection> <info:fedora/emory-control:LSDI-Yellowbacks> .
-        #   ?vol <fedora-rels-ext:isConstituentOf> ?book
-        #}
-        volumes = []
-        for book in coll.book_set:
-            volumes.extend(book.volume_set)
-
-        return volumes
-
+        'Find volumes that belong to a collection; see :meth:`collection_volumes`'
+        return collection_volumes(self.repo, pid)
 
     def is_usable_volume(self, vol):
         # if object does not exist or cannot be accessed in fedora, skip it
@@ -351,6 +363,21 @@ class BasePageImport(BaseCommand):
         else:
             return False
 
+    def store_image_size(self, page, imgfile):
+        '''Store image dimensions for a newly ingested page image, so they
+        can be used without requesting image metadata from the IIIF
+        service (see :meth:`readux.books.models.Image.set_image_size`).
+
+        :param page: page object
+        :param imgfile: path to the ingested image
+        '''
+        try:
+            width, height = Image.open(imgfile, mode='r').size
+        except Exception as err:
+            logger.warn('Error reading image size for %s: %s', imgfile, err)
+            return
+        page.set_image_size(width, height)
+
     def convert_to_jp2(self, imgfile):
         '''Convert an image file to JPEG2000 (if it isn't already a JP2).
 
@@ -474,6 +501,8 @@ class BasePageImport(BaseCommand):
                     verb = 'updated' if update else 'ingested'
                     logger.debug('page %s %s', page.pid, verb)
                     self.stats['pages'] += 1
+                    if ingested:
+                        self.store_image_size(page, imgfile)
 
                 elif update:
                     if self.verbosity >= self.v_normal:
@@ -1,12 +1,15 @@
+from collections import OrderedDict
 from datetime import datetime
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.conf import settings
-from django.db.models import permalink, Count
+from django.db.models import permalink
 from django.template.defaultfilters import truncatechars
 from lxml import etree
+import hashlib
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import requests
 import time
@@ -24,12 +27,13 @@ from eulfedora.rdfns import relsext
 from eulxml import xmlmap
 from eulxml.xmlmap import teimap
 
-from readux import __version__
-from readux.annotations.models import Annotation
+from readux import __version__, versions
+from readux.annotations.models import Annotation, AnnotationTag, \
+    AnnotationCount
 from readux.books import abbyyocr, iiif, tei
 from readux.fedora import DigitalObject
 from readux.collection.models import Collection
-from readux.utils import solr_interface, absolutize_url
+from readux.utils import solr_interface, absolutize_url, iiif_session
 
 
 logger = logging.getLogger(__name__)
@@ -202,7 +206,7 @@ class Image(DigitalObject):
     def image_metadata(self):
         '''Image metadata as returned by IIIF service'''
         if self._image_metadata is None:
-            response = requests.get(self.iiif.info())
+            response = iiif_session().get(self.iiif.info())
             if response.status_code == requests.codes.ok:
                 self._image_metadata = response.json()
             else:
@@ -210,20 +214,50 @@ class Image(DigitalObject):
 
         return self._image_metadata
 
-    # expose width & height from image metadata as properties
+    #: timeout for cached image dimensions
+    image_size_cache_timeout = getattr(settings, 'IMAGE_SIZE_CACHE_TIMEOUT',
+                                       60 * 60 * 24 * 90)
+
+    @staticmethod
+    def image_size_cache_key(pid):
+        'Cache key for image dimensions for the specified pid'
+        return 'image-size-%s' % pid
+
+    _image_size = None
+    @property
+    def image_size(self):
+        '''Image dimensions as a tuple of width and height.  Dimensions
+        are stored in the django cache at ingest or index time (see
+        :meth:`set_image_size`); if not cached, they are retrieved from
+        :attr:`image_metadata` and then cached.'''
+        if self._image_size is None:
+            self._image_size = cache.get(self.image_size_cache_key(self.pid))
+            if self._image_size is None and self.image_metadata:
+                self.set_image_size(self.image_metadata['width'],
+                                    self.image_metadata['height'])
+        return self._image_size
+
+    def set_image_size(self, width, height):
+        '''Store image dimensions in the django cache, so they can be
+        used without requesting image metadata from the IIIF service.'''
+        self._image_size = (int(width), int(height))
+        cache.set(self.image_size_cache_key(self.pid), self._image_size,
+                  self.image_size_cache_timeout)
+
+    # expose width & height from image size as properties
     @property
     def width(self):
         '''Width of :attr:`image` datastream, according to
-        :attr:`image_metadata`.'''
-        if self.image_metadata:
-            return int(self.image_metadata['width'])
+        :attr:`image_size`.'''
+        if self.image_size:
+            return self.image_size[0]
 
     @property
     def height(self):
         '''Height of :attr:`image` datastream, according to
-        :attr:`image_metadata`.'''
-        if self.image_metadata:
-            return int(self.image_metadata['height'])
+        :attr:`image_size`.'''
+        if self.image_size:
+            return self.image_size[1]
 
 
 class Page(Image):
@@ -297,6 +331,20 @@ class Page(Image):
         if self.has_fulltext():
             data['page_text'] = self.get_fulltext()
 
+        # index image dimensions so they can be used without
+        # requesting image metadata from the IIIF service
+        if self.image_size:
+            data['image_width'], data['image_height'] = self.image_size
+
+        # page is being reindexed; versions for conditional views of
+        # the page and its volume are pending until the indexer has
+        # updated solr, and the index as a whole is updated after that
+        scopes = [versions.index_scope(self.pid)]
+        if self.volume:
+            scopes.append(versions.index_scope(self.volume.pid))
+        versions.bump_pending(*scopes)
+        versions.bump_later(versions.INDEX)
+
         return data
 
     @property
@@ -500,6 +548,203 @@ class PageV1_1(Page):
                 return False
 
 
+class ManifestPage(object):
+    '''Minimal information about a single page in a
+    :class:`VolumePageManifest`: pid, page order, ARK, and which
+    page-level content datastreams are present.'''
+
+    def __init__(self, pid, page_order=None, ark_uri=None, has_tei=False,
+                 has_ocr=False, last_modified=None):
+        self.pid = pid
+        self.page_order = page_order
+        self.ark_uri = ark_uri
+        #: last modification date for the page object, as reported
+        #: by the resource index
+        self.last_modified = last_modified
+        #: boolean indicating if the page has a tei datastream
+        self.has_tei = has_tei
+        #: boolean indicating if the page has page-level ocr (the text
+        #: datastream; plain text for ScannedPage-1.0, mets/alto for 1.1)
+        self.has_ocr = has_ocr
+
+    def __repr__(self):
+        return '<ManifestPage %s (%s)>' % (self.pid, self.page_order)
+
+
+class VolumePageManifest(object):
+    '''List of :class:`ManifestPage` for all pages in a :class:`Volume`,
+    sorted by page order.  Generated with a single Fedora Resource Index
+    query, so that information about every page in a volume can be
+    accessed without loading each :class:`Page` object from Fedora.
+
+    :param volume: :class:`Volume`
+    '''
+
+    #: sparql query to find pages, page order, ARK, and content
+    #: datastreams for all pages in a volume
+    page_query = '''SELECT ?page ?order ?ark ?ds ?modified
+    WHERE {
+        ?page <fedora-rels-ext:isConstituentOf> <%(volume)s> .
+        OPTIONAL { ?page <%(page_order)s> ?order }
+        OPTIONAL { ?page <fedora-view:lastModifiedDate> ?modified }
+        OPTIONAL { ?page <dc:identifier> ?ark . FILTER regex(str(?ark), "ark:/") }
+        OPTIONAL { ?page <fedora-view:disseminates> ?ds .
+                   FILTER (regex(str(?ds), "/%(tei)s$") || regex(str(?ds), "/%(ocr)s$")) }
+    }'''
+
+    def __init__(self, volume):
+        self.volume = volume
+        self.pages = self._load()
+
+    def _load(self):
+        query = self.page_query % {
+            'volume': self.volume.uri,
+            'page_order': REPOMGMT.pageOrder,
+            'tei': Page.tei.id,
+            'ocr': PageV1_1.ocr.id,
+        }
+        rows = self.volume.risearch.find_statements(query,
+            language='sparql', type='tuples', flush=True)
+
+        # results include one row for each combination of page
+        # and optional values; combine into a single entry per page
+        pages = OrderedDict()
+        for row in rows:
+            pid = row['page'].replace('info:fedora/', '')
+            if pid not in pages:
+                pages[pid] = ManifestPage(pid)
+            page = pages[pid]
+            if row.get('order') and page.page_order is None:
+                page.page_order = int(row['order'])
+            if row.get('ark') and 'ark:/' in row['ark']:
+                page.ark_uri = row['ark']
+            if row.get('modified'):
+                page.last_modified = row['modified']
+            if row.get('ds'):
+                dsid = row['ds'].rsplit('/', 1)[-1]
+                if dsid == Page.tei.id:
+                    page.has_tei = True
+                elif dsid == PageV1_1.ocr.id:
+                    page.has_ocr = True
+
+        # sort by page order; any pages without a page order at the end
+        return sorted(pages.itervalues(),
+            key=lambda p: (p.page_order is None, p.page_order, p.pid))
+
+    def __iter__(self):
+        return iter(self.pages)
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __getitem__(self, index):
+        return self.pages[index]
+
+    @property
+    def tei_pages(self):
+        'list of :class:`ManifestPage` for pages with tei, in page order'
+        return [p for p in self.pages if p.has_tei]
+
+    @property
+    def version(self):
+        '''Checksum based on the pids, modification dates, and tei
+        availability of all pages in the volume; changes when pages
+        are added, removed, or modified.'''
+        digest = hashlib.md5()
+        for p in self.pages:
+            digest.update('%s|%s|%s\n' % (p.pid, p.last_modified, p.has_tei))
+        return digest.hexdigest()
+
+
+class VolumePageSequence(object):
+    '''Ordered list of page pids and page orders for all pages in a
+    volume, for navigating between pages without querying Solr.  The
+    list is loaded from Solr with a single query and stored in the
+    django cache, keyed on the version of the volume index (see
+    :mod:`readux.versions`), which is updated whenever a page in the
+    volume is indexed; previous and next pages, position, and list
+    page are then looked up in constant time.  Lists are not cached
+    while the version is pending, or if the number of pages loaded
+    does not match the number found by the query.
+
+    :param volume_pid: pid of the volume
+    '''
+
+    #: cache timeout for page lists; lists are replaced when pages are
+    #: indexed, so this only determines how long outdated lists are kept
+    cache_timeout = getattr(settings, 'VOLUME_PAGES_CACHE_TIMEOUT',
+                            60 * 60 * 24 * 7)
+
+    def __init__(self, volume_pid):
+        self.volume_pid = volume_pid
+        version, = versions.get_versions([(versions.index_scope(volume_pid), None)])
+        cache_key = 'volume-pages-%s-%r' % (volume_pid, version)
+        #: list of tuples of page pid and page order, in page order
+        self.pages = cache.get(cache_key, None) if version is not None else None
+        if self.pages is None:
+            self.pages, complete = self._load()
+            # don't cache a list while the volume is being reindexed,
+            # or if pages were indexed while it was loaded
+            if version is not None and complete:
+                cache.set(cache_key, self.pages, self.cache_timeout)
+        self.positions = dict((pid, i) for i, (pid, order) in enumerate(self.pages))
+
+    def _load(self):
+        # returns the list of pages, and whether it includes every page
+        # currently indexed
+        solr = solr_interface()
+        query = solr.query(isConstituentOf='info:fedora/%s' % self.volume_pid) \
+                    .filter(content_model=Page.PAGE_CMODEL_PATTERN) \
+                    .filter(state='A') \
+                    .sort_by('page_order') \
+                    .field_limit(['pid', 'page_order'])
+        response = query.paginate(rows=query.count()).execute()
+        pages = [(result['pid'], result.get('page_order', None))
+                 for result in response]
+        return pages, len(pages) == response.result.numFound
+
+    def __len__(self):
+        return len(self.pages)
+
+    def _page(self, index):
+        if 0 <= index < len(self.pages):
+            pid, page_order = self.pages[index]
+            return {'pid': pid, 'page_order': page_order}
+
+    def position(self, pid):
+        '''0-based position of a page in the volume, or None if the
+        page is not found.'''
+        return self.positions.get(pid, None)
+
+    def page(self, pid):
+        '''Page with the specified pid, as a dictionary with pid and
+        page_order, or None if the page is not found.'''
+        index = self.position(pid)
+        if index is not None:
+            return self._page(index)
+
+    def previous(self, pid):
+        '''Previous page, as a dictionary with pid and page_order, or
+        None if this is the first page or the page is not found.'''
+        index = self.position(pid)
+        if index is not None:
+            return self._page(index - 1)
+
+    def next(self, pid):
+        '''Next page, as a dictionary with pid and page_order, or
+        None if this is the last page or the page is not found.'''
+        index = self.position(pid)
+        if index is not None:
+            return self._page(index + 1)
+
+    def page_chunk(self, pid, per_page):
+        '''Number of the page in a paginated list of pages that
+        includes this page (1-based), or None if the page is not found.'''
+        index = self.position(pid)
+        if index is not None:
+            return (index // per_page) + 1
+
+
 class BaseVolume(object):
     '''Common functionality for :class:`Volume` and :class:`SolrVolume`'''
 
@@ -640,17 +885,21 @@ class Volume(DigitalObject, BaseVolume):
         else:
             return False
 
+    _page_manifest = None
+
+    @property
+    def page_manifest(self):
+        ''':class:`VolumePageManifest` with basic information for all
+        pages in this volume, sorted by page order'''
+        if self._page_manifest is None:
+            self._page_manifest = VolumePageManifest(self)
+        return self._page_manifest
+
     @property
     def has_tei(self):
         'boolean flag indicating if TEI has been generated for volume pages'
-        if self.pages:
-            # NOTE: this is only checking tei in the first few pages;
-            # If TEI is incompletely loaded, this could report incorrectly.
-            # Checks multiple pages because blank pages might have no TEI.
-            for p in self.pages[:10]:
-                if p.tei.exists:
-                    return True
-        return False
+        # checks all pages, because blank pages might have no TEI
+        return any(p.has_tei for p in self.page_manifest)
 
     @property
     def title(self):
@@ -779,6 +1028,13 @@ class Volume(DigitalObject, BaseVolume):
         if self.pdf and self.pdf.size:
             data['pdf_size'] = self.pdf.size
 
+        # volume is being reindexed; versions for conditional views of
+        # the volume and its collection are pending until the indexer
+        # has updated solr, and the index as a whole is updated after that
+        versions.bump_pending(versions.index_scope(self.pid),
+                              versions.index_scope(data['collection_id']))
+        versions.bump_later(versions.INDEX)
+
         return data
 
     #: supported unAPI formats, for use with :meth:`readux.books.views.unapi`
@@ -866,9 +1122,10 @@ class Volume(DigitalObject, BaseVolume):
                        .filter(content_model=Page.PAGE_CMODEL_PATTERN) \
                        .filter(state='A') \
                        .sort_by('page_order') \
-                       .field_limit(['pid', 'page_order']) \
+                       .field_limit(['pid', 'page_order', 'image_width',
+                                     'image_height']) \
                        .results_as(SolrPage)
-        # only return fields we actually need (pid, page_order)
+        # only return fields we actually need (pid, page_order, image size)
         # TODO: add volume id for generating urls ?
         # solrquery = solrquery.field_limit(['pid', 'page_order', 'isConstituentOf'])  # ??
         # return so it can be filtered, paginated as needed
@@ -907,54 +1164,61 @@ class Volume(DigitalObject, BaseVolume):
     def page_annotation_count(self, user=None):
         '''Generate a dictionary with a count of annotations for each
         unique page uri within the current volume.  Filtered by
-        *visibility* to user, if specified.'''
-        # aggregate anotations by unique uri and return a count
-        # of the number of annotations for each uri
-        notes = self.annotations()
-        if user is not None:
-            notes = notes.visible_to(user=user)
-
-        notes = notes.values('uri').distinct() \
-                     .annotate(count=Count('uri')) \
-                     .values('uri', 'count')
-
-        # queryset returns a list of dict; convert to a dict for easy lookup
-        return dict([(n['uri'], n['count']) for n in notes])
+        *visibility* to user, if specified.  Uses precomputed counts;
+        see :class:`~readux.annotations.models.AnnotationCount`.'''
+        return AnnotationCount.objects.for_user(user).pages(self.absolute_url)
 
     def annotation_count(self, user=None):
         '''Total number of annotations for this volume; filtered by annotations
         *visible* to a particular user, if specified.'''
-        notes = self.annotations()
-        if user is not None:
-            notes = notes.visible_to(user)
-        return notes.count()
+        return self.volume_annotation_count(user, uris=[self.absolute_url]) \
+                   .get(self.absolute_url, 0)
 
     @classmethod
-    def volume_annotation_count(cls, user=None):
+    def volume_annotation_count(cls, user=None, uris=None):
         '''Generate a dictionary with a count of annotations for each
-        unique volume uri.  Filtered by *visibility* to user if specified.'''
-        # aggregate anotations by unique uri and return a count
-        # of the number of annotations for each uri
-        notes = Annotation.objects.all()
+        unique volume uri.  Filtered by *visibility* to user if specified,
+        and restricted to the specified list of volume uris, if any.
+        Uses precomputed counts; see
+        :class:`~readux.annotations.models.AnnotationCount`.'''
+        counts = AnnotationCount.objects.for_user(user)
+        if uris is not None:
+            counts = counts.filter(uri__in=uris)
+        return counts.volumes()
+
+    def annotation_tags(self, user=None):
+        '''Tags used on annotations for this volume, with the number of
+        annotations for each tag (see
+        :meth:`readux.annotations.models.AnnotationTagQuerySet.counts`).
+        Filtered by annotations *visible* to a particular user, if
+        specified.'''
+        notes = self.annotations()
         if user is not None:
             notes = notes.visible_to(user)
+        return AnnotationTag.objects.filter(annotation__in=notes).counts()
 
-        notes = notes.values('volume_uri').distinct() \
-                     .annotate(count=Count('volume_uri')) \
-                     .values('volume_uri', 'count')
-
-        # queryset returns a list of dict; convert to a dict for easy lookup
-        return dict([(n['volume_uri'], n['count']) for n in notes])
+    #: timeout for cached page-level TEI fragments used to assemble
+    #: volume TEI; cache keys include the page modification date,
+    #: so fragments can be kept for a long time
+    page_tei_cache_timeout = getattr(settings, 'PAGE_TEI_CACHE_TIMEOUT',
+                                     60 * 60 * 24 * 30)
 
     def generate_volume_tei(self):
         '''Generate TEI for a volume by combining the TEI for
-        all pages.'''
+        all pages.
+
+        The generated volume TEI is cached, keyed on the
+        :attr:`VolumePageManifest.version` so that it is regenerated
+        when any page changes.  TEI for individual pages is also cached
+        (see :meth:`page_tei_fragments`), so only modified pages need
+        to be loaded from Fedora when the volume TEI is regenerated.
+        '''
         if not self.has_tei:
             return
 
         # store volume TEI in django cache, because generating TEI
         # for a large volume is expensive (fedora api calls for each page)
-        cache_key = '%s-tei' % self.pid
+        cache_key = '%s-tei-%s' % (self.pid, self.page_manifest.version)
         vol_tei_xml = cache.get(cache_key, None)
         if vol_tei_xml:
             logger.debug('Loading volume TEI for %s from cache' % self.pid)
@@ -964,86 +1228,18 @@ class Volume(DigitalObject, BaseVolume):
         # if tei was not in the cache, generate it
         if vol_tei_xml is None:
             start = time.time()
-            vol_tei = tei.Facsimile()
-            # populate header information
-            vol_tei.create_header()
-            vol_tei.header.title = self.title
-            # publication statement
-            vol_tei.distributor = settings.TEI_DISTRIBUTOR
-            vol_tei.pubstmt.distributor_readux = 'Readux'
-            vol_tei.pubstmt.desc = 'TEI facsimile generated by Readux version %s' % __version__
-            # source description - original publication
-            vol_tei.create_original_source()
-            vol_tei.original_source.title = self.title
-            # original publication date
-            if self.date:
-                vol_tei.original_source.date = self.date[0]
-            # if authors are set, it should be a list
-            if self.creator:
-                vol_tei.original_source.authors = self.creator
-            # source description - digital edition
-            vol_tei.create_digital_source()
-            vol_tei.digital_source.title = '%s, digital edition' % self.title
-            vol_tei.digital_source.date = self.digital_ed_date
-            # FIXME: ideally, these would be ARKs, but ARKs for readux volume
-            # content do not yet resolve to Readux urls
-            vol_tei.digital_source.url = absolutize_url(self.get_absolute_url())
-            vol_tei.digital_source.pdf_url = absolutize_url(self.pdf_url())
-
-            # loop through pages and add tei content
-            # for page in self.pages[:10]:   # FIXME: temporary, for testing/speed
-            page_order = 1
-            for page in self.pages:
-                if page.tei.exists and page.tei.content.page:
-                    # include facsimile page *only* from the tei for each page
-                    # tei facsimile already includes a graphic url
-                    teipage = page.tei.content.page
-
-                    # add a reference from tei page to readux page
-                    # pages should have ARKS; fall back to readux url if
-                    # ark is not present (only expected to happen in dev)
-                    teipage.href = page.ark_uri or absolutize_url(page.get_absolute_url())
-                    # NOTE: generating ark_uri currently requires loading
-                    # DC from fedora; could we generate reliably based on the pid?
-
-                    # teipage.n = page.page_order
-                    teipage.n = page_order
-                    # NOTE: normally we would use page.page_order, but that
-                    # requires an additional api call for each page
-                    # to load the rels-ext, so use a local counter instead
-
-                    # ensure graphic elements are present for image variants
-                    # full size, page size, thumbnail, and deep zoom variants
-                    # NOTE: graphic elements need to come immediately after
-                    # surface and before zone; adding them before removing
-                    # existing graphic element should place them correctly.
-
-                    # mapping of types we want in the tei and
-                    # corresponding mode to pass to the url
-                    image_types = {
-                        'full': 'fs',
-                        'page': 'single-page',
-                        'thumbnail': 'thumbnail',
-                        'small-thumbnail': 'mini-thumbnail',
-                        'json': 'info',
-                    }
-                    for image_type, mode in image_types.iteritems():
-                        teipage.graphics.append(tei.Graphic(rend=image_type,
-                            url=absolutize_url(reverse('books:page-image',
-                                kwargs={'vol_pid': self.pid, 'pid': page.pid, 'mode': mode}))),
-                        )
-
-                    # page tei should have an existing graphic reference
-                    # remove it from our output
-                    if teipage.graphics[0].rend is None:
-                        del teipage.graphics[0]
-
-                    vol_tei.page_list.append(teipage)
-
-                    page_order += 1
+            vol_tei = self.volume_tei_header()
+
+            # add tei content for each page
+            for page_order, teipage in enumerate(self.iter_page_tei_fragments(), 1):
+                # NOTE: normally we would use page.page_order, but
+                # numbering pages sequentially based only on pages with
+                # tei content preserves the numbering used in previous exports
+                teipage.n = page_order
+                vol_tei.page_list.append(teipage)
 
             logger.info('Volume TEI for %s with %d pages generated in %.02fs' %  \
-                (self.pid, len(self.pages), time.time() - start))
+                (self.pid, len(self.page_manifest), time.time() - start))
 
         # update current date for either version (new or cached)
         # store current date (tei generation) in publication statement
@@ -1054,9 +1250,216 @@ class Volume(DigitalObject, BaseVolume):
         # save current volume tei in django cache
         cache.set(cache_key, vol_tei.serialize(), 3000)
 
+        return vol_tei
 
+    def volume_tei_header(self):
+        '''Initialize a new :class:`readux.books.tei.Facsimile` with
+        the TEI header populated based on volume metadata.'''
+        vol_tei = tei.Facsimile()
+        # populate header information
+        vol_tei.create_header()
+        vol_tei.header.title = self.title
+        # publication statement
+        vol_tei.distributor = settings.TEI_DISTRIBUTOR
+        vol_tei.pubstmt.distributor_readux = 'Readux'
+        vol_tei.pubstmt.desc = 'TEI facsimile generated by Readux version %s' % __version__
+        # source description - original publication
+        vol_tei.create_original_source()
+        vol_tei.original_source.title = self.title
+        # original publication date
+        if self.date:
+            vol_tei.original_source.date = self.date[0]
+        # if authors are set, it should be a list
+        if self.creator:
+            vol_tei.original_source.authors = self.creator
+        # source description - digital edition
+        vol_tei.create_digital_source()
+        vol_tei.digital_source.title = '%s, digital edition' % self.title
+        vol_tei.digital_source.date = self.digital_ed_date
+        # FIXME: ideally, these would be ARKs, but ARKs for readux volume
+        # content do not yet resolve to Readux urls
+        vol_tei.digital_source.url = absolutize_url(self.get_absolute_url())
+        vol_tei.digital_source.pdf_url = absolutize_url(self.pdf_url())
         return vol_tei
 
+    def page_tei_cache_key(self, page_info):
+        '''Cache key for the TEI fragment for a single page, based on
+        the page pid and modification date.  Returns None if the page
+        modification date is not known.
+
+        :param page_info: :class:`ManifestPage`
+        '''
+        if page_info.last_modified:
+            return '%s-tei-page-%s-%s' % (self.pid, page_info.pid,
+                                          page_info.last_modified)
+
+    def page_tei_fragments(self):
+        '''Generate a list of TEI facsimile page surfaces (as
+        :class:`readux.books.tei.Zone`) for all pages in this volume with
+        TEI, in page order.  See :meth:`iter_page_tei_fragments`.'''
+        return list(self.iter_page_tei_fragments())
+
+    #: number of pages to load and cache at once when
+    #: generating page TEI fragments
+    page_tei_batch_size = 50
+
+    def iter_page_tei_fragments(self):
+        '''Generator of TEI facsimile page surfaces (as
+        :class:`readux.books.tei.Zone`) for all pages in this volume with
+        TEI, in page order.  Page fragments are cached by page modification
+        date, so only pages that are new or have changed since the last
+        time volume TEI was generated are loaded from Fedora.  Pages
+        that need to be loaded are fetched concurrently (see
+        :attr:`page_tei_fetch_threads`).  Pages are processed in batches
+        of :attr:`page_tei_batch_size`, so that only one batch of pages
+        needs to be held in memory at a time.'''
+        pages = self.page_manifest.tei_pages
+        for i in range(0, len(pages), self.page_tei_batch_size):
+            for teipage in self._page_tei_batch(pages[i:i + self.page_tei_batch_size]):
+                yield teipage
+
+    def _page_tei_batch(self, pages):
+        # load tei fragments for a batch of pages from the cache or fedora
+        cache_keys = dict((p.pid, self.page_tei_cache_key(p)) for p in pages)
+        # retrieve all available fragments with a single cache request
+        cached = cache.get_many([key for key in cache_keys.itervalues() if key])
+
+        # load tei for any pages not in the cache from fedora
+        to_fetch = [p for p in pages if cache_keys[p.pid] not in cached]
+        fetched = dict(zip([p.pid for p in to_fetch],
+                           self.fetch_page_tei_list(to_fetch)))
+        updated = {}
+
+        fragments = []
+        for page_info in pages:
+            key = cache_keys[page_info.pid]
+            if key in cached:
+                # empty string indicates a page with no tei facsimile page
+                if cached[key]:
+                    fragments.append(xmlmap.load_xmlobject_from_string(
+                        cached[key], tei.Zone))
+                continue
+
+            teipage = fetched[page_info.pid]
+            if teipage is not None:
+                self.assemble_page_tei(teipage, page_info)
+                fragments.append(teipage)
+            if key is not None:
+                updated[key] = teipage.serialize() if teipage is not None else ''
+
+        if updated:
+            logger.debug('Caching TEI for %d pages in %s', len(updated), self.pid)
+            cache.set_many(updated, self.page_tei_cache_timeout)
+
+        return fragments
+
+    #: maximum number of threads to use when loading page TEI from Fedora
+    page_tei_fetch_threads = getattr(settings, 'PAGE_TEI_FETCH_THREADS', 8)
+
+    def fetch_page_tei_list(self, pages):
+        '''Load TEI for a list of pages from Fedora using a bounded pool
+        of threads (see :attr:`page_tei_fetch_threads`).  Returns a list
+        of the results of :meth:`fetch_page_tei` in the same order as
+        the list of pages.
+
+        :param pages: list of :class:`ManifestPage`
+        '''
+        threads = min(len(pages), self.page_tei_fetch_threads)
+        if threads <= 1:
+            return [self.fetch_page_tei(p) for p in pages]
+
+        pool = ThreadPool(threads)
+        try:
+            # map returns results in the order of the input list
+            return pool.map(self.fetch_page_tei, pages)
+        finally:
+            pool.close()
+            pool.join()
+
+    def fetch_page_tei(self, page_info):
+        '''Load TEI for a single page from Fedora.  Returns the TEI
+        facsimile page surface as a :class:`readux.books.tei.Zone`,
+        or None if the page TEI does not include one.
+
+        :param page_info: :class:`ManifestPage`
+        '''
+        # include facsimile page *only* from the tei for each page
+        return Page(self.api, page_info.pid).tei.content.page
+
+    #: list of image types to include in page TEI and the
+    #: corresponding mode to pass to the page image url:
+    #: full size, page size, thumbnail, and deep zoom variants
+    tei_image_types = [
+        ('full', 'fs'),
+        ('page', 'single-page'),
+        ('thumbnail', 'thumbnail'),
+        ('small-thumbnail', 'mini-thumbnail'),
+        ('json', 'info'),
+    ]
+
+    #: placeholder used to generate page url templates
+    _page_pid_placeholder = '__page_pid__'
+    _page_url_templates = None
+
+    @property
+    def page_url_templates(self):
+        '''Dictionary of absolute page urls for this volume with a
+        placeholder for the page pid (see :meth:`page_url`), so that
+        urls can be generated for all pages in a volume without
+        resolving urls for each page.  Keys are ``page`` for the
+        page detail url and the image modes in :attr:`tei_image_types`.'''
+        if self._page_url_templates is None:
+            kwargs = {'vol_pid': self.pid, 'pid': self._page_pid_placeholder}
+            templates = {
+                'page': absolutize_url(reverse('books:page', kwargs=kwargs))
+            }
+            for image_type, mode in self.tei_image_types:
+                templates[mode] = absolutize_url(reverse('books:page-image',
+                    kwargs=dict(kwargs, mode=mode)))
+            self._page_url_templates = templates
+        return self._page_url_templates
+
+    def page_url(self, name, pid):
+        '''Generate an absolute url for a page in this volume
+        from :attr:`page_url_templates`.'''
+        return self.page_url_templates[name].replace(
+            self._page_pid_placeholder, pid)
+
+    def assemble_page_tei(self, teipage, page_info):
+        '''Prepare page TEI for inclusion in the volume TEI: set
+        a reference to the page ARK and add graphic elements for the
+        available image variants.  Graphic elements are generated directly
+        on the underlying lxml node using :attr:`page_url_templates`.
+
+        :param teipage: :class:`readux.books.tei.Zone`
+        :param page_info: :class:`ManifestPage`
+        '''
+        # add a reference from tei page to readux page
+        # pages should have ARKS; fall back to readux url if
+        # ark is not present (only expected to happen in dev)
+        teipage.href = page_info.ark_uri or \
+            self.page_url('page', page_info.pid)
+
+        # ensure graphic elements are present for image variants
+        # NOTE: graphic elements need to come immediately after
+        # surface and before zone, so insert them after any existing
+        # graphic elements
+        node = teipage.node
+        graphic_tag = '{%s}graphic' % tei.TeiBase.ROOT_NS
+        existing = node.findall(graphic_tag)
+        index = node.index(existing[-1]) + 1 if existing else 0
+        for image_type, mode in self.tei_image_types:
+            node.insert(index, etree.Element(graphic_tag, rend=image_type,
+                url=self.page_url(mode, page_info.pid)))
+            index += 1
+
+        # page tei should have an existing graphic reference
+        # remove it from our output
+        if existing and existing[0].get('rend') is None:
+            node.remove(existing[0])
+
+        return teipage
+
 
 class VolumeV1_0(Volume):
     '''Fedora object for ScannedVolume-1.0.  Extends :class:`Volume`.
@@ -1235,6 +1638,18 @@ class SolrPage(UserDict):
         'object pid'
         return self.data.get('pid')
 
+    @property
+    def width(self):
+        'image width, if indexed'
+        if self.data.get('image_width'):
+            return int(self.data['image_width'])
+
+    @property
+    def height(self):
+        'image height, if indexed'
+        if self.data.get('image_height'):
+            return int(self.data['image_height'])
+
     def thumbnail_url(self):
         'IIIF thumbnail url'
         return self.iiif.thumbnail()
@@ -1,7 +1,7 @@
 from django.contrib.sitemaps import Sitemap
 from django.core.urlresolvers import reverse
 
-from readux.utils import solr_interface
+from readux.utils import solr_interface, solr_cursor
 from readux.books.models import Volume, Page
 
 class _BaseVolumeSitemap(Sitemap):
@@ -13,6 +13,10 @@ class _BaseVolumeSitemap(Sitemap):
         return solr.query(content_model=Volume.VOLUME_CMODEL_PATTERN) \
                    .field_limit(['pid', 'last_modified'])
 
+    def iter_items(self):
+        # all items, using a solr cursor; used to pre-generate sitemaps
+        return solr_cursor(self.items())
+
     def lastmod(self, item):
         return item['last_modified']
 
@@ -46,6 +50,10 @@ class VolumePageSitemap(Sitemap):
                    .field_limit(['pid', 'last_modified',
                                  'isConstituentOf'])
 
+    def iter_items(self):
+        # all items, using a solr cursor; used to pre-generate sitemaps
+        return solr_cursor(self.items())
+
     def lastmod(self, item):
         return item['last_modified']
 
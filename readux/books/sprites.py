@@ -0,0 +1,213 @@
+'''Thumbnail sprite sheets, for displaying a grid of page thumbnails or
+volume covers with a single image request instead of one request per
+thumbnail.
+
+Sprite sheet urls are signed, so that the sprite view only generates
+sprite sheets for lists of pages selected by the site (each sprite
+sheet requires a request to the IIIF server for every image).'''
+
+from collections import OrderedDict
+from cStringIO import StringIO
+import hashlib
+import logging
+from multiprocessing.pool import ThreadPool
+import re
+import time
+from urllib import urlencode
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.utils.crypto import constant_time_compare
+from PIL import Image, ImageOps
+import requests
+
+from readux.books.models import IIIFImage
+from readux.utils import iiif_session
+
+
+logger = logging.getLogger(__name__)
+
+
+class SpriteSheet(object):
+    '''A sprite sheet combining thumbnails for a list of page images
+    into a single image, laid out in a grid of equal-sized cells.
+    Images are placed in pid order, so that the same set of pages always
+    generates the same sprite sheet; use :meth:`position` or the offset
+    map from :meth:`render` to display each image.
+
+    :param pids: list of page pids
+    :param mode: thumbnail mode; one of :attr:`cell_sizes`
+    :param layout: layout for the thumbnails; one of :attr:`cell_sizes`
+    '''
+
+    #: cell size (width, height) for each thumbnail mode and layout;
+    #: thumbnail cells match the display size of covers in the cover
+    #: list view
+    cell_sizes = {
+        'thumbnail': {'default': (200, 250), 'landscape': (350, 220)},
+        'mini-thumbnail': {'default': (100, 100)},
+    }
+    #: size of the long edge of the image to request from the IIIF server
+    image_sizes = {'thumbnail': 300, 'mini-thumbnail': 100}
+    #: modes where thumbnails are cropped to fill the cell (as with css
+    #: background-size: cover); in other modes thumbnails are scaled to
+    #: fit and placed at the top left corner of the cell
+    crop_modes = ['thumbnail']
+    #: background color for cells with no image
+    background = '#EEEEEE'
+    #: number of cells in each row
+    columns = 10
+    #: maximum number of images in a single sprite sheet
+    max_images = 60
+    #: pattern for valid pids (based on the Fedora pid syntax)
+    pid_re = re.compile(r'^[A-Za-z0-9.-]+:([A-Za-z0-9.~_-]|%[0-9A-F]{2})+$')
+    #: salt for sprite url signatures
+    signature_salt = 'readux.books.sprites'
+
+    def __init__(self, pids, mode='thumbnail', layout='default'):
+        if mode not in self.cell_sizes:
+            raise ValueError('Unsupported sprite mode %s' % mode)
+        if layout not in self.cell_sizes[mode]:
+            raise ValueError('Unsupported sprite layout %s' % layout)
+        if not pids or len(pids) > self.max_images:
+            raise ValueError('Sprite requires between 1 and %d images' \
+                             % self.max_images)
+        for pid in pids:
+            if not self.pid_re.match(pid):
+                raise ValueError('Invalid pid %s' % pid)
+        self.pids = sorted(set(pids))
+        self.mode = mode
+        self.layout = layout
+        self.cell_width, self.cell_height = self.cell_sizes[mode][layout]
+
+    @property
+    def cache_timeout(self):
+        'timeout for cached sprite sheets; configure with SPRITE_CACHE_TIMEOUT'
+        return getattr(settings, 'SPRITE_CACHE_TIMEOUT', 60 * 60 * 24)
+
+    @property
+    def fetch_threads(self):
+        '''number of thumbnails to request from the IIIF server in
+        parallel; configure with SPRITE_FETCH_THREADS'''
+        return getattr(settings, 'SPRITE_FETCH_THREADS', 8)
+
+    def _value(self):
+        # canonical representation of the sprite sheet contents
+        return '|'.join([self.mode, self.layout] + self.pids)
+
+    @property
+    def cache_key(self):
+        'cache key for the rendered sprite sheet'
+        return 'sprite-%s' % hashlib.md5(self._value()).hexdigest()
+
+    @property
+    def signature(self):
+        'signature for the sprite sheet url, based on the secret key'
+        return signing.Signer(salt=self.signature_salt).signature(self._value())
+
+    def valid_signature(self, signature):
+        'Check that a signature from a sprite sheet url is valid'
+        return constant_time_compare(signature or '', self.signature)
+
+    @property
+    def size(self):
+        'total size (width, height) of the sprite sheet image'
+        rows = (len(self.pids) - 1) / self.columns + 1
+        return (self.cell_width * min(len(self.pids), self.columns),
+                self.cell_height * rows)
+
+    def url(self, format='jpg'):
+        '''signed url for the sprite image (or offset map, if format is
+        json)'''
+        params = [('pid', pid) for pid in self.pids]
+        if self.layout != 'default':
+            params.insert(0, ('layout', self.layout))
+        params.append(('sig', self.signature))
+        return '%s?%s' % (reverse('books:sprite',
+            kwargs={'mode': self.mode, 'format': format}), urlencode(params))
+
+    def offset(self, pid):
+        'offset (x, y) of the cell for the specified pid'
+        index = self.pids.index(pid)
+        return ((index % self.columns) * self.cell_width,
+                (index / self.columns) * self.cell_height)
+
+    def position(self, pid):
+        '''css background position for displaying the image for the
+        specified pid from the sprite sheet'''
+        return '-%dpx -%dpx' % self.offset(pid)
+
+    def image_url(self, pid):
+        'IIIF url for the thumbnail to be included in the sprite sheet'
+        size = self.image_sizes[self.mode]
+        return unicode(IIIFImage(pid=pid).size(width=size, height=size,
+                                               exact=True))
+
+    def fetch_image(self, pid):
+        '''Retrieve a thumbnail image from the IIIF server; returns
+        a :class:`PIL.Image.Image` or None if the image could not be
+        loaded.'''
+        url = self.image_url(pid)
+        try:
+            response = iiif_session().get(url)
+            if response.status_code == requests.codes.ok:
+                img = Image.open(StringIO(response.content))
+                img.load()
+                return img
+            logger.warn('Error retrieving %s for sprite: %s',
+                        url, response.status_code)
+        except requests.exceptions.RequestException as err:
+            logger.warn('Error retrieving %s for sprite: %s', url, err)
+        except IOError as err:
+            logger.warn('Error loading %s for sprite: %s', url, err)
+
+    def fetch_images(self):
+        'Retrieve all thumbnail images, in order, in parallel'
+        pool = ThreadPool(min(self.fetch_threads, len(self.pids)))
+        try:
+            return pool.map(self.fetch_image, self.pids)
+        finally:
+            pool.close()
+
+    def render(self):
+        '''Generate the sprite sheet.  Returns a tuple of JPEG image data
+        and an offset map, as an :class:`collections.OrderedDict` of pid
+        to a dictionary with x, y, width and height of the image within
+        the sprite sheet; pids for images that could not be loaded are
+        not included in the offset map.  Results are cached, and
+        thumbnails are only requested from the IIIF server when the
+        sprite sheet is not already cached.'''
+        cached = cache.get(self.cache_key)
+        if cached is not None:
+            return cached
+
+        start = time.time()
+        sprite = Image.new('RGB', self.size, self.background)
+        offsets = OrderedDict()
+        cell = (self.cell_width, self.cell_height)
+        for pid, img in zip(self.pids, self.fetch_images()):
+            if img is None:
+                continue
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            if self.mode in self.crop_modes:
+                img = ImageOps.fit(img, cell, Image.ANTIALIAS)
+            else:
+                img.thumbnail(cell, Image.ANTIALIAS)
+            x, y = self.offset(pid)
+            sprite.paste(img, (x, y))
+            offsets[pid] = {'x': x, 'y': y, 'width': img.size[0],
+                            'height': img.size[1]}
+
+        output = StringIO()
+        sprite.save(output, 'JPEG', quality=85)
+        result = (output.getvalue(), offsets)
+        # don't cache a sprite sheet with missing images, so that
+        # they can be retried on the next request
+        if len(offsets) == len(self.pids):
+            cache.set(self.cache_key, result, self.cache_timeout)
+        logger.debug('Generated %s sprite with %d images in %.02fs',
+                     self.mode, len(offsets), time.time() - start)
+        return result
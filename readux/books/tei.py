@@ -284,7 +284,14 @@ class AnnotatedFacsimile(Facsimile):
         InterpGroup)
 
 
+    #: optional dictionary of page xml ids keyed on page xlink href,
+    #: used by :meth:`page_id_by_xlink` when pages are not included in
+    #: the document (i.e., when annotated TEI is streamed page by page)
+    page_ids = None
+
     def page_id_by_xlink(self, link):
+        if self.page_ids is not None:
+            return self.page_ids.get(link)
         results = self.node.xpath('//tei:surface[@type="page"][@xlink:href="%s"]/@xml:id' \
             % link, namespaces=self.ROOT_NAMESPACES)
         if results:
@@ -0,0 +1,104 @@
+'''Methods to generate volume TEI and annotated TEI incrementally, so
+that TEI for large volumes can be streamed as a download without building
+the entire document in memory.'''
+
+from datetime import datetime
+import logging
+import time
+from lxml import etree
+
+from readux.books import annotate, tei
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkWriter(object):
+    '''Minimal file-like object for use with :class:`lxml.etree.xmlfile`;
+    collects written content so it can be returned in chunks.'''
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def read(self):
+        'Return and clear all content written since the last read'
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_volume_tei(vol, annotations=None):
+    '''Generator that yields a TEI facsimile document for a volume in
+    chunks of serialized XML.  The TEI header is generated first, and
+    then each page surface is written as it is loaded, so only one batch
+    of pages is held in memory at a time (see
+    :meth:`readux.books.models.Volume.iter_page_tei_fragments`).  Output
+    should be equivalent to :meth:`readux.books.models.Volume.generate_volume_tei`
+    (and :meth:`readux.books.annotate.annotated_tei`, if annotations are
+    specified), but without pretty-printing.
+
+    :param vol: :class:`~readux.books.models.Volume`
+    :param annotations: optional
+        :class:`~readux.annotations.models.Annotation` queryset; if
+        specified, annotated TEI will be generated.  Annotation notes
+        are added at the end of the document, after all pages.
+    '''
+    start = time.time()
+    teivol = vol.volume_tei_header()
+    # store current date (tei generation) in publication statement
+    export_date = datetime.now()
+    teivol.pubstmt.date = export_date
+    teivol.pubstmt.date_normal = export_date
+
+    notes = []
+    if annotations is not None:
+        teivol = annotate.annotate_tei_header(teivol, annotations)
+        # load all annotations once, grouped by page
+        annotations = annotate.PageAnnotationIndex(annotations)
+        # pages are not kept in the document, so track page ids
+        # for generating related page references in annotation notes
+        teivol.page_ids = {}
+
+    out = ChunkWriter()
+    root = teivol.node
+    facsimile_tag = '{%s}facsimile' % tei.TeiBase.ROOT_NS
+    page_count = 0
+
+    with etree.xmlfile(out, encoding='UTF-8') as xf:
+        xf.write_declaration()
+        with xf.element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap):
+            # tei header
+            header = list(root)
+            for child in header:
+                xf.write(child)
+            xf.flush()
+            yield out.read()
+
+            with xf.element(facsimile_tag):
+                for teipage in vol.iter_page_tei_fragments():
+                    page_count += 1
+                    # number pages sequentially based only on pages
+                    # with tei content, as in generate_volume_tei
+                    teipage.n = page_count
+                    if annotations is not None:
+                        notes.extend(annotate.annotate_page(teipage, annotations))
+                        if teipage.href:
+                            teivol.page_ids[teipage.href] = teipage.id
+                    xf.write(teipage.node)
+                    xf.flush()
+                    yield out.read()
+
+            # annotation notes, bibliography and tags are added
+            # after all pages have been processed
+            if annotations is not None:
+                annotate.add_annotation_notes(teivol, notes)
+                for child in root:
+                    if child not in header:
+                        xf.write(child)
+
+    yield out.read()
+    logger.info('Streamed TEI for %s with %d pages in %.02fs',
+                vol.pid, page_count, time.time() - start)
@@ -0,0 +1,15 @@
+'''
+Custom template filters for displaying thumbnails from a
+:class:`readux.books.sprites.SpriteSheet`.
+'''
+
+from django import template
+
+register = template.Library()
+
+
+@register.filter
+def sprite_position(sprite, pid):
+    '''CSS background position for displaying the thumbnail for a page
+    from a sprite sheet, e.g. ``{{ sprite|sprite_position:page.pid }}``.'''
+    return sprite.position(pid)
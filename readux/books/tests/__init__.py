@@ -5,6 +5,10 @@ from readux.books.tests.views import *
 from readux.books.tests.tei import *
 from readux.books.tests.annotate import *
 from readux.books.tests.markdown_tei import *
+from readux.books.tests.tei_stream import *
+from readux.books.tests.image_cache import *
+from readux.books.tests.sprites import *
+from readux.books.tests.warm_cache import *
 
 
 
@@ -2,6 +2,7 @@
 import datetime
 from django.contrib.auth import get_user_model
 from django.test import TestCase
+from django.test.utils import override_settings
 from eulxml.xmlmap import load_xmlobject_from_file
 import json
 from lxml import etree
@@ -11,7 +12,8 @@ from readux import __version__
 from readux.annotations.models import Annotation
 from readux.books import tei
 from readux.books.annotate import annotation_to_tei, insert_anchor, \
-    annotated_tei, consolidate_bibliography
+    annotated_tei, consolidate_bibliography, PageAnnotationIndex, \
+    PageIdIndex, html_xpath_to_tei
 from readux.books.tests.models import FIXTURE_DIR
 
 
@@ -220,6 +222,63 @@ la la la foo bar lala
         # encoding desc should be present
         self.assert_(annotei.encoding_desc)
 
+    @override_settings(DEV_ENV=False)
+    def test_page_annotation_index(self):
+        page_uri = 'http://readux.co/books/pages/some:1/'
+        ark = 'http://pid.co/ark:/1234/11'
+        note = Annotation(text='note on page 1', uri=page_uri,
+            extra_data=json.dumps({'ark': ark}))
+        note.save()
+        related = Annotation(text='related to page 1',
+            uri='http://readux.co/books/pages/some:2/',
+            extra_data=json.dumps({'ark': 'http://pid.co/ark:/1234/12',
+                                   'related_pages': [ark]}))
+        related.save()
+
+        # annotations should be loaded with a single query
+        with self.assertNumQueries(1):
+            index = PageAnnotationIndex(Annotation.objects.all())
+            notes = index.for_page(ark)
+        self.assertEqual([note.id], [n.id for n, info in notes])
+        self.assertEqual(ark, notes[0][1]['ark'])
+        # local uri matches only in dev mode
+        self.assertEqual([], index.for_page(page_uri))
+        with override_settings(DEV_ENV=True):
+            self.assertEqual([note.id],
+                [n.id for n, info in index.for_page(page_uri)])
+
+    def test_page_id_index(self):
+        teidoc = load_xmlobject_from_file(os.path.join(FIXTURE_DIR, 'teifacsimile.xml'),
+            tei.AnnotatedFacsimile)
+        index = PageIdIndex(teidoc.page)
+        zone_id = 'fnstr.idm320760248608'
+        self.assert_(zone_id in index.ids)
+
+        # div by id with numbered span resolves to word in the zone
+        el = index.resolve('//div[@id="%s"]/span[1]' % zone_id, '//tei:zone[1]')
+        self.assertEqual('RUDIMENTS', el.text)
+        # div without span resolves to the zone itself
+        el = index.resolve('//div[@id="%s"]' % zone_id, '//tei:zone[1]')
+        self.assertEqual(zone_id, el.get('{http://www.w3.org/XML/1998/namespace}id'))
+        # unknown id or span index not found
+        self.assertEqual(None, index.resolve('//div[@id="bogus"]/span[1]', '//tei:zone[1]'))
+        self.assertEqual(None,
+            index.resolve('//div[@id="%s"]/span[5]' % zone_id, '//tei:zone[1]'))
+
+        # results should match the equivalent tei xpath
+        html_xpath = '//div[@id="fntln.idm320760250272"]/span[1]'
+        expected = teidoc.page.node.xpath(html_xpath_to_tei(html_xpath),
+            namespaces=tei.Zone.ROOT_NAMESPACES)[0]
+        self.assertEqual(expected, index.resolve(html_xpath, '//tei:zone[1]'))
+
+        # empty or unusual xpaths use xpath fallback
+        first_zone = teidoc.page.node.xpath('//tei:zone[1]',
+            namespaces=tei.Zone.ROOT_NAMESPACES)[0]
+        self.assertEqual(first_zone, index.resolve('', '//tei:zone[1]'))
+        self.assertEqual(expected,
+            index.resolve('//div[@id="fntln.idm320760250272"]/span[position()=1]',
+                          '//tei:zone[1]'))
+
     def test_consolidate_bibl(self):
         teidoc = load_xmlobject_from_file(os.path.join(FIXTURE_DIR,
                                                        'teifacsimile.xml'),
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import time
+from django.test import TestCase
+from mock import patch
+
+from readux.books.image_cache import DerivativeCache
+
+
+class DerivativeCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = DerivativeCache(self.cache_dir, 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_key(self):
+        key = self.cache.key('page:1', 'thumbnail', None, 'abc')
+        self.assertEqual(key, self.cache.key('page:1', 'thumbnail', '', 'abc'))
+        self.assertNotEqual(key, self.cache.key('page:1', 'thumbnail', None, 'def'))
+        self.assertNotEqual(key, self.cache.key('page:1', 'info', None, 'abc'))
+        self.assertNotEqual(key, self.cache.key('page:2', 'thumbnail', None, 'abc'))
+
+    def test_put_get(self):
+        key = self.cache.key('page:1', 'thumbnail', None, 'abc')
+        self.assertEqual(None, self.cache.get(key))
+        entry = self.cache.put(key, ['abc', 'def'], 'image/jpeg')
+        self.assertEqual(6, entry.size)
+        self.assertEqual(key, entry.etag)
+        with open(entry.path) as cached:
+            self.assertEqual('abcdef', cached.read())
+
+        entry = self.cache.get(key)
+        self.assertEqual('image/jpeg', entry.content_type)
+        self.assertEqual(6, entry.size)
+        # no temporary files left behind
+        self.assertEqual([key, '%s.json' % key],
+                         sorted(os.listdir(os.path.dirname(entry.path))))
+
+        # replacing an entry only counts the change in size
+        self.assertEqual(6, self.cache.size())
+        self.cache.put(key, ['abcd'], 'image/jpeg')
+        self.assertEqual(4, self.cache.size())
+        self.assertEqual(4, self.cache.get(key).size)
+
+        # error writing content should not leave a partial entry
+        def failing_chunks():
+            yield 'abc'
+            raise IOError
+        key = self.cache.key('page:2', 'thumbnail', None, 'abc')
+        self.assertRaises(IOError, self.cache.put, key, failing_chunks(),
+                          'image/jpeg')
+        self.assertEqual(None, self.cache.get(key))
+        self.assertFalse(os.listdir(os.path.dirname(self.cache.path(key))))
+
+    def test_evict(self):
+        keys = [self.cache.key('page:%d' % i, 'thumbnail', None, 'abc')
+                for i in range(3)]
+        entries = [self.cache.put(key, ['abcd'], 'image/jpeg') for key in keys[:2]]
+        self.assertEqual(8, self.cache.size())
+        # set first entry as older, then access it so it is most recently used
+        past = time.time() - 60
+        for entry in entries:
+            os.utime(entry.path, (past, past))
+        os.utime(entries[1].path, (past - 60, past - 60))
+        self.cache.get(keys[0])
+
+        # adding another entry exceeds the size limit;
+        # least-recently used entry should be removed
+        self.cache.put(keys[2], ['abcd'], 'image/jpeg')
+        self.assertEqual(8, self.cache.size())
+        self.assertNotEqual(None, self.cache.get(keys[0]))
+        self.assertEqual(None, self.cache.get(keys[1]))
+        self.assertNotEqual(None, self.cache.get(keys[2]))
+
+    def test_evict_low_water(self):
+        cache = DerivativeCache(self.cache_dir, 100)
+        keys = [cache.key('page:%d' % i, 'thumbnail', None, 'abc')
+                for i in range(12)]
+        for key in keys[:10]:
+            cache.put(key, ['a' * 10], 'image/jpeg')
+        self.assertEqual(100, cache.size())
+
+        # exceeding the limit evicts down to the low-water mark
+        cache.put(keys[10], ['a' * 10], 'image/jpeg')
+        self.assertEqual(90, cache.size())
+
+        # so that the next entries can be added without another eviction
+        with patch.object(cache, 'evict') as mockevict:
+            cache.put(keys[11], ['a' * 10], 'image/jpeg')
+            self.assertEqual(0, mockevict.call_count)
+        self.assertEqual(100, cache.size())
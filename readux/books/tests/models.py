@@ -2,9 +2,10 @@ import os
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.test import TestCase
-from mock import patch, Mock
+from mock import patch, Mock, MagicMock
 import re
 import rdflib
 from rdflib import RDF
@@ -16,8 +17,9 @@ from eulfedora.server import Repository
 from readux.annotations.models import Annotation
 from readux.books import abbyyocr
 from readux.books.models import SolrVolume, Volume, VolumeV1_0, Book, BIBO, \
-    DC, Page, PageV1_1
-from readux.books import iiif
+    DC, Page, PageV1_1, ManifestPage, VolumePageManifest, VolumePageSequence
+from readux.books import iiif, tei
+from readux import versions
 
 
 FIXTURE_DIR = os.path.join(settings.BASE_DIR, 'readux', 'books', 'fixtures')
@@ -173,15 +175,178 @@ class VolumeTest(TestCase):
     def test_has_tei(self):
         mockapi = Mock()
         vol = Volume(mockapi, 'vol:1')
-        p1 = Mock(spec=Page)
-        p1.tei.exists = False
-        p2 = Mock(spec=Page)
-        p2.tei.exists = False
-        vol.pages = [p1, p2]
+        p1 = ManifestPage('page:1', 1)
+        p2 = ManifestPage('page:2', 2)
+        vol._page_manifest = [p1, p2]
         self.assertFalse(vol.has_tei)
-        p2.tei.exists = True
+        p2.has_tei = True
         self.assertTrue(vol.has_tei)
 
+    def test_page_manifest(self):
+        mockapi = Mock()
+        vol = Volume(mockapi, 'vol:1')
+        # simulate risearch tuple results: one row per combination
+        # of page and optional values
+        rows = [
+            {'page': 'info:fedora/page:2', 'order': '2',
+             'ark': 'http://pid.co/ark:/1234/p2', 'ds': 'info:fedora/page:2/tei'},
+            {'page': 'info:fedora/page:2', 'order': '2',
+             'ark': 'http://pid.co/ark:/1234/p2', 'ds': 'info:fedora/page:2/text'},
+            {'page': 'info:fedora/page:1', 'order': '1', 'ark': '',
+             'ds': 'info:fedora/page:1/text'},
+            {'page': 'info:fedora/page:3', 'order': '', 'ark': '', 'ds': ''},
+        ]
+        with patch.object(Volume, 'risearch', new=Mock()) as mockrisearch:
+            mockrisearch.find_statements.return_value = rows
+            manifest = vol.page_manifest
+
+            self.assertEqual(1, mockrisearch.find_statements.call_count,
+                'manifest should be generated with a single query')
+            args, kwargs = mockrisearch.find_statements.call_args
+            self.assert_(vol.uri in args[0])
+            self.assertEqual('sparql', kwargs['language'])
+
+        self.assertEqual(3, len(manifest))
+        # sorted by page order, pages with no order at the end
+        self.assertEqual(['page:1', 'page:2', 'page:3'],
+                         [p.pid for p in manifest])
+        self.assertEqual(1, manifest[0].page_order)
+        self.assertEqual(None, manifest[0].ark_uri)
+        self.assertTrue(manifest[0].has_ocr)
+        self.assertFalse(manifest[0].has_tei)
+        self.assertEqual('http://pid.co/ark:/1234/p2', manifest[1].ark_uri)
+        self.assertTrue(manifest[1].has_ocr)
+        self.assertTrue(manifest[1].has_tei)
+        self.assertEqual(None, manifest[2].page_order)
+        self.assertEqual(['page:2'], [p.pid for p in manifest.tei_pages])
+        # cached on the volume
+        self.assertEqual(manifest, vol.page_manifest)
+
+    @patch('readux.books.models.solr_interface')
+    def test_page_sequence(self, mocksolr_interface):
+        cache.clear()
+        mocksolr = mocksolr_interface.return_value
+        mockquery = mocksolr.query.return_value
+        mockquery.filter.return_value = mockquery
+        mockquery.sort_by.return_value = mockquery
+        mockquery.field_limit.return_value = mockquery
+        mockquery.count.return_value = 3
+        mockquery.paginate.return_value.execute.return_value = self.solr_response([
+            {'pid': 'page:1', 'page_order': 1},
+            {'pid': 'page:2', 'page_order': 2},
+            {'pid': 'page:3', 'page_order': 3},
+        ])
+
+        pages = VolumePageSequence('vol:1')
+        mocksolr.query.assert_called_with(isConstituentOf='info:fedora/vol:1')
+        mockquery.paginate.assert_called_with(rows=3)
+        self.assertEqual(3, len(pages))
+        self.assertEqual(1, pages.position('page:2'))
+        self.assertEqual(None, pages.position('page:4'))
+        self.assertEqual({'pid': 'page:2', 'page_order': 2},
+                         pages.page('page:2'))
+        self.assertEqual(None, pages.page('page:4'))
+        self.assertEqual({'pid': 'page:1', 'page_order': 1},
+                         pages.previous('page:2'))
+        self.assertEqual({'pid': 'page:3', 'page_order': 3},
+                         pages.next('page:2'))
+        self.assertEqual(None, pages.previous('page:1'))
+        self.assertEqual(None, pages.next('page:3'))
+        self.assertEqual(None, pages.next('page:4'))
+        self.assertEqual(1, pages.page_chunk('page:3', 30))
+        self.assertEqual(2, pages.page_chunk('page:3', 2))
+        self.assertEqual(None, pages.page_chunk('page:4', 30))
+
+        # cached; no solr query on subsequent use
+        mocksolr.reset_mock()
+        pages = VolumePageSequence('vol:1')
+        self.assertEqual(3, len(pages))
+        self.assertEqual(0, mocksolr.query.call_count)
+
+        # reloaded when the volume version changes (i.e., a page is indexed)
+        versions.bump(versions.index_scope('vol:1'))
+        mockquery.paginate.return_value.execute.return_value = \
+            self.solr_response([{'pid': 'page:1', 'page_order': 1}])
+        pages = VolumePageSequence('vol:1')
+        self.assertEqual(1, mocksolr.query.call_count)
+        self.assertEqual(1, len(pages))
+
+        # not cached if pages were indexed while the list was loaded
+        versions.bump(versions.index_scope('vol:1'))
+        mockquery.paginate.return_value.execute.return_value = \
+            self.solr_response([{'pid': 'page:1', 'page_order': 1}], 2)
+        VolumePageSequence('vol:1')
+        VolumePageSequence('vol:1')
+        self.assertEqual(3, mocksolr.query.call_count)
+
+        # or while the volume is being reindexed
+        self.addCleanup(cache.clear)
+        mockquery.paginate.return_value.execute.return_value = \
+            self.solr_response([{'pid': 'page:1', 'page_order': 1}])
+        versions.bump_pending(versions.index_scope('vol:1'))
+        VolumePageSequence('vol:1')
+        VolumePageSequence('vol:1')
+        self.assertEqual(5, mocksolr.query.call_count)
+
+    def solr_response(self, docs, found=None):
+        # list of results with a numFound, as returned by sunburnt
+        response = MagicMock()
+        response.__iter__.side_effect = lambda: iter(docs)
+        response.result.numFound = len(docs) if found is None else found
+        return response
+
+    @patch('readux.books.models.cache')
+    def test_page_tei_fragments(self, mockcache):
+        mockapi = Mock()
+        vol = Volume(mockapi, 'vol:1')
+        p1 = ManifestPage('page:1', 1, has_tei=True,
+                          last_modified='2016-01-01T00:00:00Z')
+        p2 = ManifestPage('page:2', 2, has_tei=True,
+                          last_modified='2016-01-02T00:00:00Z')
+        vol._page_manifest = VolumePageManifest.__new__(VolumePageManifest)
+        vol._page_manifest.pages = [p1, p2]
+
+        page1_key = vol.page_tei_cache_key(p1)
+        self.assert_(p1.pid in page1_key)
+        self.assert_(p1.last_modified in page1_key)
+        self.assertEqual(None, vol.page_tei_cache_key(ManifestPage('page:3')))
+
+        # page 1 cached, page 2 not
+        mockcache.get_many.return_value = {
+            page1_key: '<surface xmlns="http://www.tei-c.org/ns/1.0" xml:id="p1"/>'
+        }
+        with patch.object(vol, 'fetch_page_tei') as mockfetch:
+            mockfetch.return_value = tei.Zone(id='p2')
+            fragments = vol.page_tei_fragments()
+            # only the page not in the cache should be loaded
+            mockfetch.assert_called_once_with(p2)
+
+        self.assertEqual(['p1', 'p2'], [f.id for f in fragments])
+        # page without ark should link to readux page url
+        self.assertEqual(vol.page_url('page', p2.pid), fragments[1].href)
+        self.assert_(fragments[1].href.endswith(
+            reverse('books:page', kwargs={'vol_pid': vol.pid, 'pid': p2.pid})))
+        # graphic elements added for each image variant
+        self.assertEqual([rend for rend, mode in vol.tei_image_types],
+                         [g.rend for g in fragments[1].graphics])
+        self.assert_(fragments[1].graphics[0].url.endswith(
+            reverse('books:page-image', kwargs={'vol_pid': vol.pid,
+                    'pid': p2.pid, 'mode': 'fs'})))
+        args, kwargs = mockcache.set_many.call_args
+        self.assertEqual([vol.page_tei_cache_key(p2)], args[0].keys())
+
+        # multiple pages are fetched concurrently, in page order
+        with patch.object(vol, 'fetch_page_tei') as mockfetch:
+            mockfetch.side_effect = lambda p: tei.Zone(id=p.pid)
+            pages = [ManifestPage('page:%d' % i) for i in range(20)]
+            self.assertEqual([p.pid for p in pages],
+                [z.id for z in vol.fetch_page_tei_list(pages)])
+
+        # manifest version changes when a page is modified
+        version = vol.page_manifest.version
+        p2.last_modified = '2016-02-01T00:00:00Z'
+        self.assertNotEqual(version, vol.page_manifest.version)
+
 
 
 class VolumeV1_0Test(TestCase):
@@ -346,6 +511,13 @@ class VolumeV1_0Test(TestCase):
                 self.assertEqual(mockpdf.size, data['pdf_size'],
                     'pdf_size should be set from pdf size, when available')
 
+        # versions for the volume are pending until solr is updated,
+        # but the version of the index as a whole is still known
+        # (pending versions are removed from the cache after the test)
+        self.addCleanup(cache.clear)
+        self.assertEqual([None], versions.get_versions([(versions.index_scope(self.vol.pid), None)]))
+        self.assertNotEqual([None], versions.get_versions([(versions.INDEX, None)]))
+
     def test_voyant_url(self):
         # NOTE: this test is semi-redundant with the same test for the SolrVolume,
         # but since the method is implemented in BaseVolume and depends on
@@ -427,6 +599,32 @@ class PageV1_1Test(TestCase):
             page.add_ocr_ids()
             self.assertTrue(page.ocr_has_ids)
 
+    @patch('readux.books.models.iiif_session')
+    @patch('readux.books.models.cache')
+    def test_image_size(self, mockcache, mockiiif_session):
+        page = PageV1_1(Mock()) # use mock for fedora api, since we won't make any calls
+        page.pid = 'rdxtest:4607'
+        cache_key = page.image_size_cache_key(page.pid)
+
+        # cached dimensions should be used without requesting image metadata
+        mockcache.get.return_value = (2000, 1500)
+        self.assertEqual(2000, page.width)
+        self.assertEqual(1500, page.height)
+        mockcache.get.assert_called_with(cache_key)
+        self.assertEqual(0, mockiiif_session.return_value.get.call_count)
+
+        # not cached: fall back to iiif image metadata and cache the result
+        page = PageV1_1(Mock())
+        page.pid = 'rdxtest:4607'
+        mockcache.get.return_value = None
+        mockget = mockiiif_session.return_value.get
+        mockget.return_value.status_code = 200
+        mockget.return_value.json.return_value = {
+            'width': '1200', 'height': 1600}
+        self.assertEqual((1200, 1600), page.image_size)
+        mockcache.set.assert_called_with(cache_key, (1200, 1600),
+                                         page.image_size_cache_timeout)
+
 class AbbyyOCRTestCase(TestCase):
 
     fr6v1_doc = os.path.join(FIXTURE_DIR, 'abbyyocr_fr6v1.xml')
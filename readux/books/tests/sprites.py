@@ -0,0 +1,103 @@
+from cStringIO import StringIO
+from django.test import TestCase
+from mock import patch, Mock
+from PIL import Image
+
+from readux.books.sprites import SpriteSheet
+
+
+def image_content(size, format='PNG'):
+    # generate image content for a mock IIIF response
+    output = StringIO()
+    Image.new('RGB', size, 'red').save(output, format)
+    return output.getvalue()
+
+
+class SpriteSheetTest(TestCase):
+
+    def test_init(self):
+        self.assertRaises(ValueError, SpriteSheet, [])
+        self.assertRaises(ValueError, SpriteSheet, ['page:1'], mode='fs')
+        self.assertRaises(ValueError, SpriteSheet, ['page:1'],
+                          mode='mini-thumbnail', layout='landscape')
+        self.assertRaises(ValueError, SpriteSheet,
+            ['page:%d' % i for i in range(SpriteSheet.max_images + 1)])
+        self.assertRaises(ValueError, SpriteSheet, ['page:1', '../etc/passwd'])
+
+    def test_layout(self):
+        pids = ['page:%d' % i for i in range(12)]
+        sprite = SpriteSheet(pids)
+        self.assertEqual((2000, 500), sprite.size)
+        # images are placed in pid order
+        self.assertEqual((0, 0), sprite.offset('page:0'))
+        self.assertEqual((600, 0), sprite.offset('page:11'))
+        self.assertEqual((800, 0), sprite.offset('page:2'))
+        self.assertEqual((200, 250), sprite.offset('page:9'))
+        self.assertEqual('-200px -250px', sprite.position('page:9'))
+
+        sprite = SpriteSheet(pids[:3], layout='landscape')
+        self.assertEqual((1050, 220), sprite.size)
+        self.assert_('layout=landscape' in sprite.url())
+        self.assert_('pid=page%3A2' in sprite.url())
+        self.assert_(sprite.url('json').split('?')[0].endswith('.json'))
+        self.assert_('sig=%s' % sprite.signature in sprite.url())
+        self.assertTrue(sprite.valid_signature(sprite.signature))
+        self.assertFalse(sprite.valid_signature(None))
+        self.assertFalse(sprite.valid_signature(SpriteSheet(pids[:3]).signature))
+
+        # the same pages in any order generate the same sprite sheet
+        self.assertEqual(SpriteSheet(pids[:3]).cache_key,
+                         SpriteSheet(list(reversed(pids[:3]))).cache_key)
+        self.assertEqual(SpriteSheet(pids[:3]).url(),
+                         SpriteSheet(list(reversed(pids[:3]))).url())
+
+        self.assertNotEqual(SpriteSheet(pids[:3]).cache_key,
+                            SpriteSheet(pids[:3], layout='landscape').cache_key)
+        self.assertNotEqual(SpriteSheet(pids[:3]).cache_key,
+                            SpriteSheet(pids[1:4]).cache_key)
+
+    @patch('readux.books.sprites.cache')
+    @patch('readux.books.sprites.iiif_session')
+    def test_render(self, mockiiif_session, mockcache):
+        mockcache.get.return_value = None
+        responses = {}
+        for pid, size in [('page:1', (240, 300)), ('page:2', (300, 150))]:
+            responses[SpriteSheet([pid], 'mini-thumbnail').image_url(pid)] = \
+                Mock(status_code=200, content=image_content(size))
+        mockiiif_session.return_value.get.side_effect = lambda url: responses[url]
+
+        sprite = SpriteSheet(['page:1', 'page:2'], 'mini-thumbnail')
+        content, offsets = sprite.render()
+        img = Image.open(StringIO(content))
+        self.assertEqual('JPEG', img.format)
+        self.assertEqual((200, 100), img.size)
+        # mini thumbnails are scaled to fit; offset map includes size
+        self.assertEqual(['page:1', 'page:2'], offsets.keys())
+        self.assertEqual({'x': 0, 'y': 0, 'width': 80, 'height': 100},
+                         offsets['page:1'])
+        self.assertEqual({'x': 100, 'y': 0, 'width': 100, 'height': 50},
+                         offsets['page:2'])
+        mockcache.set.assert_called_with(sprite.cache_key, (content, offsets),
+                                         sprite.cache_timeout)
+
+        # thumbnails are cropped to fill the cell
+        for pid in ['page:1', 'page:2']:
+            responses[SpriteSheet([pid]).image_url(pid)] = responses[
+                SpriteSheet([pid], 'mini-thumbnail').image_url(pid)]
+        content, offsets = SpriteSheet(['page:1', 'page:2']).render()
+        self.assertEqual({'x': 200, 'y': 0, 'width': 200, 'height': 250},
+                         offsets['page:2'])
+
+        # image that can't be loaded is left out and not cached
+        mockcache.reset_mock()
+        responses[SpriteSheet(['page:2']).image_url('page:2')] = \
+            Mock(status_code=404)
+        content, offsets = SpriteSheet(['page:1', 'page:2']).render()
+        self.assertEqual(['page:1'], offsets.keys())
+        self.assertEqual(0, mockcache.set.call_count)
+
+        # cached result is returned without requesting images
+        mockcache.get.return_value = ('data', {})
+        mockiiif_session.reset_mock()
+        self.assertEqual(('data', {}), sprite.render())
+        self.assertEqual(0, mockiiif_session.return_value.get.call_count)
@@ -0,0 +1,92 @@
+import datetime
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.test.utils import override_settings
+from eulxml.xmlmap import load_xmlobject_from_file, load_xmlobject_from_string
+import json
+from mock import Mock
+import os.path
+
+from readux.annotations.models import Annotation
+from readux.books import tei
+from readux.books.models import Volume
+from readux.books.tei_stream import stream_volume_tei
+from readux.books.tests.models import FIXTURE_DIR
+
+
+class StreamVolumeTeiTest(TestCase):
+
+    page_uri = "http://readux.co/books/pages/some:1/"
+
+    def setUp(self):
+        # use tei fixture header and page to simulate volume tei
+        fixture = os.path.join(FIXTURE_DIR, 'teifacsimile.xml')
+        self.header = load_xmlobject_from_file(fixture, tei.Facsimile)
+        self.header.title = 'Lecoq'
+        facsimile = self.header.node.find('{%s}facsimile' % tei.TeiBase.ROOT_NS)
+        self.header.node.remove(facsimile)
+
+        pages = []
+        for i in range(3):
+            page = load_xmlobject_from_file(fixture, tei.Facsimile).page
+            page.id = 'page-%d' % i
+            page.href = '%s%d/' % (self.page_uri, i)
+            pages.append(page)
+
+        self.vol = Mock(spec=Volume, pid='vol:1')
+        self.vol.volume_tei_header.return_value = self.header
+        self.vol.iter_page_tei_fragments.return_value = iter(pages)
+
+    def test_stream(self):
+        chunks = list(stream_volume_tei(self.vol))
+        # header, one chunk per page, and document end
+        self.assertEqual(5, len(chunks))
+        self.assert_('<teiHeader' in chunks[0])
+        self.assert_('page-0' in chunks[1])
+
+        teidoc = load_xmlobject_from_string(''.join(chunks), tei.Facsimile)
+        self.assertEqual('Lecoq', teidoc.title)
+        self.assertEqual(['page-0', 'page-1', 'page-2'],
+                         [p.id for p in teidoc.page_list])
+        self.assertEqual(['1', '2', '3'], [p.n for p in teidoc.page_list])
+        self.assertEqual(datetime.date.today(), teidoc.pubstmt.date)
+
+    @override_settings(DEV_ENV=False)
+    def test_stream_annotated(self):
+        user = get_user_model()(username='an_annotator',
+            first_name="Anne", last_name="O'Tater")
+        user.save()
+        page_uri = '%s1/' % self.page_uri
+        note = Annotation(text="Here's the thing", quote="really",
+            uri=page_uri, user=user,
+            extra_data=json.dumps({
+                'tags': ['test'],
+                'ranges': [
+                    {'start': '//div[@id="fnstr.idm320760248608"]/span[1]',
+                     'end': '//div[@id="fnstr.idm320760242176"]/span[1]',
+                     'startOffset': 0,
+                     'endOffset': 6
+                     }
+                ],
+                'ark': page_uri,
+                'related_pages': ['%s2/' % self.page_uri]
+                }))
+        note.save()
+
+        chunks = list(stream_volume_tei(self.vol, Annotation.objects.all()))
+        teidoc = load_xmlobject_from_string(''.join(chunks),
+                                            tei.AnnotatedFacsimile)
+        self.assertEqual(', an annotated digital edition', teidoc.subtitle)
+        self.assertEqual(3, len(teidoc.page_list))
+        # notes are added after the pages
+        self.assertEqual(1, len(teidoc.annotations))
+        self.assertEqual('annotation-%s' % note.id, teidoc.annotations[0].id)
+        self.assertEqual('#range(#highlight-start-%s, #highlight-end-%s)' \
+            % (note.id, note.id), teidoc.annotations[0].target)
+        # related page reference uses page id from streamed pages
+        self.assertEqual('#page-2',
+            teidoc.annotations[0].related_pages[0].target)
+        # highlight anchors added to the annotated page
+        self.assert_(teidoc.page_list[1].node.xpath('.//tei:anchor',
+            namespaces=tei.TeiBase.ROOT_NAMESPACES))
+        self.assertEqual('test', teidoc.tags.interp[0].value)
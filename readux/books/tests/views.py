@@ -1,19 +1,28 @@
 from datetime import datetime, timedelta
 from django.contrib.auth import get_user_model
-from django.core.paginator import Paginator
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.paginator import Paginator, EmptyPage
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpRequest
 from django.template.defaultfilters import filesizeformat
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
 import json
+import os
 from mock import Mock, patch, NonCallableMock, NonCallableMagicMock, \
-    MagicMock, call
+    MagicMock, call, ANY
+import shutil
+import tempfile
+import time
 from urllib import unquote
 
 from readux.annotations.models import Annotation
 from readux.books.models import SolrVolume, Volume, Page, SolrPage
-from readux.books import sitemaps, views, view_helpers, forms
-from readux.utils import absolutize_url
+from readux.books import sitemaps, sprites, views, view_helpers, forms
+from readux import versions, search
+from readux.utils import absolutize_url, solr_cursor
 
 
 class BookViewsTest(TestCase):
@@ -222,7 +231,67 @@ class BookViewsTest(TestCase):
             testuser = User.objects.get(username=self.user_credentials['user']['username'])
             self.client.login(**self.user_credentials['user'])
             response = self.client.get(search_url, {'keyword': 'lecoq', 'collection': 'Yellowbacks'})
-            mockvolclass.volume_annotation_count.assert_called_with(testuser)
+            # counts are only loaded for volumes in the current page of results
+            mockvolclass.volume_annotation_count.assert_called_with(testuser,
+                                                                    uris=ANY)
+
+    def test_search_paginator(self):
+        cache.clear()
+        search.cache_stats.reset()
+        mockquery = Mock()
+        mockquery.paginate.return_value = mockquery
+        mockquery.params.return_value = [('q', 'yellowbacks'), ('rows', 10)]
+        mockquery.result_constructor = dict
+        mockquery.interface.conn.select.return_value = '<response/>'
+        mockresponse = mockquery.interface.schema.parse_response.return_value
+        mockresponse.result.numFound = 25
+
+        request = HttpRequest()
+        paginator = search.SolrPaginator(mockquery, 10, request=request)
+        page = paginator.page(2)
+        mockquery.paginate.assert_called_with(start=10, rows=10)
+        # total and page of results from the same solr request
+        self.assertEqual(mockresponse, page.object_list)
+        self.assertEqual(25, paginator.count)
+        self.assertEqual(3, paginator.num_pages)
+        self.assertEqual(1, mockquery.interface.conn.select.call_count)
+        self.assertEqual((0, 1), (search.cache_stats.hits, search.cache_stats.misses))
+
+        # memoized for the request
+        paginator.page(2)
+        self.assertEqual(1, mockquery.interface.conn.select.call_count)
+        self.assertEqual((0, 1), (search.cache_stats.hits, search.cache_stats.misses))
+        # cached for other requests; equivalent parameters share a key
+        mockquery.params.return_value = [('rows', 10), ('q', 'yellowbacks')]
+        search.SolrPaginator(mockquery, 10, request=HttpRequest()).page(2)
+        self.assertEqual(1, mockquery.interface.conn.select.call_count)
+        self.assertEqual(0.5, search.cache_stats.hit_rate)
+        # not cached after reindexing
+        versions.bump(versions.INDEX)
+        search.SolrPaginator(mockquery, 10).page(2)
+        self.assertEqual(2, mockquery.interface.conn.select.call_count)
+        # still cached while content is being indexed
+        # (scheduled versions are removed from the cache after the test)
+        self.addCleanup(cache.clear)
+        with override_settings(VERSION_PENDING_DELAY=60):
+            versions.bump_later(versions.INDEX)
+        search.SolrPaginator(mockquery, 10).page(2)
+        search.SolrPaginator(mockquery, 10).page(2)
+        self.assertEqual(3, mockquery.interface.conn.select.call_count)
+        # but not once the indexer has had time to update solr
+        with patch('readux.versions.time') as mocktime:
+            mocktime.time.return_value = time.time() + 61
+            search.SolrPaginator(mockquery, 10).page(2)
+            search.SolrPaginator(mockquery, 10).page(2)
+        self.assertEqual(4, mockquery.interface.conn.select.call_count)
+        # not cached while an index update is pending
+        versions.bump_pending(versions.INDEX)
+        search.SolrPaginator(mockquery, 10).page(2)
+        search.SolrPaginator(mockquery, 10).page(2)
+        self.assertEqual(6, mockquery.interface.conn.select.call_count)
+
+        self.assertRaises(EmptyPage, paginator.page, 4)
+        self.assertRaises(EmptyPage, paginator.page, 0)
 
     @patch('readux.books.views.VolumeText.repository_class') #TypeInferringRepository')
     def test_text(self, mockrepo_class):
@@ -568,8 +637,9 @@ class BookViewsTest(TestCase):
         self.assertEqual(2, annotated_pages[page2_url])
         self.assertEqual(13, annotated_pages[page3_url])
 
+    @patch('readux.books.views.VolumePageSequence')
     @patch('readux.books.views.TypeInferringRepository')
-    def test_view_page(self, mockrepo):
+    def test_view_page(self, mockrepo, mockpage_seq):
         mockobj = Mock()
         mockobj.pid = 'page:1'
         mockobj.volume.pid = 'vol:1'
@@ -599,34 +669,46 @@ class BookViewsTest(TestCase):
         # first test without tei
         mockobj.tei = NonCallableMock()  # non-magic mock, to simplify template logic
         mockobj.tei.exists = False
-        # uses solr to find adjacent pages
-        solr_result = NonCallableMagicMock(spec_set=['__iter__'])
-        # *only* mock iter, to avoid weirdness with django templates & callables
+        mockrepo.return_value.get_object.return_value = mockobj
+        # uses cached list of volume pages to find adjacent pages
         nearby_pages = [
-            {'pid': 'page:4', 'page_order': '4'},
-            {'pid': 'page:5', 'page_order': '5'},
-            {'pid': 'page:5', 'page_order': '6'},
+            {'pid': 'page:4', 'page_order': 4},
+            {'pid': 'page:6', 'page_order': 6},
         ]
-        solr_result.__iter__.return_value = nearby_pages
-        mocksolr_query = MagicMock()
-        mocksolr_query.__iter__.return_value = iter(solr_result)
-        mocksolr_query.__len__.return_value = 3
-        # cheating here, since we know what index should be requested...
-        mocksolr_query.__getitem__.return_value = nearby_pages[2]
-        mocksolr_query.query.return_value = mocksolr_query
-        mockobj.volume.find_solr_pages.return_value = mocksolr_query
-        mockrepo.return_value.get_object.return_value = mockobj
+        mockpages = mockpage_seq.return_value
+        mockpages.previous.return_value = nearby_pages[0]
+        mockpages.next.return_value = nearby_pages[1]
+        mockpages.page.return_value = {'pid': 'page:5', 'page_order': 5}
+        mockpages.page_chunk.return_value = 1
 
         response = self.client.get(url)
         # test expected context variables
         self.assertEqual(mockobj, response.context['page'],
             'page object should be set in context')
         self.assertEqual(nearby_pages[0], response.context['prev'],
-            'previous page should be selected from solr result and set in context')
-        self.assertEqual(nearby_pages[2], response.context['next'],
-            'next page should be selected from solr result and set in context')
+            'previous page should be selected from volume pages and set in context')
+        self.assertEqual(nearby_pages[1], response.context['next'],
+            'next page should be selected from volume pages and set in context')
         self.assertEqual(1, response.context['page_chunk'],
             'chunk of paginated pages should be calculated and set in context')
+        # page order and volume pid are set without loading the page
+        # or its volume from fedora
+        self.assertEqual(5, response.context['page_order'])
+        self.assertEqual('vol:1', response.context['vol_pid'])
+        mockpages.page.assert_called_with(mockobj.pid)
+        mockpage_seq.assert_called_with(mockobj.volume.pid)
+        mockpages.page_chunk.assert_called_with(mockobj.pid,
+                                                views.VolumePageList.paginate_by)
+
+        # page not found in volume pages; chunk calculated from page order
+        mockpages.page.return_value = None
+        mockpages.page_chunk.return_value = None
+        mockobj.page_order = 35
+        response = self.client.get(url)
+        self.assertEqual(2, response.context['page_chunk'])
+        self.assertEqual(35, response.context['page_order'])
+        mockobj.page_order = 5
+        mockpages.page.return_value = {'pid': 'page:5', 'page_order': 5}
         self.assertNotContains(response,
             reverse('books:page-tei',
                 kwargs={'vol_pid': mockobj.volume.pid, 'pid': mockobj.pid}),
@@ -755,6 +837,177 @@ class BookViewsTest(TestCase):
             reverse('books:page-ocr', **url_args),
             response['location'])
 
+    @patch('readux.books.views.iiif_session')
+    @patch('readux.books.views.TypeInferringRepository')
+    def test_page_image(self, mockrepo, mockiiif_session):
+        mockpage = mockrepo.return_value.get_object.return_value
+        mockpage.iiif.thumbnail.return_value = 'http://iiif.co/page:1/thumbnail.jpg'
+        mockget = mockiiif_session.return_value.get
+        remote_response = mockget.return_value
+        remote_response.status_code = 206
+        remote_response.headers = {'Content-Type': 'image/jpeg',
+            'Content-Length': '6', 'Content-Range': 'bytes 0-5/100',
+            'Connection': 'keep-alive', 'Server': 'loris'}
+        remote_response.raw.stream.return_value = iter(['abc', 'def'])
+
+        img_url = reverse('books:page-image', kwargs={'vol_pid': 'vol:1',
+                          'pid': 'page:1', 'mode': 'thumbnail'})
+        response = self.client.get(img_url, HTTP_RANGE='bytes=0-5')
+        # content should be streamed from the remote response
+        self.assertTrue(response.streaming)
+        self.assertEqual('abcdef', ''.join(response.streaming_content))
+        args, kwargs = mockget.call_args
+        self.assertEqual('http://iiif.co/page:1/thumbnail.jpg', args[0])
+        self.assertTrue(kwargs['stream'])
+        # range request passed through to the image server
+        self.assertEqual('bytes=0-5', kwargs['headers']['Range'])
+        # unencoded content requested, since client did not accept gzip
+        self.assertEqual('identity', kwargs['headers']['Accept-Encoding'])
+        remote_response.raw.stream.assert_called_with(views.ProxyView.chunk_size,
+                                                      decode_content=False)
+        # status, content length and range passed through
+        self.assertEqual(206, response.status_code)
+        self.assertEqual('6', response['Content-Length'])
+        self.assertEqual('bytes 0-5/100', response['Content-Range'])
+        self.assertFalse(response.has_header('Server'))
+        remote_response.close.assert_called_with()
+
+        # client accept-encoding replaces the default, with no duplicate header
+        self.client.get(img_url, HTTP_ACCEPT_ENCODING='gzip')
+        args, kwargs = mockget.call_args
+        self.assertEqual(['gzip'], [value for header, value in kwargs['headers'].items()
+                                    if header.lower() == 'accept-encoding'])
+
+        # timeout from image server
+        mockget.side_effect = views.requests.exceptions.Timeout
+        response = self.client.get(img_url)
+        self.assertEqual(504, response.status_code)
+
+    @patch('readux.books.view_helpers.Repository')
+    @patch('readux.books.views.iiif_session')
+    @patch('readux.books.views.TypeInferringRepository')
+    def test_page_image_cached(self, mockrepo, mockiiif_session, mockhelperrepo):
+        mockpage = mockrepo.return_value.get_object.return_value
+        mockpage.iiif.thumbnail.return_value = 'http://iiif.co/page:1/thumbnail.jpg'
+        mockhelperrepo.return_value.get_object.return_value.image.checksum = 'abc123'
+        mockget = mockiiif_session.return_value.get
+        remote_response = mockget.return_value
+        remote_response.status_code = 200
+        remote_response.headers = {'Content-Type': 'image/jpeg'}
+        remote_response.iter_content.return_value = iter(['abc', 'def'])
+
+        img_url = reverse('books:page-image', kwargs={'vol_pid': 'vol:1',
+                          'pid': 'page:1', 'mode': 'thumbnail'})
+        mockhelperget = mockhelperrepo.return_value.get_object
+        cache_dir = tempfile.mkdtemp()
+        # image checksums are stored in the django cache
+        self.addCleanup(cache.clear)
+        try:
+            with override_settings(IIIF_CACHE_DIR=cache_dir):
+                response = self.client.get(img_url)
+                self.assertEqual('abcdef', ''.join(response.streaming_content))
+                self.assertEqual('image/jpeg', response['Content-Type'])
+                self.assertEqual('6', response['Content-Length'])
+                self.assert_(response.has_header('ETag'))
+                self.assert_(response.has_header('Last-Modified'))
+                etag = response['ETag']
+                remote_response.close.assert_called_with()
+
+                # second request should be served from the cache,
+                # without loading the page from fedora
+                mockget.reset_mock()
+                mockhelperget.reset_mock()
+                response = self.client.get(img_url)
+                self.assertEqual('abcdef', ''.join(response.streaming_content))
+                self.assertEqual(0, mockget.call_count)
+                self.assertEqual(0, mockhelperget.call_count)
+                self.assertEqual(etag, response['ETag'])
+
+                # conditional request
+                response = self.client.get(img_url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(304, response.status_code)
+                self.assertEqual(0, mockhelperget.call_count)
+
+                # served via x-sendfile when configured
+                with override_settings(IIIF_CACHE_SENDFILE='X-Sendfile'):
+                    response = self.client.get(img_url)
+                    self.assert_(response['X-Sendfile'].startswith(cache_dir))
+                    self.assertEqual('', response.content)
+                with override_settings(IIIF_CACHE_SENDFILE='X-Accel-Redirect',
+                                       IIIF_CACHE_SENDFILE_URL='/iiif-cache/'):
+                    response = self.client.get(img_url)
+                    self.assert_(response['X-Accel-Redirect'].startswith('/iiif-cache/'))
+                    self.assertFalse(response['X-Accel-Redirect'].startswith(cache_dir))
+
+                # modified (and reindexed) image should not use the
+                # cached derivative
+                mockhelperget.return_value.image.checksum = 'def456'
+                versions.bump(versions.index_scope('page:1'))
+                remote_response.iter_content.return_value = iter(['ghi'])
+                response = self.client.get(img_url)
+                self.assertEqual('ghi', ''.join(response.streaming_content))
+                self.assertEqual(1, mockget.call_count)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    @patch('readux.books.views.sprites.SpriteSheet.render')
+    def test_thumbnail_sprite(self, mockrender):
+        offsets = {'page:1': {'x': 0, 'y': 0, 'width': 200, 'height': 250},
+                   'page:2': {'x': 200, 'y': 0, 'width': 200, 'height': 250}}
+        mockrender.return_value = ('jpeg data', offsets)
+        sprite_url = reverse('books:sprite', kwargs={'mode': 'thumbnail',
+                                                     'format': 'jpg'})
+        signature = sprites.SpriteSheet(['page:1', 'page:2']).signature
+        response = self.client.get(sprite_url, {'pid': ['page:1', 'page:2'],
+                                                'sig': signature})
+        self.assertEqual('image/jpeg', response['Content-Type'])
+        self.assertEqual('jpeg data', response.content)
+
+        json_url = reverse('books:sprite', kwargs={'mode': 'thumbnail',
+                                                   'format': 'json'})
+        response = self.client.get(json_url, {'pid': ['page:1', 'page:2'],
+                                              'sig': signature})
+        data = json.loads(response.content)
+        self.assertEqual(offsets, data['pages'])
+        self.assertEqual(400, data['width'])
+        self.assertEqual(250, data['height'])
+        self.assert_(data['image'].startswith(sprite_url))
+
+        # no pids or unsupported layout
+        response = self.client.get(sprite_url)
+        self.assertEqual(400, response.status_code)
+        response = self.client.get(sprite_url, {'pid': 'page:1', 'layout': 'tiny'})
+        self.assertEqual(400, response.status_code)
+
+        # sprite sheets not generated by the site are not rendered
+        mockrender.reset_mock()
+        response = self.client.get(sprite_url, {'pid': ['page:1', 'page:3'],
+                                                'sig': signature})
+        self.assertEqual(403, response.status_code)
+        response = self.client.get(sprite_url, {'pid': ['page:1', 'page:2']})
+        self.assertEqual(403, response.status_code)
+        self.assertEqual(0, mockrender.call_count)
+
+    @patch('readux.books.views.Repository')
+    def test_volume_annotation_tags(self, mockrepo):
+        mockvol = mockrepo.return_value.get_object.return_value
+        mockvol.exists = False
+        tags_url = reverse('books:annotation-tags', kwargs={'pid': 'vol:1'})
+        response = self.client.get(tags_url)
+        self.assertEqual(404, response.status_code)
+
+        mockvol.exists = True
+        mockvol.is_a_volume = True
+        tags = [{'slug': 'review', 'tag': 'review', 'count': 2}]
+        mockvol.annotation_tags.return_value = tags
+        self.client.login(**self.user_credentials['user'])
+        response = self.client.get(tags_url)
+        self.assertEqual('application/json', response['Content-Type'])
+        self.assertEqual(tags, json.loads(response.content))
+        args, kwargs = mockvol.annotation_tags.call_args
+        self.assertEqual(self.user_credentials['user']['username'],
+                         args[0].username)
+
     @patch('readux.books.sitemaps.solr_interface')
     def test_sitemaps(self, mocksolr_interface):
         # minimal test, just to check that sitemaps render without error
@@ -764,6 +1017,51 @@ class BookViewsTest(TestCase):
         response = self.client.get(reverse('sitemap', kwargs={'section': 'volumes'}))
         self.assertContains(response, '<urlset')
 
+    @patch('readux.collection.sitemaps.solr_cursor')
+    @patch('readux.books.sitemaps.solr_cursor')
+    def test_pregenerated_sitemaps(self, mocksolr_cursor, mockcoll_solr_cursor):
+        from readux import sitemaps as pregenerated
+        from readux.urls import sitemaps as site_sitemaps
+        docs = [{'pid': 'vol:%d' % i, 'last_modified': datetime(2016, 3, 1),
+                 'isConstituentOf': ['info:fedora/vol:1']} for i in range(3)]
+        mocksolr_cursor.side_effect = lambda query: iter(docs)
+        mockcoll_solr_cursor.return_value = iter([])
+
+        sitemap_dir = tempfile.mkdtemp()
+        try:
+            with patch.object(sitemaps.VolumePageSitemap, 'limit', 2):
+                pages = pregenerated.generate(site_sitemaps, sitemap_dir)
+            self.assertEqual(2, pages['volume-pages'])
+            self.assertEqual(1, pages['volumes'])
+            # empty sections still have a sitemap file
+            self.assertEqual(1, pages['collections'])
+
+            with override_settings(SITEMAP_DIR=sitemap_dir):
+                response = self.client.get(reverse('sitemap-index'))
+                self.assertContains(response, 'sitemapindex')
+                section_url = reverse('sitemap', kwargs={'section': 'volume-pages'})
+                self.assertContains(response, '%s?p=2</loc>' % section_url)
+                self.assert_(response.has_header('Last-Modified'))
+
+                response = self.client.get(section_url, {'p': 2})
+                self.assertContains(response, '<urlset')
+                self.assertContains(response, '<loc>', 1)
+                self.assertContains(response, '<lastmod>2016-03-01</lastmod>')
+                self.assertContains(response,
+                    reverse('books:page', kwargs={'vol_pid': 'vol:1', 'pid': 'vol:2'}))
+
+                # compressed file is served as is if client accepts gzip
+                response = self.client.get(section_url, HTTP_ACCEPT_ENCODING='gzip')
+                self.assertEqual('gzip', response['Content-Encoding'])
+                self.assert_('Accept-Encoding' in response['Vary'])
+
+            # files no longer needed are removed when regenerated
+            pregenerated.generate(site_sitemaps, sitemap_dir)
+            self.assertFalse(os.path.exists(os.path.join(sitemap_dir,
+                pregenerated.section_filename('volume-pages', 2))))
+        finally:
+            shutil.rmtree(sitemap_dir)
+
     @patch('readux.books.views.Repository')
     def test_volume_export(self, mockrepo):
         mockobj = NonCallableMock()
@@ -808,42 +1106,84 @@ class BookViewsTest(TestCase):
 
 class ViewHelpersTest(TestCase):
 
-    @patch('readux.books.view_helpers.Repository')
-    @patch('readux.books.view_helpers.solr_interface')
-    def test_volume_pages_modified(self, mocksolr_interface, mockrepo):
-        mockvol = Mock(pid='vol:1')
-        mockrepo.return_value.get_object.return_value = mockvol
+    def setUp(self):
+        # versions are stored in the cache
+        cache.clear()
 
-        mockrequest = Mock()
-        mockrequest.user.is_authenticated.return_value = False
+    def request(self, user=None):
+        request = HttpRequest()
+        request.user = user or AnonymousUser()
+        return request
 
+    @patch('readux.books.view_helpers.solr_interface')
+    def test_volume_pages_modified(self, mocksolr_interface):
         # no solr results
         mockresult = MagicMock()
         mocksolr_interface.return_value.query.return_value.sort_by.return_value.field_limit.return_value = mockresult
         mockresult.count.return_value = 0
-        lastmod = view_helpers.volume_pages_modified(mockrequest, 'vol:1')
-        self.assertEqual(None, lastmod)
+        request = self.request()
+        self.assertEqual(None, view_helpers.volume_pages_modified(request, 'vol:1'))
+        self.assertEqual(None, view_helpers.volume_pages_etag(request, 'vol:1'))
 
-        # only solr result
+        # version is initialized from solr timestamp
         mockresult.count.return_value = 1
-        yesterday = datetime.now() - timedelta(days=1)
+        yesterday = datetime.utcnow().replace(microsecond=0) - timedelta(days=1)
         mockresult.__getitem__.return_value = {'timestamp': yesterday}
-        lastmod = view_helpers.volume_pages_modified(mockrequest, 'vol:1')
-        self.assertEqual(yesterday, lastmod)
-
-        # test with both solr and annotations for logged in user
-        mockvol.get_absolute_url.return_value = reverse('books:volume', kwargs={'pid': mockvol.pid})
-        mockrequest.user.is_authenticated.return_value = True
-        mockrequest.user.username = 'tester'
+        request = self.request()
+        lastmod = view_helpers.volume_pages_modified(request, 'vol:1')
+        self.assertEqual(timezone.make_aware(yesterday, timezone.utc), lastmod)
+        etag = view_helpers.volume_pages_etag(request, 'vol:1')
+        self.assert_(etag)
+
+        # version is cached; solr is not queried again
+        mocksolr_interface.reset_mock()
+        request = self.request()
+        self.assertEqual(lastmod, view_helpers.volume_pages_modified(request, 'vol:1'))
+        self.assertEqual(etag, view_helpers.volume_pages_etag(request, 'vol:1'))
+        mocksolr_interface.assert_not_called()
+
+        # reindexing updates the version
+        versions.bump(versions.index_scope('vol:1'))
+        request = self.request()
+        self.assert_(view_helpers.volume_pages_modified(request, 'vol:1') > lastmod)
+        self.assertNotEqual(etag, view_helpers.volume_pages_etag(request, 'vol:1'))
+
+        # logged in user: etag changes when annotations are added or deleted
         testuser = get_user_model()(username='tester')
         testuser.save()
+        etag = view_helpers.volume_pages_etag(self.request(testuser), 'vol:1')
         anno = Annotation.objects.create(user=testuser,
-            uri=reverse('books:page', kwargs={'vol_pid': mockvol.pid,
-                'pid': 'page:3'}), extra_data=json.dumps({}))
-        mockvol.annotations.return_value = Annotation.objects.filter(uri__contains=mockvol.get_absolute_url())
-        lastmod = view_helpers.volume_pages_modified(mockrequest, 'vol:1')
-        self.assertEqual(anno.created, lastmod)
-
+            uri=reverse('books:page', kwargs={'vol_pid': 'vol:1', 'pid': 'page:3'}),
+            volume_uri=view_helpers.volume_uri('vol:1'), extra_data=json.dumps({}))
+        request = self.request(testuser)
+        added_etag = view_helpers.volume_pages_etag(request, 'vol:1')
+        self.assertNotEqual(etag, added_etag)
+        self.assert_(view_helpers.volume_pages_modified(request, 'vol:1') >= anno.created)
+        anno.delete()
+        self.assertNotEqual(added_etag,
+            view_helpers.volume_pages_etag(self.request(testuser), 'vol:1'))
+        # anonymous etag is not affected
+        self.assertEqual(view_helpers.volume_pages_etag(self.request(), 'vol:1'),
+            view_helpers.volume_pages_etag(self.request(), 'vol:1'))
+
+        request = self.request()
+        lastmod = view_helpers.volume_pages_modified(request, 'vol:1')
+        etag = view_helpers.volume_pages_etag(request, 'vol:1')
+
+        # no conditional headers until the indexer has updated solr
+        # (pending versions are removed from the cache after the test)
+        self.addCleanup(cache.clear)
+        with override_settings(VERSION_PENDING_DELAY=60):
+            versions.bump_pending(versions.index_scope('vol:1'))
+        request = self.request()
+        self.assertEqual(None, view_helpers.volume_pages_modified(request, 'vol:1'))
+        self.assertEqual(None, view_helpers.volume_pages_etag(request, 'vol:1'))
+        # then versions are later than any previous version
+        with patch('readux.versions.time') as mocktime:
+            mocktime.time.return_value = time.time() + 61
+            request = self.request()
+            self.assert_(view_helpers.volume_pages_modified(request, 'vol:1') > lastmod)
+            self.assertNotEqual(etag, view_helpers.volume_pages_etag(request, 'vol:1'))
 
 
 class SitemapTestCase(TestCase):
@@ -869,6 +1209,34 @@ class SitemapTestCase(TestCase):
         mocksolr.query.return_value.field_limit.assert_called_with(['pid', 'last_modified',
             'isConstituentOf'])
 
+        # all items are retrieved with a solr cursor
+        with patch('readux.books.sitemaps.solr_cursor') as mocksolr_cursor:
+            volpage_sitemap.iter_items()
+            mocksolr_cursor.assert_called_with(
+                mocksolr.query.return_value.field_limit.return_value)
+
+    def test_solr_cursor(self):
+        response_xml = '''<response><result numFound="3" start="0"/>
+            <str name="nextCursorMark">%s</str></response>'''
+        query = Mock()
+        query.params.return_value = [('q', 'content_model:page'), ('start', 10),
+                                     ('sort', 'title_exact asc')]
+        query.interface.conn.select.side_effect = [response_xml % 'AoE1',
+            response_xml % 'AoE2', response_xml % 'AoE2']
+        query.interface.schema.parse_response.return_value.result.docs = [{'pid': 'page:1'}]
+
+        docs = list(solr_cursor(query, rows=2))
+        self.assertEqual(3, len(docs))
+        self.assertEqual(3, query.interface.conn.select.call_count)
+        params = query.interface.conn.select.call_args_list[0][0][0]
+        self.assert_(('sort', 'title_exact asc,pid asc') in params)
+        self.assert_(('rows', 2) in params)
+        self.assert_(('cursorMark', '*') in params)
+        self.assert_(('start', 10) not in params)
+        # next request uses the cursor mark from the previous response
+        self.assert_(('cursorMark', 'AoE1') in
+                     query.interface.conn.select.call_args_list[1][0][0])
+
 class BookSearchTest(TestCase):
 
     def test_search_terms(self):
@@ -0,0 +1,76 @@
+from cStringIO import StringIO
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from mock import patch, Mock, PropertyMock, call
+
+from readux.books.management.page_import import collection_volumes
+from readux.books.models import SolrPage
+
+
+@patch('readux.books.management.commands.warm_cache.signal')
+@patch('readux.books.management.commands.warm_cache.ManagementRepository')
+class WarmCacheTest(TestCase):
+
+    def volume(self, pid, solr_pages):
+        vol = Mock(pid=pid, exists=True, is_a_volume=True, has_tei=False)
+        vol.page_manifest = [Mock(pid=page['pid']) for page in solr_pages]
+        query = vol.find_solr_pages.return_value
+        query.count.return_value = len(solr_pages)
+        query.paginate.return_value = solr_pages
+        return vol
+
+    def test_collection_volumes(self, mockrepo, mocksignal):
+        repo = mockrepo.return_value
+        coll = repo.get_object.return_value
+        coll.exists = False
+        self.assertRaises(CommandError, collection_volumes, repo, 'coll:1')
+        self.assertRaises(CommandError, call_command, 'warm_cache',
+                          collection='coll:1', stdout=StringIO())
+
+        coll.exists = True
+        coll.has_requisite_content_models = False
+        self.assertRaises(CommandError, collection_volumes, repo, 'coll:1')
+
+        coll.has_requisite_content_models = True
+        coll.book_set = [Mock(volume_set=[Mock(pid='vol:1'), Mock(pid='vol:2')]),
+                         Mock(volume_set=[Mock(pid='vol:3')])]
+        self.assertEqual(['vol:1', 'vol:2', 'vol:3'],
+                         [vol.pid for vol in collection_volumes(repo, 'coll:1')])
+
+    @patch('readux.books.management.commands.warm_cache.image_cache')
+    @patch('readux.books.management.commands.warm_cache.Page')
+    @patch('readux.books.views.sprites.SpriteSheet')
+    def test_warm_volumes(self, mocksprite, mockpage, mockimage_cache,
+                          mockrepo, mocksignal):
+        solr_pages = [SolrPage(pid='page:%02d' % i, page_order=i,
+                               image_width=400, image_height=300)
+                      for i in range(35)]
+        vols = {
+            'vol:1': self.volume('vol:1', solr_pages),
+            'vol:2': self.volume('vol:2', []),
+        }
+        # unexpected error on one volume
+        type(vols['vol:2']).page_manifest = PropertyMock(side_effect=ValueError('bad data'))
+        mockrepo.return_value.get_object.side_effect = lambda pid, type: vols[pid]
+        mockimage_cache.cache_page_image.return_value = None
+        mocksprite.return_value.render.return_value = ('jpeg data', {})
+        mocksprite.return_value.pids = []
+
+        stdout, stderr = StringIO(), StringIO()
+        call_command('warm_cache', 'vol:1', 'vol:2', concurrency=1,
+                     stdout=stdout, stderr=stderr)
+
+        # error is reported, and does not stop other volumes
+        self.assert_('Unexpected error processing vol:2: bad data' in stderr.getvalue())
+        self.assert_('Processed vol:1 (35 pages)' in stdout.getvalue())
+        self.assert_('Processed 1 volume (35 pages)' in stdout.getvalue())
+        self.assert_('1 failure' in stdout.getvalue())
+
+        # sprite sheets are generated for each page of the page list,
+        # with the same pids and layout as the view
+        pids = [page.pid for page in solr_pages]
+        self.assertEqual([call(pids[:30], 'thumbnail', 'landscape'),
+                          call(pids[30:], 'thumbnail', 'landscape')],
+                         mocksprite.call_args_list)
+        self.assertEqual(2, mocksprite.return_value.render.call_count)
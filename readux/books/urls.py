@@ -7,6 +7,8 @@ urlpatterns = patterns('',
     url(r'^$', views.VolumeSearch.as_view(), name='search'),
     url(r'^covers/$', views.VolumeCoverSearch.as_view(), name='search-covers'),
     url(r'^unapi/$', views.Unapi.as_view(), name='unapi'),
+    url(r'^sprites/(?P<mode>(thumbnail|mini-thumbnail))\.(?P<format>(jpg|json))$',
+        views.ThumbnailSprite.as_view(), name='sprite'),
     url(r'^(?P<pid>[^/]+)/$', views.VolumeDetail.as_view(), name='volume'),
     url(r'^(?P<pid>[^/]+)/pdf/$', views.VolumePdf.as_view(), name='pdf'),
     url(r'^(?P<pid>[^/]+)/ocr/$', views.VolumeOcr.as_view(), name='ocr'),
@@ -15,6 +17,8 @@ urlpatterns = patterns('',
     url(r'^(?P<pid>[^/]+)/tei/$', views.VolumeTei.as_view(), name='tei'),
     url(r'^(?P<pid>[^/]+)/annotated-tei/$', views.VolumeTei.as_view(),
         {'mode': 'annotated'}, name='annotated-tei'),
+    url(r'^(?P<pid>[^/]+)/tags/$', views.VolumeAnnotationTags.as_view(),
+        name='annotation-tags'),
     url(r'^(?P<pid>[^/]+)/export/$',
          views.AnnotatedVolumeExport.as_view(), name='webexport'),
 
@@ -1,15 +1,17 @@
 import datetime
 from django.conf import settings
-from django.utils import timezone
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
 import os
 
 from eulfedora.views import datastream_etag
 from eulfedora.server import Repository
 from eulfedora.util import RequestFailed
 
-from readux.annotations.models import Annotation
-from readux.books.models import Volume, VolumeV1_0, Page, PageV1_0
-from readux.utils import solr_interface, md5sum
+from readux.books import image_cache
+from readux.books.models import Volume, VolumeV1_0, Page
+from readux import versions
+from readux.utils import solr_interface, md5sum, absolutize_url
 
 '''
 Conditional methods for calculating last modified time and ETags
@@ -20,134 +22,131 @@ for view methods in :mod:`readux.books.views`.
   In many cases, the Solr indexing timestamp is used rather than the object
   modification time, as this may account for changes to the site or indexing
   (including adding pages to a volume that is otherwise unchanged).
+
+Volume and page views use versions (see :mod:`readux.versions`) for
+indexed content and annotations, which are updated when content is
+reindexed or annotations change, so that conditional requests can be
+handled without querying Solr or the database.
 '''
 
 
-def volumes_modified(request, *args, **kwargs):
-    'last modification time for all volumes'
-    solr = solr_interface()
-    results = solr.query(content_model=VolumeV1_0.VOLUME_CONTENT_MODEL) \
-                  .sort_by('-timestamp').field_limit('timestamp')
-    # NOTE: using solr indexing timestamp instead of object last modified, since
-    # if an object's index has changed it may have been modified
+def solr_timestamp(query):
+    '''Most recent Solr indexing timestamp for items matching a query,
+    or None if there are no matching items.'''
+    results = query.sort_by('-timestamp').field_limit('timestamp')
+    if results.count():
+        return results[0]['timestamp']
 
-    # if user is logged in, changes in annotation totals result
-    # in volume page display modifications
-    latest_note = None
-    if request.user.is_authenticated():
-        latest_note = Annotation.objects.visible_to(request.user) \
-                                .last_created_time()
 
-    solrtime = results[0]['timestamp'] if results.count() else None
-    return solrtimestamp_or_datetime(solrtime, latest_note)
+def request_versions(request, scopes):
+    '''Get versions for a list of scopes (see
+    :meth:`readux.versions.get_versions`).  Versions are needed for both
+    ETag and Last-Modified, so they are stored on the request and only
+    retrieved once.'''
+    key = tuple(scope for scope, seed in scopes)
+    if not hasattr(request, 'content_versions'):
+        request.content_versions = {}
+    if key not in request.content_versions:
+        request.content_versions[key] = versions.get_versions(scopes)
+    return request.content_versions[key]
 
 
-def volume_modified(request, pid):
-    'last modification time for a single volume'
+def user_etag(request, scopes):
+    '''ETag for a list of version scopes; since annotation counts
+    vary by user, the ETag includes the current user.  Also
+    distinguishes ajax requests, for views that return json to ajax
+    requests.'''
+    user = request.user.pk if request.user.is_authenticated() else None
+    return versions.etag(request_versions(request, scopes), user,
+                         request.is_ajax())
+
+
+def volume_uri(pid):
+    '''Volume uri for a pid, as used for annotations, without
+    initializing a :class:`~readux.books.models.Volume`.'''
+    return absolutize_url(reverse('books:volume', kwargs={'pid': pid}))
+
+
+def index_seed():
+    '''Seed the version for the Solr index as a whole (see
+    :mod:`readux.versions`) with the most recent Solr timestamp.'''
     solr = solr_interface()
-    results = solr.query(content_model=VolumeV1_0.VOLUME_CONTENT_MODEL,
-                         pid=pid) \
-                  .sort_by('-timestamp').field_limit('timestamp')
-    # NOTE: using solr indexing timestamp instead of object last modified, since
-    # if an object's index has changed it may have been modified,
-    # and index timestamp for a volume will be updated when pages are added
+    return solr_timestamp(solr.query())
+
 
-    # if a user is logged in, page should show as modified
-    # when annotation count changes
-    latest_note = None
+def volumes_scopes(request):
+    # versions for all volumes: any change to the index,
+    # and, if the user is logged in, changes in annotation totals
+    scopes = [(versions.INDEX, index_seed)]
     if request.user.is_authenticated():
-        # NOTE: shouldn't be very expensive to init volume here; not actually
-        # making any api calls, just using volume to get volume
-        # uri and associated annotations
-        repo = Repository()
-        vol = repo.get_object(pid, type=Volume)
-        # newest annotation creation for pages in this volume
-        latest_note = vol.annotations().visible_to(request.user) \
-                         .last_created_time()
-
-    solrtime = results[0]['timestamp'] if results.count() else None
-    return solrtimestamp_or_datetime(solrtime, latest_note)
-
-
-def volume_pages_modified(request, pid):
-    '''Last modification time for a single volume or its pages, or for
-    any annotations of those pages.'''
-    solr = solr_interface()
-    repo = Repository()
-    vol = repo.get_object(pid, type=Volume)
+        scopes.append((versions.ANNOTATIONS, None))
+    return scopes
+
+def volumes_modified(request, *args, **kwargs):
+    'last modification time for all volumes'
+    return versions.last_modified(request_versions(request, volumes_scopes(request)))
+
+def volumes_etag(request, *args, **kwargs):
+    'etag for all volumes'
+    return user_etag(request, volumes_scopes(request))
 
-    # NOTE: some overlap with Volume find_solr_pages method...
-    results = solr.query((solr.Q(content_model=Volume.VOLUME_CMODEL_PATTERN) & solr.Q(pid=pid)) | \
-                         (solr.Q(content_model=Page.PAGE_CMODEL_PATTERN) & solr.Q(isConstituentOf=vol.uri))) \
-                  .sort_by('-timestamp').field_limit('timestamp')
+
+def volume_scopes(request, pid):
+    # versions for a volume: the index for the volume and its pages,
+    # and if the user is logged in, annotations on the volume
 
     # NOTE: using solr indexing timestamp instead of object last modified, since
     # if an object's index has changed it may have been modified,
     # and index timestamp for a volume will be updated when pages are added
-
-    # Page could also be modified based on annotations of the pages.
-    # We only show total counts per page, so might not be modified if the
-    # total number has not changed, but simplest just to get last modification
-    # date in case of changes.
-    # Note that this does NOT account for annotation deletions.
-
-    # if a user is logged in, page should show as modified
-    # based on annotations
-    # Only displaying annotation *count* so creation time should
-    # be sufficient. (Does not take into account deletions...)
-    latest_note = None
+    def seed():
+        solr = solr_interface()
+        return solr_timestamp(solr.query(
+            (solr.Q(content_model=Volume.VOLUME_CMODEL_PATTERN) & solr.Q(pid=pid)) | \
+            (solr.Q(content_model=Page.PAGE_CMODEL_PATTERN) &
+             solr.Q(isConstituentOf='info:fedora/%s' % pid))))
+
+    scopes = [(versions.index_scope(pid), seed)]
     if request.user.is_authenticated():
-        # get annotations for pages in this volume
-        try:
-            latest_note = vol.annotations().visible_to(request.user) \
-                             .last_created_time()
-        except Annotation.DoesNotExist:
-            # no notes for this volume
-            pass
-
-    solrtime = results[0]['timestamp'] if results.count() else None
-    return solrtimestamp_or_datetime(solrtime, latest_note)
+        scopes.append((versions.annotation_scope(volume_uri(pid)), None))
+    return scopes
 
+def volume_modified(request, pid, **kwargs):
+    'last modification time for a single volume'
+    return versions.last_modified(request_versions(request, volume_scopes(request, pid)))
 
-def page_modified(request, vol_pid, pid):
-    'last modification time for a single page'
-    solr = solr_interface()
-    # TODO: use volume pid in query
-    results = solr.query(content_model=PageV1_0.PAGE_CONTENT_MODEL,
-                         pid=pid) \
-                  .sort_by('-timestamp').field_limit('timestamp')
-
-    # if user is logged in, page should show as modified
-    # when annotations have changed
-    latest_note = None
-    if request.user.is_authenticated():
-        # last update for annotations on this volume, if any
-        repo = Repository()
-        page = repo.get_object(pid, type=Page)
-        latest_note = page.annotations().visible_to(request.user) \
-                          .last_updated_time()
+def volume_etag(request, pid, **kwargs):
+    'etag for a single volume'
+    return user_etag(request, volume_scopes(request, pid))
 
-    solrtime = results[0]['timestamp'] if results.count() else None
-    return solrtimestamp_or_datetime(solrtime, latest_note)
+# volume page list is based on the same content as the volume
+volume_pages_modified = volume_modified
+volume_pages_etag = volume_etag
 
 
-def solrtimestamp_or_datetime(solrtime, othertime):
-    # Compare and return the more recent of a solr timestamp or an
-    # annotation datetime.
+def page_scopes(request, vol_pid, pid):
+    # versions for a single page: the index for the page and its
+    # volume (which changes when pages are added, and so the previous
+    # and next page links), and if the user is logged in, annotations
+    # on the volume
+    def seed():
+        solr = solr_interface()
+        return solr_timestamp(solr.query(content_model=Page.PAGE_CMODEL_PATTERN,
+                                         pid=pid))
 
-    # convert solr timestamp to timezone-aware for comparison;
-    # return the most recent of the two
-    # FIXME:  assuming solr stores as UTC, confirm this
-    if solrtime is not None and othertime is not None:
-        solrtime = timezone.make_aware(solrtime, timezone.utc)
-        return max(solrtime, othertime)
+    scopes = [(versions.index_scope(pid), seed),
+              (versions.index_scope(vol_pid), None)]
+    if request.user.is_authenticated():
+        scopes.append((versions.annotation_scope(volume_uri(vol_pid)), None))
+    return scopes
 
-    # if both are not set, return solr time if present
-    if solrtime is not None:
-        return solrtime
+def page_modified(request, vol_pid, pid):
+    'last modification time for a single page'
+    return versions.last_modified(request_versions(request,
+                                  page_scopes(request, vol_pid, pid)))
 
-    # if nothing has been returned, return other time (could be None)
-    return othertime
+def page_etag(request, vol_pid, pid):
+    'etag for a single page'
+    return user_etag(request, page_scopes(request, vol_pid, pid))
 
 
 books_models_filename = os.path.join(settings.BASE_DIR, 'readux', 'books', 'models.py')
@@ -218,11 +217,62 @@ def ocr_lastmodified(request, pid):
 # (If this requires additional fedora api calls to determine type,
 # may be too costly.)
 
+#: timeout for cached page image checksums; cache keys include the
+#: page index version, so checksums can be kept for a long time
+page_image_checksum_timeout = getattr(settings, 'PAGE_IMAGE_CHECKSUM_CACHE_TIMEOUT',
+                                      60 * 60 * 24 * 30)
+
+def page_image_checksum(pid):
+    '''Checksum for a page image datastream, or None if the page has no
+    image.  Checksums are stored in the Django cache under the page
+    index version (see :mod:`readux.versions`), which changes when the
+    page is reindexed after a modification, so only the first request
+    for a page version needs to load the page from Fedora.'''
+    version = versions.get_versions([(versions.index_scope(pid), None)])[0]
+    key = None
+    if version is not None:
+        key = 'page-image-checksum:%s:%r' % (pid, version)
+        checksum = cache.get(key)
+        if checksum is not None:
+            return checksum
+
+    page = Repository().get_object(pid, type=Page)
+    if page.image.exists:
+        checksum = page.image.checksum
+        if key is not None:
+            cache.set(key, checksum, page_image_checksum_timeout)
+        return checksum
+
+def page_image_cache_entry(request, pid, mode, url=None, **kwargs):
+    '''Cache key and :class:`~readux.books.image_cache.CacheEntry` for
+    a page image derivative in the local image cache, as a tuple; entry
+    is None if the derivative has not been cached yet.  Returns None if
+    the image cache is not configured or the image mode is not cached.
+    Result is stored on the request, since it is needed for conditional
+    processing and for the view.'''
+    if not hasattr(request, 'page_image_cache'):
+        request.page_image_cache = None
+        derivatives = image_cache.derivative_cache()
+        if derivatives is not None and mode in image_cache.cached_modes:
+            try:
+                checksum = page_image_checksum(pid)
+                if checksum is not None:
+                    key = derivatives.key(pid, mode, url, checksum)
+                    request.page_image_cache = (key, derivatives.get(key))
+            except RequestFailed:
+                pass
+    return request.page_image_cache
+
 def page_image_etag(request, pid, **kwargs):
-    'etag for Page image datastream'
-    return datastream_etag(request, pid, Page.image.id, type=Page)
+    '''etag for a cached Page image derivative; based on the cache key,
+    which includes the image datastream checksum'''
+    cached = page_image_cache_entry(request, pid, **kwargs)
+    if cached is not None:
+        return cached[0]
 
 def page_image_lastmodified(request, pid, **kwargs):
-    'last modified for Page image datastream'
-    return datastream_lastmodified(request, pid, Page.image.id, type=Page)
+    'last modified for a cached Page image derivative'
+    cached = page_image_cache_entry(request, pid, **kwargs)
+    if cached is not None and cached[1] is not None:
+        return cached[1].created
 
@@ -5,9 +5,10 @@ from django.core.servers.basehttp import FileWrapper
 from django.contrib.sites.shortcuts import get_current_site
 from django.http import Http404, HttpResponse, HttpResponseNotFound, \
     HttpResponsePermanentRedirect, StreamingHttpResponse, HttpResponseBadRequest, \
-    JsonResponse
+    HttpResponseForbidden, JsonResponse
 from django.shortcuts import render
 from django.utils.decorators import method_decorator
+from django.utils.http import http_date, quote_etag
 from django.utils.text import slugify
 from django.views.decorators.http import condition, require_http_methods, \
    last_modified
@@ -16,6 +17,7 @@ from django.views.generic import ListView, DetailView, View
 from django.views.generic.edit import FormMixin, ProcessFormView
 from django.views.generic.base import RedirectView
 from eulcommon.djangoextras.auth import login_required_with_ajax
+import calendar
 import json
 from urllib import urlencode
 import os
@@ -29,10 +31,12 @@ from eulfedora.views import raw_datastream, RawDatastreamView
 
 from readux.annotations.models import AnnotationGroup
 from readux.books.models import Volume, SolrVolume, Page, VolumeV1_0, \
-    PageV1_1, SolrPage
+    PageV1_1, SolrPage, VolumePageSequence
 from readux.books.forms import BookSearch, VolumeExport
-from readux.books import view_helpers, annotate, export, github
-from readux.utils import solr_interface, absolutize_url
+from readux.books import view_helpers, annotate, export, github, \
+    tei_stream, image_cache, sprites
+from readux.search import SolrPaginator
+from readux.utils import solr_interface, absolutize_url, iiif_session
 from readux.views import VaryOnCookieMixin
 
 
@@ -51,10 +55,15 @@ class VolumeSearch(ListView):
     display_filters = []
     sort_options = ['relevance', 'title', 'date added']
 
-    @method_decorator(last_modified(view_helpers.volumes_modified))
+    @method_decorator(condition(etag_func=view_helpers.volumes_etag,
+        last_modified_func=view_helpers.volumes_modified))
     def dispatch(self, *args, **kwargs):
         return super(VolumeSearch, self).dispatch(*args, **kwargs)
 
+    def get_paginator(self, queryset, per_page, **kwargs):
+        # retrieve results, total and facets with a single solr request
+        return SolrPaginator(queryset, per_page, request=self.request, **kwargs)
+
     def get_queryset(self):
         self.form = BookSearch(self.request.GET)
 
@@ -162,11 +171,13 @@ class VolumeSearch(ListView):
                 if pages_loaded < context_data['paginator'].count:
                     facets['pages_loaded'] = facet_counts.facet_queries[0][1]
 
-            # generate list for display and removal of active filters
-            q = self.get_queryset()
             annotated_volumes = {}
             if context_data['paginator'].count and self.request.user.is_authenticated():
-                notes = Volume.volume_annotation_count(self.request.user)
+                # only load counts for volumes on the current page
+                uris = [absolutize_url(reverse('books:volume', kwargs={'pid': vol.pid}))
+                        for vol in context_data['object_list']]
+                notes = Volume.volume_annotation_count(self.request.user,
+                                                       uris=uris)
                 domain = get_current_site(self.request).domain.rstrip('/')
                 if not domain.startswith('http'):
                     domain = 'http://' + domain
@@ -179,6 +190,13 @@ class VolumeSearch(ListView):
                 'annotated_volumes': annotated_volumes
             })
 
+            # sprite sheet for covers on the current page of results
+            if self.display_mode == 'covers':
+                pids = [vol.primary_image['pid']
+                        for vol in context_data['object_list'] if vol.primary_image]
+                if pids:
+                    context_data['cover_sprite'] = sprites.SpriteSheet(pids)
+
         return context_data
 
 
@@ -197,7 +215,8 @@ class VolumeDetail(DetailView, VaryOnCookieMixin):
     search_template_name = 'books/volume_pages_search.html'
     context_object_name = 'vol'
 
-    @method_decorator(last_modified(view_helpers.volume_modified))
+    @method_decorator(condition(etag_func=view_helpers.volume_etag,
+        last_modified_func=view_helpers.volume_modified))
     @method_decorator(vary_on_headers('X-Requested-With'))  # vary on ajax request
     def dispatch(self, *args, **kwargs):
         return super(VolumeDetail, self).dispatch(*args, **kwargs)
@@ -327,7 +346,8 @@ class VolumePageList(ListView, VaryOnCookieMixin):
     paginate_by = 30
     context_object_name = 'pages'
 
-    @method_decorator(last_modified(view_helpers.volume_pages_modified))
+    @method_decorator(condition(etag_func=view_helpers.volume_pages_etag,
+        last_modified_func=view_helpers.volume_pages_modified))
     def dispatch(self, *args, **kwargs):
         return super(VolumePageList, self).dispatch(*args, **kwargs)
 
@@ -365,17 +385,44 @@ class VolumePageList(ListView, VaryOnCookieMixin):
             'annotation_search_enabled': bool(annotated_pages)
         })
 
-        # Check if the first page of the volume is wider than it is tall
-        # to set the layout of the pages
-        first_page = self.vol.pages[0]
-        if first_page.width > first_page.height:
-            layout = 'landscape'
-        else:
-            layout = 'default'
+        layout = self.page_layout(self.vol, self.object_list[:1])
         context_data['layout'] = layout
 
+        # sprite sheet for the thumbnails on the current page of results
+        sprite = self.page_sprite(context_data['pages'], layout)
+        if sprite is not None:
+            context_data['sprite'] = sprite
+
         return context_data
 
+    @staticmethod
+    def page_layout(vol, solr_pages):
+        '''Layout for the page list: landscape if the first page of the
+        volume is wider than it is tall, otherwise default.  Uses image
+        dimensions from solr if available, to avoid requesting image
+        metadata from the IIIF service.
+
+        :param vol: :class:`~readux.books.models.Volume`
+        :param solr_pages: solr page results, starting with the first page
+        '''
+        first_page = None
+        for solr_page in solr_pages[:1]:
+            if solr_page.width and solr_page.height:
+                first_page = solr_page
+        if first_page is None:
+            first_page = vol.pages[0]
+        if first_page.width > first_page.height:
+            return 'landscape'
+        return 'default'
+
+    @staticmethod
+    def page_sprite(solr_pages, layout):
+        '''Thumbnail :class:`~readux.books.sprites.SpriteSheet` for one
+        page of the page list, or None if there are no pages.'''
+        pids = [page.pid for page in solr_pages]
+        if pids:
+            return sprites.SpriteSheet(pids, 'thumbnail', layout)
+
 #: size used for scaling single page image
 SINGLE_PAGE_SIZE = 1000
 
@@ -385,7 +432,8 @@ class PageDetail(DetailView, VaryOnCookieMixin):
     template_name = 'books/page_detail.html'
     context_object_name = 'page'
 
-    @method_decorator(last_modified(view_helpers.page_modified))
+    @method_decorator(condition(etag_func=view_helpers.page_etag,
+        last_modified_func=view_helpers.page_modified))
     def dispatch(self, *args, **kwargs):
         return super(PageDetail, self).dispatch(*args, **kwargs)
 
@@ -400,27 +448,21 @@ class PageDetail(DetailView, VaryOnCookieMixin):
 
     def get_context_data(self, **kwargs):
         context_data = super(PageDetail, self).get_context_data()
-        # use solr to find adjacent pages to this one
-        pagequery = self.object.volume.find_solr_pages()
-        # search range around current page order
-        # (+/-1 should probably work, but using 2 to allow some margin for error)
-        pagequery = pagequery.query(page_order__range=(self.object.page_order - 2,
-                                                       self.object.page_order + 2))
-
-        # find the index of the current page in the sorted solr result
-        index = 0
-        prev = nxt = None
-        for p in pagequery:
-            if p['pid'] == self.object.pid:
-                break
-            index += 1
-            prev = p
-
-        if len(pagequery) > index + 1:
-            nxt = pagequery[index + 1]
-
-        # calculates which paginated page the page is part of based on 30 items per page
-        page_chunk = ((self.object.page_order - 1) // 30) + 1
+        # use cached list of pages in the volume to find adjacent pages
+        # and the page of the volume page list that includes this one
+        # (and this page's order, without loading it from fedora)
+        pages = VolumePageSequence(self.kwargs['vol_pid'])
+        prev = pages.previous(self.object.pid)
+        nxt = pages.next(self.object.pid)
+        current = pages.page(self.object.pid)
+        if current is not None and current['page_order'] is not None:
+            page_order = current['page_order']
+        else:
+            page_order = self.object.page_order
+        page_chunk = pages.page_chunk(self.object.pid, VolumePageList.paginate_by)
+        if page_chunk is None:
+            # page is not indexed; calculate based on page order
+            page_chunk = ((page_order - 1) // VolumePageList.paginate_by) + 1
 
         # form for searching in this book
         form = BookSearch()
@@ -445,7 +487,8 @@ class PageDetail(DetailView, VaryOnCookieMixin):
             scale = None
 
         context_data.update({'next': nxt, 'prev': prev,
-            'page_chunk': page_chunk, 'form': form, 'scale': scale})
+            'page_chunk': page_chunk, 'form': form, 'scale': scale,
+            'page_order': page_order, 'vol_pid': self.kwargs['vol_pid']})
 
         # if user is logged in, check for zotero account and pass
         # token and user id through for annotation citation
@@ -572,6 +615,10 @@ class VolumeText(VolumeOcr):
         return response
 
 class VolumeTei(View):
+    '''Download volume TEI or annotated TEI.  TEI is streamed page by
+    page (see :meth:`readux.books.tei_stream.stream_volume_tei`), so that
+    large volumes can be downloaded without generating the full
+    document in memory.'''
 
     def get(self, request, *args, **kwargs):
         repo = TypeInferringRepository()
@@ -580,16 +627,16 @@ class VolumeTei(View):
         if not vol.exists or not vol.has_requisite_content_models or not vol.has_tei:
             raise Http404
 
-        tei = vol.generate_volume_tei()
         base_filename = '%s-tei' % vol.noid
+        annotations = None
         if kwargs.get('mode', None) == 'annotated':
-            tei = annotate.annotated_tei(tei, vol.annotations() \
-                                                 .filter(user=request.user))
+            annotations = vol.annotations().filter(user=request.user)
             base_filename += '-annotated'
             logger.info('Exporting %s as annotated TEI for user %s',
                     vol.pid, request.user.username)
 
-        response = HttpResponse(tei.serialize(pretty=True),
+        response = StreamingHttpResponse(
+            tei_stream.stream_volume_tei(vol, annotations),
             content_type='application/xml')
         # generate a default filename based on the object label
         response['Content-Disposition'] = 'attachment;filename="%s.xml"' % \
@@ -598,6 +645,19 @@ class VolumeTei(View):
         return response
 
 
+class VolumeAnnotationTags(VaryOnCookieMixin, View):
+    '''Tag facet for annotations on a volume: JSON list of the tags used
+    on annotations visible to the current user, with the number of
+    annotations for each tag, most frequent first.'''
+
+    def get(self, request, *args, **kwargs):
+        repo = Repository(request=request)
+        vol = repo.get_object(self.kwargs['pid'], type=Volume)
+        if not vol.exists or not vol.is_a_volume:
+            raise Http404
+        return JsonResponse(vol.annotation_tags(request.user), safe=False)
+
+
 class AnnotatedVolumeExport(DetailView, FormMixin, ProcessFormView,
                             VaryOnCookieMixin):
     model = Volume
@@ -839,54 +899,172 @@ class PageRedirect(RedirectView):
 
 
 class ProxyView(View):
-    # quick and dirty proxyview modeled on RedirectView
-
-    def get(self, request, *args, **kwargs):
-        url = self.get_redirect_url(*args, **kwargs)
-        # use headers to allow browsers to cache downloaded copies
-        headers = {}
-        for header in ['HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_UNMODIFIED_SINCE',
-                       'HTTP_IF_MATCH', 'HTTP_IF_NONE_MATCH']:
+    '''Proxy view modeled on RedirectView; content is streamed from the
+    remote url in chunks through a shared, pooled http session
+    (see :meth:`readux.utils.iiif_session`), so that large images are
+    not held in memory and connections to the image server are reused.
+    Subclasses must implement **get_redirect_url**.'''
+
+    #: request headers to pass through to the remote server
+    proxy_request_headers = ['HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_UNMODIFIED_SINCE',
+                             'HTTP_IF_MATCH', 'HTTP_IF_NONE_MATCH',
+                             'HTTP_RANGE', 'HTTP_IF_RANGE', 'HTTP_ACCEPT_ENCODING']
+    #: remote response headers that should not be included in the response
+    excluded_response_headers = ['Connection', 'Server', 'Keep-Alive', 'Link',
+                                 'Transfer-Encoding']
+    # FIXME: link header is valuable, but would
+    # need to be made relative to current url
+
+    #: size of chunks to read from the remote response when streaming
+    chunk_size = 64 * 1024
+
+    def proxy_headers(self, request):
+        '''Request headers to pass to the remote server, so that browsers
+        can cache downloaded copies and request partial content.'''
+        headers = {
+            # pass content through unmodified unless the client
+            # accepts compressed content
+            'Accept-Encoding': 'identity'
+        }
+        for header in self.proxy_request_headers:
             if header in request.META:
-                headers[header.replace('HTTP_', '')] = request.META.get(header)
-        remote_response = requests.get(url, headers=headers)
-        local_response = HttpResponse()
-        local_response.status_code = remote_response.status_code
+                # use canonical header names (e.g., If-Modified-Since), so
+                # the client Accept-Encoding replaces the default above
+                headers[header.replace('HTTP_', '').replace('_', '-').title()] = \
+                    request.META.get(header)
+        return headers
 
-        # include response headers, except for server-specific items
+    def copy_headers(self, remote_response, response, exclude=None):
+        '''Include response headers from the remote response, except for
+        server-specific items.'''
+        exclude = self.excluded_response_headers + (exclude or [])
         for header, value in remote_response.headers.iteritems():
-            if header not in ['Connection', 'Server', 'Keep-Alive', 'Link']:
-                             # 'Access-Control-Allow-Origin', 'Link']:
-                # FIXME: link header is valuable, but would
-                # need to be made relative to current url
-                local_response[header] = value
+            if header.title() not in exclude:
+                response[header] = value
 
-        # special case, for deep zoom (hack)
+    def get(self, request, *args, **kwargs):
+        url = self.get_redirect_url(*args, **kwargs)
+        # special case, for deep zoom (hack); info.json needs to be
+        # modified, so it is not streamed
         if kwargs['mode'] == 'info':
-            data = remote_response.json()
-            # need to adjust the id to be relative to current url
-            # this is a hack, patching in a proxy iiif interface at this url
-            data['@id'] = absolutize_url(request.path.replace('/info/', '/iiif'))
-            local_response.content = json.dumps(data)
-            # upate content-length for change in data
-            local_response['content-length'] = len(local_response.content)
-            # needed to allow external site (i.e. jekyll export)
-            # to use deepzoom
-            local_response['Access-Control-Allow-Origin'] = '*'
+            return self.get_info(request, url)
+
+        try:
+            remote_response = iiif_session().get(url,
+                headers=self.proxy_headers(request), stream=True)
+        except requests.exceptions.Timeout:
+            logger.warn('Timeout requesting %s', url)
+            return HttpResponse(status=504)
+        except requests.exceptions.RequestException as err:
+            logger.warn('Error requesting %s: %s', url, err)
+            return HttpResponse(status=502)
+
+        # no content for not-modified responses
+        if remote_response.status_code == requests.codes.not_modified:
+            remote_response.close()
+            local_response = HttpResponse(status=remote_response.status_code)
         else:
-            # include response content if any
-            local_response.content = remote_response.content
+            # pass content through in chunks as it is received,
+            # without decoding (content-length and any content-encoding
+            # headers still apply); 206 partial content responses to
+            # range requests are passed through as is
+            local_response = StreamingHttpResponse(
+                _stream_remote_content(remote_response, self.chunk_size),
+                status=remote_response.status_code)
+        self.copy_headers(remote_response, local_response)
+        return local_response
 
+    def get_info(self, request, url):
+        '''Proxy IIIF image info, with the image id adjusted to be
+        relative to the current url.'''
+        try:
+            remote_response = iiif_session().get(url)
+        except requests.exceptions.Timeout:
+            logger.warn('Timeout requesting %s', url)
+            return HttpResponse(status=504)
+        except requests.exceptions.RequestException as err:
+            logger.warn('Error requesting %s: %s', url, err)
+            return HttpResponse(status=502)
+
+        local_response = HttpResponse(status=remote_response.status_code)
+        # content is decoded and modified, so content length and
+        # encoding from the remote response do not apply
+        self.copy_headers(remote_response, local_response,
+                          exclude=['Content-Length', 'Content-Encoding'])
+        if remote_response.status_code != requests.codes.ok:
+            local_response.content = remote_response.content
+            return local_response
+
+        data = remote_response.json()
+        # need to adjust the id to be relative to current url
+        # this is a hack, patching in a proxy iiif interface at this url
+        data['@id'] = absolutize_url(request.path.replace('/info/', '/iiif'))
+        local_response.content = json.dumps(data)
+        # upate content-length for change in data
+        local_response['content-length'] = len(local_response.content)
+        # needed to allow external site (i.e. jekyll export)
+        # to use deepzoom
+        local_response['Access-Control-Allow-Origin'] = '*'
         return local_response
 
     def head(self, request, *args, **kwargs):
         url = self.get_redirect_url(*args, **kwargs)
-        remote_response = requests.head(url)
-        response = HttpResponse()
-        for header, value in remote_response.headers.iteritems():
-            if header not in ['Connection', 'Server', 'Keep-Alive',
-                             'Access-Control-Allow-Origin', 'Link']:
-                response[header] = value
+        try:
+            remote_response = iiif_session().head(url,
+                headers=self.proxy_headers(request))
+        except requests.exceptions.Timeout:
+            logger.warn('Timeout requesting %s', url)
+            return HttpResponse(status=504)
+        except requests.exceptions.RequestException as err:
+            logger.warn('Error requesting %s: %s', url, err)
+            return HttpResponse(status=502)
+
+        response = HttpResponse(status=remote_response.status_code)
+        self.copy_headers(remote_response, response,
+                          exclude=['Access-Control-Allow-Origin'])
+        return response
+
+
+def _stream_remote_content(remote_response, chunk_size):
+    # generator for streaming proxied content; ensures the remote
+    # connection is released back to the pool when done
+    try:
+        for chunk in remote_response.raw.stream(chunk_size, decode_content=False):
+            yield chunk
+    finally:
+        remote_response.close()
+
+
+class ThumbnailSprite(View):
+    '''Sprite sheet combining thumbnails for a list of pages (specified
+    by one or more **pid** parameters, and an optional **layout**) into a
+    single image, so that a grid of thumbnails can be displayed with a
+    single request; see :class:`readux.books.sprites.SpriteSheet`.  With
+    json format, returns the sprite image url, size, and an offset map
+    with the position and size of each thumbnail.  Only sprite sheets
+    with a valid signature (i.e., urls generated by the site) are
+    generated.'''
+
+    def get(self, request, mode, format):
+        try:
+            sprite = sprites.SpriteSheet(request.GET.getlist('pid'), mode,
+                request.GET.get('layout', 'default'))
+        except ValueError as err:
+            return HttpResponseBadRequest(unicode(err))
+        if not sprite.valid_signature(request.GET.get('sig')):
+            return HttpResponseForbidden('Invalid sprite signature')
+
+        content, offsets = sprite.render()
+        if format == 'json':
+            width, height = sprite.size
+            return JsonResponse({
+                'image': sprite.url(), 'width': width, 'height': height,
+                'cell': {'width': sprite.cell_width, 'height': sprite.cell_height},
+                'pages': offsets
+            })
+
+        response = HttpResponse(content, content_type='image/jpeg')
+        response['ETag'] = quote_etag(sprite.cache_key)
         return response
 
 
@@ -898,7 +1076,101 @@ class PageImage(ProxyView):
     '''Local view for page images.  These all return redirects to the
     configured IIIF image viewer, but allow for a local, semantic
     image url independent of image handling implementations
-    to be referenced in annotations and exports.'''
+    to be referenced in annotations and exports.
+
+    If a local image cache is configured (see
+    :mod:`readux.books.image_cache`), derivative images and image info
+    are served from the cache, and only retrieved from the IIIF server
+    the first time they are requested.'''
+
+    @method_decorator(condition(etag_func=view_helpers.page_image_etag,
+        last_modified_func=view_helpers.page_image_lastmodified))
+    def dispatch(self, *args, **kwargs):
+        return super(PageImage, self).dispatch(*args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        cached = view_helpers.page_image_cache_entry(request, **kwargs)
+        # range requests are always passed through to the image server
+        if cached is None or 'HTTP_RANGE' in request.META:
+            return super(PageImage, self).get(request, *args, **kwargs)
+
+        key, entry = cached
+        if entry is None:
+            response, entry = self.cache_image(request, key, *args, **kwargs)
+            if entry is None:
+                return response
+        return self.cached_response(entry, kwargs['mode'])
+
+    def cache_image(self, request, key, *args, **kwargs):
+        '''Retrieve an image derivative from the IIIF server and add it
+        to the local image cache.  Returns a tuple of response and
+        :class:`~readux.books.image_cache.CacheEntry`; if the content
+        could not be retrieved, entry is None and the response should be
+        returned as is.'''
+        url = self.get_redirect_url(*args, **kwargs)
+        cache = image_cache.derivative_cache()
+        if kwargs['mode'] == 'info':
+            # cache image info as modified for the local url
+            response = self.get_info(request, url)
+            if response.status_code != requests.codes.ok:
+                return response, None
+            entry = cache.put(key, [response.content], response['Content-Type'])
+            return response, entry
+
+        try:
+            # always request unencoded content for the cache
+            remote_response = iiif_session().get(url,
+                headers={'Accept-Encoding': 'identity'}, stream=True)
+        except requests.exceptions.Timeout:
+            logger.warn('Timeout requesting %s', url)
+            return HttpResponse(status=504), None
+        except requests.exceptions.RequestException as err:
+            logger.warn('Error requesting %s: %s', url, err)
+            return HttpResponse(status=502), None
+
+        try:
+            if remote_response.status_code != requests.codes.ok:
+                response = HttpResponse(remote_response.content,
+                                        status=remote_response.status_code)
+                self.copy_headers(remote_response, response,
+                                  exclude=['Content-Length', 'Content-Encoding'])
+                return response, None
+            entry = cache.put(key, remote_response.iter_content(self.chunk_size),
+                              remote_response.headers.get('Content-Type'))
+        finally:
+            remote_response.close()
+        return None, entry
+
+    def cached_response(self, entry, mode):
+        '''Generate a response for a cached image derivative.  If
+        **IIIF_CACHE_SENDFILE** is configured, the response only
+        includes the configured header (e.g., **X-Sendfile**) and the web
+        server is expected to send the file; for **X-Accel-Redirect**, the
+        header is set to the file path relative to the cache directory,
+        prefixed with **IIIF_CACHE_SENDFILE_URL**.'''
+        sendfile = getattr(settings, 'IIIF_CACHE_SENDFILE', None)
+        if sendfile:
+            response = HttpResponse(content_type=entry.content_type)
+            if sendfile == 'X-Accel-Redirect':
+                cache = image_cache.derivative_cache()
+                response[sendfile] = '%s/%s' % (
+                    getattr(settings, 'IIIF_CACHE_SENDFILE_URL', '').rstrip('/'),
+                    os.path.relpath(entry.path, cache.root))
+            else:
+                response[sendfile] = entry.path
+        else:
+            response = StreamingHttpResponse(
+                FileWrapper(open(entry.path, 'rb'), self.chunk_size),
+                content_type=entry.content_type)
+            response['Content-Length'] = entry.size
+
+        response['ETag'] = quote_etag(entry.etag)
+        response['Last-Modified'] = http_date(calendar.timegm(entry.created.utctimetuple()))
+        if mode == 'info':
+            # needed to allow external site (i.e. jekyll export)
+            # to use deepzoom
+            response['Access-Control-Allow-Origin'] = '*'
+        return response
 
     def get_redirect_url(self, *args, **kwargs):
         repo = TypeInferringRepository()
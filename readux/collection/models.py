@@ -4,6 +4,7 @@ from django.db import models
 from django_image_tools.models import Image
 
 from eulcm.models.collection.v1_0 import Collection as Collectionv1_0
+from readux import versions
 from readux.utils import solr_interface
 
 
@@ -57,6 +58,11 @@ class Collection(Collectionv1_0, BaseCollection):
         data = super(Collection, self).index_data()
         # replace full title with short label
         data['title'] = self.short_label
+        # collection is being reindexed; versions for conditional views
+        # are pending until the indexer has updated solr, and the index
+        # as a whole is updated after that
+        versions.bump_pending(versions.index_scope(self.pid))
+        versions.bump_later(versions.INDEX)
         return data
 
 
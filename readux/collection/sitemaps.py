@@ -1,7 +1,7 @@
 from django.contrib.sitemaps import Sitemap
 from django.core.urlresolvers import reverse
 
-from readux.utils import solr_interface
+from readux.utils import solr_interface, solr_cursor
 from readux.collection.models import Collection
 
 class CollectionSitemap(Sitemap):
@@ -14,6 +14,10 @@ class CollectionSitemap(Sitemap):
                    .sort_by('title_exact') \
                    .field_limit(['pid', 'last_modified'])
 
+    def iter_items(self):
+        # all items, using a solr cursor; used to pre-generate sitemaps
+        return solr_cursor(self.items())
+
     def location(self, item):
         return reverse('collection:view', kwargs={'pid': item['pid']})
 
@@ -1,9 +1,10 @@
 from datetime import datetime
 from django.test import TestCase
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.core.paginator import Paginator
-from mock import patch, NonCallableMock, NonCallableMagicMock
+from mock import patch, NonCallableMock, NonCallableMagicMock, ANY
 
 from eulfedora.server import Repository
 from readux.collection.models import Collection, SolrCollection
@@ -23,6 +24,10 @@ class CollectionTest(TestCase):
 @patch('readux.collection.view_helpers.solr_interface')
 class CollectionViewsTest(TestCase):
 
+    def setUp(self):
+        # last-modified versions are stored in the cache
+        cache.clear()
+
     def test_browse(self, mocksolr_interface, mocksolr_iface):
         # for simplicity, use the same mock for view and conditional view helpers
         mocksolr = mocksolr_interface.return_value
@@ -86,6 +91,8 @@ class CollectionViewsTest(TestCase):
 
         # shouldn't error if no last modified date is found
         mocksolr.query.return_value.count.return_value = 0
+        # clear cached version, which was initialized from the solr timestamp
+        cache.clear()
 
         response = self.client.get(reverse('collection:list'))
         self.assertEqual(200, response.status_code,
@@ -226,4 +233,6 @@ class CollectionViewsTest(TestCase):
              testuser = User.objects.create_user(**credentials)
              self.client.login(**credentials)
              self.client.get(view_url)
-             mockvolclass.volume_annotation_count.assert_called_with(testuser)
+             # counts are only loaded for volumes on the current page
+             mockvolclass.volume_annotation_count.assert_called_with(testuser,
+                                                                     uris=ANY)
@@ -3,17 +3,18 @@ from urllib import urlencode
 
 from django.core.paginator import Paginator, EmptyPage, InvalidPage
 from django.contrib.sites.shortcuts import get_current_site
+from django.core.urlresolvers import reverse
 from django.http import Http404
 from django.shortcuts import render
 from django.utils.decorators import method_decorator
-from django.views.decorators.http import last_modified
+from django.views.decorators.http import condition
 from django.views.decorators.vary import vary_on_cookie
 from django.views.generic import ListView, DetailView
 
 
 from eulfedora.server import Repository
 
-from readux.utils import solr_interface
+from readux.utils import solr_interface, absolutize_url
 from readux.books.models import Volume, SolrVolume
 from readux.collection import view_helpers
 from readux.collection.models import Collection, SolrCollection
@@ -31,7 +32,8 @@ class CollectionList(ListView):
     template_name = 'collection/collection_list.html'
     display_mode = 'list'
 
-    @method_decorator(last_modified(view_helpers.collections_modified))
+    @method_decorator(condition(etag_func=view_helpers.collections_etag,
+        last_modified_func=view_helpers.collections_modified))
     def dispatch(self, *args, **kwargs):
         return super(CollectionList, self).dispatch(*args, **kwargs)
 
@@ -79,7 +81,8 @@ class CollectionDetail(DetailView, VaryOnCookieMixin):
     context_object_name = 'collection'
     display_mode = 'list'
 
-    @method_decorator(last_modified(view_helpers.collection_modified))
+    @method_decorator(condition(etag_func=view_helpers.collection_etag,
+        last_modified_func=view_helpers.collection_modified))
     def dispatch(self, *args, **kwargs):
         return super(CollectionDetail, self).dispatch(*args, **kwargs)
 
@@ -98,16 +101,6 @@ class CollectionDetail(DetailView, VaryOnCookieMixin):
         # sort: currently supports title or date added
         sort = self.request.GET.get('sort', None)
 
-        if self.request.user.is_authenticated():
-            notes = Volume.volume_annotation_count(self.request.user)
-            domain = get_current_site(self.request).domain.rstrip('/')
-            if not domain.startswith('http'):
-                domain = 'http://' + domain
-            annotated_volumes = dict([(k.replace(domain, ''), v)
-                 for k, v in notes.iteritems()])
-        else:
-            annotated_volumes = {}
-
         # search for all books that are in this collection
         solr = solr_interface()
         q = solr.query(content_model=Volume.VOLUME_CMODEL_PATTERN,
@@ -157,6 +150,18 @@ class CollectionDetail(DetailView, VaryOnCookieMixin):
         except (EmptyPage, InvalidPage):
             results = paginator.page(paginator.num_pages)
 
+        annotated_volumes = {}
+        if paginator.count and self.request.user.is_authenticated():
+            # only load counts for volumes on the current page
+            uris = [absolutize_url(reverse('books:volume', kwargs={'pid': vol.pid}))
+                    for vol in results.object_list]
+            notes = Volume.volume_annotation_count(self.request.user, uris=uris)
+            domain = get_current_site(self.request).domain.rstrip('/')
+            if not domain.startswith('http'):
+                domain = 'http://' + domain
+            annotated_volumes = dict([(k.replace(domain, ''), v)
+                 for k, v in notes.iteritems()])
+
         # facets for diplay
         facet_counts = results.object_list.facet_counts
         facets = {}
@@ -0,0 +1,39 @@
+import logging
+
+from django.conf import settings
+
+from readux.utils import solr_stats, iiif_stats
+
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamStatsMiddleware(object):
+    '''Reset :data:`readux.utils.solr_stats` and
+    :data:`readux.utils.iiif_stats` at the start of each request, and
+    report the number of requests made to Solr and the IIIF image server
+    and the time spent waiting on each when the response is returned.
+    Counts are logged at debug level; in debug mode they are also added
+    to the response as **X-Solr-Queries**, **X-Solr-Time**,
+    **X-IIIF-Requests** and **X-IIIF-Time** headers.'''
+
+    #: upstream services to report on, as tuples of label,
+    #: :class:`readux.utils.RequestStats`, and header prefix
+    upstreams = [
+        ('solr', solr_stats, 'X-Solr-Queries', 'X-Solr-Time'),
+        ('iiif', iiif_stats, 'X-IIIF-Requests', 'X-IIIF-Time'),
+    ]
+
+    def process_request(self, request):
+        for name, stats, count_header, time_header in self.upstreams:
+            stats.reset()
+
+    def process_response(self, request, response):
+        for name, stats, count_header, time_header in self.upstreams:
+            if stats.queries:
+                logger.debug('%s: %d %s requests in %.03fs', request.path,
+                             stats.queries, name, stats.time)
+            if settings.DEBUG:
+                response[count_header] = stats.queries
+                response[time_header] = '%.03f' % stats.time
+        return response
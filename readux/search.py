@@ -0,0 +1,170 @@
+'''Execute Solr searches so that a page of results, the total number of
+results, and facets are retrieved with a single Solr request.  Search
+responses are memoized on the current request, and stored briefly in
+the configured Django cache, keyed on the normalized query parameters
+and the version of the Solr index (see :mod:`readux.versions`), so
+that popular searches (e.g., searches with no filters) can be reused
+across requests and server processes.  Responses are cached for 60
+seconds by default; configure **SEARCH_CACHE_TIMEOUT** to change that.
+Responses cached while the indexer is updating Solr are invalidated
+once it has had time to finish (see :meth:`readux.versions.bump_later`),
+and responses are not cached if the version of the index is not known.
+
+Cache hits and misses are counted in :data:`cache_stats`, and the
+current hit rate is logged at debug level.
+'''
+
+import hashlib
+import logging
+import threading
+from urllib import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator, Page, EmptyPage, \
+    PageNotAnInteger
+
+from readux import versions
+
+
+logger = logging.getLogger(__name__)
+
+
+class CacheStats(object):
+    '''Hit and miss counts for a shared cache, for all threads in the
+    current process.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        'Reset hit and miss counts'
+        with self._lock:
+            #: number of lookups found in the cache
+            self.hits = 0
+            #: number of lookups not found in the cache
+            self.misses = 0
+
+    def record(self, hit):
+        'Record a single cache lookup'
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @property
+    def hit_rate(self):
+        'Fraction of lookups found in the cache, or None if there are none'
+        total = self.hits + self.misses
+        if total:
+            return float(self.hits) / total
+
+#: :class:`CacheStats` for the shared search cache
+cache_stats = CacheStats()
+
+
+def _timeout():
+    return getattr(settings, 'SEARCH_CACHE_TIMEOUT', 60)
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def cache_key(query):
+    '''Cache key for a sunburnt query, based on the query parameters
+    (sorted, so that equivalent queries share a key) and the current
+    version of the Solr index, so that cached responses are not used
+    after content is reindexed.  Returns None if the version of the
+    index is not known.'''
+    version, = versions.get_versions([(versions.INDEX, None)])
+    if version is None:
+        return None
+    params = sorted((_encode(name), _encode(value))
+                    for name, value in query.params())
+    return 'search:%s' % hashlib.md5('%r|%s' % (version, urlencode(params))) \
+                                .hexdigest()
+
+
+def execute(query, request=None):
+    '''Execute a sunburnt query (already paginated, if needed) with a
+    single Solr request, or using a cached response.  Returns a sunburnt
+    response with results, total (``result.numFound``) and facets
+    (``facet_counts``).
+
+    :param query: :class:`sunburnt.search.SolrSearch`
+    :param request: optional :class:`~django.http.HttpRequest`; if
+        specified, responses are memoized for the request
+    '''
+    key = cache_key(query)
+    # memoize on the query parameters if the response can't be cached
+    memo_key = key or repr(sorted(query.params()))
+    if request is not None:
+        if not hasattr(request, 'solr_responses'):
+            request.solr_responses = {}
+        if memo_key in request.solr_responses:
+            return request.solr_responses[memo_key]
+
+    # cache the raw solr response rather than the parsed response,
+    # which may reference the solr interface
+    content = None
+    if key is not None:
+        content = cache.get(key, None)
+        cache_stats.record(content is not None)
+        logger.debug('search cache %s; hit rate %.01f%% of %d lookups',
+                     'hit' if content is not None else 'miss',
+                     cache_stats.hit_rate * 100,
+                     cache_stats.hits + cache_stats.misses)
+    if content is None:
+        content = query.interface.conn.select(query.params())
+        if key is not None:
+            cache.set(key, content, _timeout())
+
+    # equivalent to sunburnt SolrSearch.execute
+    response = query.interface.schema.parse_response(content)
+    constructor = query.result_constructor
+    if constructor is not dict:
+        response.result.docs = [constructor(**doc) for doc in response.result.docs]
+
+    if request is not None:
+        request.solr_responses[memo_key] = response
+    return response
+
+
+class SolrPaginator(Paginator):
+    '''Paginator for a sunburnt query that retrieves a page of results
+    and the total number of results with a single request (see
+    :meth:`execute`), instead of separate requests for the count and the
+    page.  The ``object_list`` for each page is the sunburnt response,
+    so facets are available as ``object_list.facet_counts``.
+
+    :param request: optional :class:`~django.http.HttpRequest`, for
+        memoizing responses
+    '''
+
+    def __init__(self, object_list, per_page, request=None, **kwargs):
+        super(SolrPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.request = request
+
+    def page(self, number):
+        if not hasattr(self.object_list, 'paginate'):
+            # not a solr query (e.g., empty list for an invalid search)
+            return super(SolrPaginator, self).page(number)
+
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+
+        response = execute(self.object_list.paginate(start=(number - 1) * self.per_page,
+                                                     rows=self.per_page),
+                           self.request)
+        # total number of results is included with every page
+        self._count = response.result.numFound
+        self._num_pages = None
+        return Page(response, self.validate_number(number), self)
@@ -55,6 +55,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'readux.accounts.middleware.LocalSocialAuthExceptionMiddleware',
+    'readux.middleware.UpstreamStatsMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware'
 )
 
@@ -0,0 +1,198 @@
+'''Pre-generated sitemaps.  Generating sitemaps for volumes and pages
+on request requires paging through every indexed object in Solr, and
+Django's sitemap framework pages by offset, which gets slower for each
+later section of the sitemap.  Instead, the **generate_sitemaps**
+manage command can be run after indexing to write every section of the
+sitemap to gzipped files on disk, retrieving Solr results with cursors
+(see :meth:`readux.utils.solr_cursor`), and the sitemap views serve
+those files when they are available.
+
+Files are written to the directory configured as **SITEMAP_DIR**; if it
+is not configured or the sitemaps have not been generated, sitemaps are
+generated on request by the Django sitemap views.
+'''
+
+import gzip
+import itertools
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.contrib.sitemaps import views as sitemap_views
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, HttpResponseNotModified
+from django.template.loader import render_to_string
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+from readux.utils import absolutize_url
+
+
+#: filename for the pre-generated sitemap index
+INDEX_FILENAME = 'sitemap.xml'
+
+
+def sitemap_dir():
+    'Configured directory for pre-generated sitemaps, if any'
+    return getattr(settings, 'SITEMAP_DIR', None)
+
+def section_filename(section, page):
+    'Filename for a single page of a pre-generated sitemap section'
+    return 'sitemap-%s-%d.xml.gz' % (section, page)
+
+_section_file_re = re.compile(r'^sitemap-.+-\d+\.xml\.gz$')
+
+
+def _get(sitemap, name, item, default=None):
+    # equivalent to Sitemap.__get: attributes may be methods or values
+    attr = getattr(sitemap, name, None)
+    if callable(attr):
+        return attr(item)
+    return attr if attr is not None else default
+
+def sitemap_urls(sitemap):
+    '''Generator of url information for every item in a sitemap, in the
+    format used by the Django sitemap template.  Uses the sitemap
+    ``iter_items`` method to find items if it has one (i.e., to iterate
+    through Solr results with a cursor), and otherwise ``items``.'''
+    items = sitemap.iter_items() if hasattr(sitemap, 'iter_items') \
+        else sitemap.items()
+    for item in items:
+        priority = _get(sitemap, 'priority', item)
+        yield {
+            'item': item,
+            'location': absolutize_url(_get(sitemap, 'location', item)),
+            'lastmod': _get(sitemap, 'lastmod', item),
+            'changefreq': _get(sitemap, 'changefreq', item),
+            'priority': str(priority if priority is not None else ''),
+        }
+
+
+def _write(directory, filename, content, compress=False):
+    # write to a temporary file in the same directory and rename into
+    # place, so that a partially written file is never served
+    tmp = tempfile.NamedTemporaryFile(dir=directory, prefix='.tmp-',
+                                      delete=False)
+    try:
+        with tmp:
+            if compress:
+                with gzip.GzipFile(filename=filename, mode='wb', fileobj=tmp) as gz:
+                    gz.write(content.encode('utf-8'))
+            else:
+                tmp.write(content.encode('utf-8'))
+        # temporary files are only readable by the owner; make the
+        # sitemap readable by the web server
+        os.chmod(tmp.name, 0644)
+        os.rename(tmp.name, os.path.join(directory, filename))
+    except Exception:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+        raise
+
+
+def generate(sitemaps, directory=None):
+    '''Write every section of the specified sitemaps to gzipped files,
+    with no more than the sitemap ``limit`` urls per file, along with a
+    sitemap index that refers to them.  Files from a previous run that
+    are no longer needed are removed.  Returns a dictionary of the
+    number of files written for each section.
+
+    :param sitemaps: dictionary of sitemaps, as passed to the Django
+        sitemap views
+    :param directory: directory to write to; defaults to **SITEMAP_DIR**
+    '''
+    directory = directory or sitemap_dir()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    written = set()
+    pages = {}
+    locations = []
+    for section, site in sorted(sitemaps.items()):
+        if callable(site):
+            site = site()
+        urls = sitemap_urls(site)
+        pages[section] = 0
+        while True:
+            urlset = list(itertools.islice(urls, site.limit))
+            # always write the first page, so an empty section is valid
+            if not urlset and pages[section]:
+                break
+            pages[section] += 1
+            filename = section_filename(section, pages[section])
+            _write(directory, filename,
+                   render_to_string('sitemap.xml', {'urlset': urlset}),
+                   compress=True)
+            written.add(filename)
+
+            # urls for sections are the same as for the django views
+            location = absolutize_url(reverse('sitemap', kwargs={'section': section}))
+            if pages[section] > 1:
+                location = '%s?p=%d' % (location, pages[section])
+            locations.append(location)
+
+    _write(directory, INDEX_FILENAME,
+           render_to_string('sitemap_index.xml', {'sitemaps': locations}))
+
+    # remove pages from a previous run that were not regenerated
+    for filename in os.listdir(directory):
+        if _section_file_re.match(filename) and filename not in written:
+            os.remove(os.path.join(directory, filename))
+
+    return pages
+
+
+def _pregenerated(filename):
+    # path to a pre-generated file, if it exists
+    directory = sitemap_dir()
+    if directory:
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            return path
+
+def _serve(request, path, gzipped=False):
+    stat = os.stat(path)
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                              stat.st_mtime, stat.st_size):
+        return HttpResponseNotModified()
+
+    # serve compressed content as is, if the client accepts it
+    compressed = gzipped and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    opener = gzip.open if gzipped and not compressed else open
+    with opener(path, 'rb') as sitemap:
+        response = HttpResponse(sitemap.read(), content_type='application/xml')
+    if compressed:
+        response['Content-Encoding'] = 'gzip'
+    if gzipped:
+        patch_vary_headers(response, ['Accept-Encoding'])
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    # same as the django sitemap views
+    response['X-Robots-Tag'] = 'noindex, noodp, noarchive'
+    return response
+
+
+def index(request, sitemaps):
+    '''Sitemap index view.  Serves the pre-generated index if
+    available, and otherwise uses the Django sitemap index view.'''
+    path = _pregenerated(INDEX_FILENAME)
+    if path is None:
+        return sitemap_views.index(request, sitemaps, sitemap_url_name='sitemap')
+    return _serve(request, path)
+
+def sitemap(request, sitemaps, section):
+    '''Sitemap section view.  Serves the pre-generated file for the
+    requested section and page if available, and otherwise uses the
+    Django sitemap view.'''
+    path = None
+    # only look for files for known sections; invalid sections and
+    # pages are reported by the django view
+    if section in sitemaps:
+        try:
+            path = _pregenerated(section_filename(section, int(request.GET.get('p', 1))))
+        except ValueError:
+            pass
+    if path is None:
+        return sitemap_views.sitemap(request, sitemaps, section=section)
+    return _serve(request, path, gzipped=True)
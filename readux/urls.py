@@ -2,11 +2,11 @@ from django.conf import settings
 from django.conf.urls import patterns, include, url
 from django.conf.urls.static import static
 from django.contrib import admin
-from django.contrib.sitemaps import views as sitemap_views
 from django.views.generic import TemplateView
 from django.views.generic.base import RedirectView
 from feincms.module.page.sitemap import PageSitemap
 
+from readux import sitemaps as sitemap_views
 from readux.annotations import views as annotation_views
 from readux.books.sitemaps import VolumePdfSitemap, VolumeSitemap, \
     VolumePageSitemap
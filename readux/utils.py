@@ -1,6 +1,11 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import hashlib
+import logging
+from lxml import etree
+import threading
+import time
 from urlparse import urlparse
 from sunburnt import sunburnt
 
@@ -8,15 +13,85 @@ from django.conf import settings
 from django.contrib.sites.models import Site
 
 
-def solr_interface():
-    '''Wrapper function to initialize a
-    :class:`sunburnt.SolrInterface` based on django settings and
-    evironment.  Uses **SOLR_SERVER_URL** and **SOLR_CA_CERT_PATH** if
-    one is set.  Additionally, if an **HTTP_PROXY** is set in the
+logger = logging.getLogger(__name__)
+
+
+class RequestStats(threading.local):
+    '''Thread-local counters for requests to a backend service (e.g.,
+    Solr or the IIIF image server), so that the number of requests and
+    the time spent waiting on the service can be reported for the current
+    web request.  Reset at the start of each request by
+    :class:`readux.middleware.UpstreamStatsMiddleware`.'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        'Reset query count and elapsed time'
+        #: number of http requests made to the service
+        self.queries = 0
+        #: total time spent waiting on the service, in seconds
+        self.time = 0.0
+
+    def record(self, elapsed):
+        'Record a single request that took `elapsed` seconds'
+        self.queries += 1
+        self.time += elapsed
+
+#: :class:`RequestStats` for Solr requests in the current thread
+solr_stats = RequestStats()
+#: :class:`RequestStats` for IIIF image server requests in the current thread
+iiif_stats = RequestStats()
+
+
+class PooledSession(requests.Session):
+    '''Extension of :class:`requests.Session` with a keep-alive
+    connection pool of the specified size.  Adds a default timeout to all
+    requests (requests does not support setting a session-level timeout)
+    and records each request in the specified :class:`RequestStats`.
+    For streamed responses, the recorded time is the time until
+    response headers are received.'''
+
+    timeout = None
+    stats = None
+
+    def __init__(self, timeout=None, stats=None, pool_size=10):
+        super(PooledSession, self).__init__()
+        self.timeout = timeout
+        self.stats = stats
+        # keep-alive connection pool; pool size should be at least
+        # the number of threads that might make requests at once
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout', None) is None:
+            kwargs['timeout'] = self.timeout
+        start = time.time()
+        try:
+            return super(PooledSession, self).request(method, url, **kwargs)
+        finally:
+            if self.stats is not None:
+                self.stats.record(time.time() - start)
+
+
+_solr = None
+_solr_lock = threading.Lock()
+
+
+def solr_session():
+    '''Initialize a :class:`PooledSession` for Solr based on django settings
+    and environment.  Uses **SOLR_CA_CERT_PATH** and **SOLR_DISABLE_CERT_CHECK**
+    if set.  Connection pool size and timeout can be configured with
+    **SOLR_POOL_SIZE** (default 10) and **SOLR_TIMEOUT** (in seconds;
+    default 30).  Additionally, if an **HTTP_PROXY** is set in the
     environment, it will be configured.
     '''
-
-    session = requests.Session()
+    session = PooledSession(timeout=getattr(settings, 'SOLR_TIMEOUT', 30),
+                            stats=solr_stats,
+                            pool_size=getattr(settings, 'SOLR_POOL_SIZE', 10))
 
     if hasattr(settings, 'SOLR_CA_CERT_PATH'):
         session.cert = settings.SOLR_CA_CERT_PATH
@@ -32,17 +107,100 @@ def solr_interface():
            parsed_proxy.scheme: http_proxy   # i.e., 'http': 'hostname:3128'
         }
 
-    # pass in the constructed requests session as the connection to be used
-    # when making requests of solr
-    solr_opts = {'http_connection': session}
-    # since we have the schema available, don't bother requesting it
-    # from solr every time we initialize a new connection
-    if hasattr(settings, 'SOLR_SCHEMA'):
-        solr_opts['schemadoc'] = settings.SOLR_SCHEMA
-
-    solr = sunburnt.SolrInterface(settings.SOLR_SERVER_URL,
-                                  **solr_opts)
-    return solr
+    return session
+
+
+def solr_interface():
+    '''Wrapper function to access a :class:`sunburnt.SolrInterface`
+    based on django settings and evironment.  Uses **SOLR_SERVER_URL**
+    and the connection options documented in :meth:`solr_session`.
+
+    The interface is initialized once and shared by all threads in
+    the current process, so that the configured schema is only parsed
+    once and http connections to Solr are pooled and reused across
+    queries and requests.
+    '''
+    global _solr
+
+    if _solr is None:
+        with _solr_lock:
+            # check again, in case another thread initialized it
+            # while this one was waiting for the lock
+            if _solr is None:
+                # pass in the constructed requests session as the connection
+                # to be used when making requests of solr
+                solr_opts = {'http_connection': solr_session()}
+                # since we have the schema available, don't bother requesting it
+                # from solr every time we initialize a new connection
+                if hasattr(settings, 'SOLR_SCHEMA'):
+                    solr_opts['schemadoc'] = settings.SOLR_SCHEMA
+
+                _solr = sunburnt.SolrInterface(settings.SOLR_SERVER_URL,
+                                               **solr_opts)
+    return _solr
+
+
+def solr_cursor(query, rows=1000):
+    '''Generator for all results of a sunburnt query, retrieved in
+    batches using Solr cursors (``cursorMark``), so that later batches
+    are as fast to retrieve as the first, unlike deep paging with
+    ``start``.  Results are sorted by any sort already specified on the
+    query, with pid (the unique key) added to make the order stable, as
+    required for cursors.  Requires Solr 4.7 or later.
+
+    :param query: :class:`sunburnt.search.SolrSearch`
+    :param rows: number of results to retrieve per request
+    '''
+    params = [(name, value) for name, value in query.params()
+              if name not in ['start', 'rows', 'sort', 'cursorMark']]
+    sort = [value for name, value in query.params() if name == 'sort']
+    sort.append('pid asc')
+    params.extend([('sort', ','.join(sort)), ('rows', rows)])
+
+    cursor = '*'
+    while True:
+        content = query.interface.conn.select(params + [('cursorMark', cursor)])
+        response = query.interface.schema.parse_response(content)
+        for doc in response.result.docs:
+            yield doc
+        # sunburnt does not parse the next cursor mark from the response
+        next_cursor = etree.fromstring(content) \
+                           .xpath('string(/response/str[@name="nextCursorMark"])')
+        # cursor mark does not change once all results are retrieved
+        if not next_cursor or next_cursor == cursor:
+            break
+        cursor = next_cursor
+
+
+def reset_solr_interface():
+    '''Discard the shared :class:`sunburnt.SolrInterface`, so it will be
+    re-initialized with current settings on the next call to
+    :meth:`solr_interface` (e.g., when settings are changed in tests).'''
+    global _solr
+    with _solr_lock:
+        _solr = None
+
+
+_iiif = None
+_iiif_lock = threading.Lock()
+
+
+def iiif_session():
+    '''Access a :class:`PooledSession` for requests to the IIIF image
+    server, shared by all threads in the current process so that
+    connections are reused.  Connection pool size and timeout can be
+    configured with **IIIF_POOL_SIZE** (default 10) and **IIIF_TIMEOUT**
+    (in seconds; default 30).
+    '''
+    global _iiif
+
+    if _iiif is None:
+        with _iiif_lock:
+            if _iiif is None:
+                _iiif = PooledSession(timeout=getattr(settings, 'IIIF_TIMEOUT', 30),
+                                      stats=iiif_stats,
+                                      pool_size=getattr(settings, 'IIIF_POOL_SIZE', 10))
+    return _iiif
 
 
 def md5sum(filename):
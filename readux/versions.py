@@ -0,0 +1,223 @@
+'''Version vectors for conditional views.  Each *scope* (e.g., the Solr
+index for a single object, or annotations on a single volume) has a
+version, which is the time of the most recent change, stored in the
+configured Django cache.  Versions are updated when objects are
+indexed (see the ``index_data`` methods) and when annotations change,
+so that views can calculate ETag and Last-Modified headers from a few
+cache lookups instead of querying Solr and the database; since
+versions are updated when annotations are deleted, deletions also
+change the headers.
+
+Versions are strictly increasing.  If a version is not in the cache
+(e.g., after the cache is cleared), it is initialized from an optional
+*seed* function, or otherwise with the current time, so a new version
+is never older than the content it describes.  Versions are cached
+without expiration by default; configure **VERSION_CACHE_TIMEOUT** to
+change that.
+
+A version must not change before the content it describes, or the
+old content could be cached under the new version.  Changes saved in
+the database should be made within :meth:`atomic`, so that versions
+are only updated once the changes are committed.  Index data is
+generated for the indexer, which then updates Solr; versions for
+indexed content are marked as pending (see :meth:`bump_pending`), and
+are unknown, so responses are not cached, until the indexer has had
+time to update Solr (configured as **VERSION_PENDING_DELAY**, in
+seconds; 60 by default).  Since the whole index changes whenever any
+object is indexed, the version for the index as a whole is not marked
+as pending, but updated once the indexer has had time to update Solr
+(see :meth:`bump_later`).
+'''
+
+import calendar
+from contextlib import contextmanager
+from datetime import datetime
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+
+#: scope for the Solr index as a whole
+INDEX = 'index'
+#: scope for all annotations
+ANNOTATIONS = 'annotations'
+
+
+def index_scope(pid):
+    'Version scope for the indexed content of a single object'
+    return '%s:%s' % (INDEX, pid)
+
+def annotation_scope(volume_uri):
+    'Version scope for annotations on a single volume'
+    return '%s:%s' % (ANNOTATIONS, hashlib.md5(volume_uri).hexdigest())
+
+
+def _cache_key(scope):
+    return 'version:%s' % scope
+
+def _pending_key(scope):
+    return 'version-pending:%s' % scope
+
+def _later_key(scope):
+    return 'version-later:%s' % scope
+
+def _timeout():
+    return getattr(settings, 'VERSION_CACHE_TIMEOUT', None)
+
+def _pending_delay():
+    return getattr(settings, 'VERSION_PENDING_DELAY', 60)
+
+def _timestamp(value):
+    # convert a datetime (naive datetimes are assumed to be UTC)
+    # into a unix timestamp
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def get_versions(scopes):
+    '''Get current versions for a list of scopes.  Scopes are
+    specified as tuples of scope name and seed function, which is used
+    to initialize a version that is not cached; seed function should
+    return a :class:`~datetime.datetime` or None if the version is not
+    known.  If no seed function is specified, versions are initialized
+    with the current time.  Returns a list of versions (timestamps), or
+    None for unknown versions, including versions with a pending update
+    (see :meth:`bump_pending`).'''
+    keys = [_cache_key(scope) for scope, seed in scopes]
+    pending_keys = [_pending_key(scope) for scope, seed in scopes]
+    later_keys = [_later_key(scope) for scope, seed in scopes]
+    cached = cache.get_many(keys + pending_keys + later_keys)
+    now = time.time()
+    result = []
+    for (scope, seed), key, pending_key, later_key in \
+            zip(scopes, keys, pending_keys, later_keys):
+        value = cached.get(key, None)
+        pending = cached.get(pending_key, None)
+        if pending is not None and pending > now:
+            # content may still be changing
+            result.append(None)
+            continue
+        # scheduled updates that are due (see bump_later)
+        due = [t for t in cached.get(later_key, ()) if t <= now]
+        if due:
+            pending = max([pending or 0] + due)
+        if value is None:
+            initial = seed() if seed is not None else timezone.now()
+            if initial is not None:
+                value = _timestamp(initial)
+                # another process may have initialized the version;
+                # if so, use that value
+                if not cache.add(key, value, _timeout()):
+                    value = cache.get(key, value)
+        if pending is not None:
+            # once a pending update is complete, the version is at least
+            # the time the update was expected to be complete
+            value = max(value or 0, pending)
+        result.append(value)
+    return result
+
+
+class _Deferred(threading.local):
+    # scopes to be updated when the outermost atomic block exits
+    depth = 0
+    scopes = None
+
+_deferred = _Deferred()
+
+
+@contextmanager
+def atomic(using=None):
+    '''Context manager equivalent to :meth:`django.db.transaction.atomic`,
+    which also defers any version updates (see :meth:`bump`) made within
+    it until the outermost block exits successfully, so that versions are
+    not updated before changes are committed.  If the block exits with an
+    exception, deferred updates are discarded.'''
+    depth = _deferred.depth
+    if not depth:
+        _deferred.scopes = set()
+    _deferred.depth = depth + 1
+    try:
+        with transaction.atomic(using=using):
+            yield
+    finally:
+        _deferred.depth = depth
+        if not depth:
+            scopes, _deferred.scopes = _deferred.scopes, None
+    if not depth:
+        bump(*scopes)
+
+
+def bump(*scopes):
+    '''Update versions for one or more scopes, to indicate a change.
+    Within :meth:`atomic`, versions are updated when the outermost block
+    exits.'''
+    if _deferred.depth:
+        _deferred.scopes.update(scopes)
+        return
+    now = time.time()
+    for scope in scopes:
+        key = _cache_key(scope)
+        current = cache.get(key, 0)
+        # ensure versions always increase, even if changes happen
+        # within clock resolution
+        cache.set(key, max(now, current + 0.000001), _timeout())
+
+
+def bump_pending(*scopes):
+    '''Mark versions for one or more scopes as pending, for content that
+    is about to be changed elsewhere (i.e., when index data is generated
+    for the indexer, which then updates Solr).  Versions are unknown
+    until **VERSION_PENDING_DELAY** seconds have passed, and are then
+    updated.'''
+    until = time.time() + _pending_delay()
+    for scope in scopes:
+        key = _pending_key(scope)
+        cache.set(key, max(until, cache.get(key, 0)), _timeout())
+
+
+def bump_later(*scopes):
+    '''Update versions for one or more scopes once
+    **VERSION_PENDING_DELAY** seconds have passed, for content that is
+    about to be changed elsewhere but changes too often to be marked as
+    pending (i.e., the index as a whole, which changes whenever any
+    object is indexed).  Until then, the current version is used, and
+    content cached in the meantime is invalidated when the version is
+    updated.  The earliest scheduled update is never postponed by later
+    ones, so frequent changes still update the version.'''
+    now = time.time()
+    until = now + _pending_delay()
+    for scope in scopes:
+        key = _later_key(scope)
+        first, last = cache.get(key, (None, None))
+        if first is not None and first <= now:
+            # store updates that are already due before scheduling
+            # another one
+            version_key = _cache_key(scope)
+            due = max(t for t in (first, last) if t <= now)
+            cache.set(version_key, max(cache.get(version_key, 0), due),
+                      _timeout())
+            first = last if last > now else None
+        cache.set(key, (first or until, until), _timeout())
+
+
+def last_modified(versions):
+    '''Last modification time for a list of versions, as returned by
+    :meth:`get_versions`, as a timezone-aware
+    :class:`~datetime.datetime`, or None if any version is not known.'''
+    if versions and None not in versions:
+        return datetime.utcfromtimestamp(max(versions)).replace(tzinfo=timezone.utc)
+
+
+def etag(versions, *extra):
+    '''ETag for a list of versions, as returned by :meth:`get_versions`,
+    and any additional values that distinguish versions of the content
+    (e.g., the current user); returns None if any version is not known.'''
+    if versions and None not in versions:
+        return hashlib.md5('|'.join(repr(v) for v in list(versions) + list(extra))) \
+                      .hexdigest()